@@ -0,0 +1,336 @@
+import asyncio
+import os
+import shlex
+import socket
+from asyncio.subprocess import PIPE, DEVNULL
+from logging import DEBUG, getLogger
+
+import serial
+from django.conf import settings
+
+from commands.cec import READY_MARKER as CEC_READY_MARKER
+from commands.serialport import decode_frame
+from commands.tcp import KEEPALIVE_OPTIONS, TcpUnavailable, encode_commands
+from riker.logutils import log_event
+
+LOGGER = getLogger(__name__)
+
+CEC_READY_TIMEOUT = 30
+
+SERIAL_CONNECTIONS = {}
+
+TCP_CONNECTIONS = {}
+
+CEC_CLIENT = None
+
+
+class AsyncSerialPort(object):
+    """
+    A pyserial port whose file descriptor is driven by the event loop instead
+    of blocking writes.
+    """
+
+    def __init__(self, port, baud, bytesize, timeout, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.serial = serial.Serial(port, baudrate=baud, bytesize=bytesize, timeout=0)
+        os.set_blocking(self.serial.fileno(), False)
+        self._lock = asyncio.Lock()
+        self.timeout = timeout
+
+    def _wait_writable(self):
+        future = self.loop.create_future()
+        fd = self.serial.fileno()
+        self.loop.add_writer(fd, future.set_result, None)
+        future.add_done_callback(lambda _: self.loop.remove_writer(fd))
+        return future
+
+    async def write(self, data):
+        async with self._lock:
+            view = memoryview(data)
+            while view:
+                try:
+                    written = os.write(self.serial.fileno(), view)
+                except BlockingIOError:
+                    written = 0
+                view = view[written:]
+                if view:
+                    await asyncio.wait_for(self._wait_writable(), self.timeout or None)
+
+    async def close(self):
+        async with self._lock:
+            self.serial.close()
+
+
+class AsyncCecClient(object):
+    """
+    Wraps a cec-client subprocess, started as ``command`` like CecSession.
+    stdout is drained continuously so that the pipe never fills, and is
+    watched for the ready marker.
+    """
+
+    def __init__(self, command=('cec-client', '-d', '8'), loop=None):
+        self.command = list(command)
+        self.loop = loop or asyncio.get_event_loop()
+        self.process = None
+        self.ready = asyncio.Event()
+        self._starting = asyncio.Lock()
+
+    async def start(self):
+        self.ready.clear()
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command,
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
+        )
+        self.loop.create_task(self._read_output())
+        try:
+            await asyncio.wait_for(self.ready.wait(), CEC_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            LOGGER.warning('cec-client did not report readiness within %s seconds.', CEC_READY_TIMEOUT)
+            self.ready.set()
+
+    async def _read_output(self):
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                LOGGER.error('cec-client exited with status %s.', await self.process.wait())
+                self.ready.clear()
+                return
+            if CEC_READY_MARKER in line.decode('ascii', 'replace'):
+                self.ready.set()
+
+    async def ensure_started(self):
+        async with self._starting:
+            if self.process is None or self.process.returncode is not None:
+                await self.start()
+
+    async def send(self, text):
+        await self.ensure_started()
+        await self.ready.wait()
+        self.process.stdin.write(text.encode('ascii'))
+        await self.process.stdin.drain()
+
+
+async def send_infrared_command(device, command):
+    process = await asyncio.create_subprocess_exec('irsend', 'SEND_ONCE', device, command)
+    status = await process.wait()
+    if status:
+        LOGGER.error('irsend exited with status %s sending %s to %s.', status, command, device)
+
+
+async def send_serial_command(port, baud, bytesize, timeout, inter_frame_gap, command):
+    key = (port, baud, bytesize, timeout, inter_frame_gap,)
+    try:
+        ser = SERIAL_CONNECTIONS[key]
+    except KeyError:
+        ser = SERIAL_CONNECTIONS[key] = AsyncSerialPort(port, baud, bytesize, timeout)
+    await ser.write(decode_frame(command))
+    if inter_frame_gap:
+        await asyncio.sleep(inter_frame_gap)
+
+
+def get_cec_client():
+    global CEC_CLIENT
+    if CEC_CLIENT is None:
+        CEC_CLIENT = AsyncCecClient(shlex.split(settings.RIKER_CEC_CLIENT))
+    return CEC_CLIENT
+
+
+def release_serial_port(port, baud, bytesize, timeout, inter_frame_gap):
+    """
+    Close the port of a serial configuration that no device uses any more,
+    after the write in progress.
+    """
+    connection = SERIAL_CONNECTIONS.pop((port, baud, bytesize, timeout, inter_frame_gap,), None)
+    if connection is not None:
+        asyncio.ensure_future(connection.close(), loop=connection.loop)
+
+
+async def send_cec_command(source, sink, command):
+    full_command = 'tx {source}{sink}:44:{command} \n tx {source}{sink}:45 \n'.format(
+        source=source,
+        sink=sink,
+        command=command
+    )
+    await get_cec_client().send(full_command)
+
+
+class AsyncTcpConnection(object):
+    """
+    A long-lived connection to one TCP device, used by one send at a time,
+    with the connect and write timeouts and the connect backoff of
+    TcpConnectionPool. Everything the peer sends is read as it arrives, so
+    its buffer never fills; a line is only used to acknowledge the frame
+    being sent, and is dropped otherwise.
+    """
+
+    def __init__(self, address, connect_timeout=2.0, write_timeout=2.0, backoff_initial=0.5, backoff_max=30.0):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.write_timeout = write_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.lock = asyncio.Lock()
+        self.writer = None
+        self.failures = 0
+        self.retry_at = 0
+        self._reading = None
+        self._ack = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if now < self.retry_at:
+            raise TcpUnavailable(
+                'Not reconnecting to {}:{} for another {:.1f} seconds.'.format(
+                    self.address[0],
+                    self.address[1],
+                    self.retry_at - now,
+                )
+            )
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as error:
+            self.failures += 1
+            self.retry_at = now + min(self.backoff_initial * 2 ** (self.failures - 1), self.backoff_max)
+            if isinstance(error, asyncio.TimeoutError):
+                raise TimeoutError('Timed out connecting to {}:{}.'.format(*self.address))
+            raise
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in KEEPALIVE_OPTIONS:
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        self.writer = writer
+        self.failures = 0
+        self.retry_at = 0
+        self._reading = loop.create_task(self.read_responses(reader, writer))
+        LOGGER.info('Connected to %s:%s.', *self.address)
+
+    async def read_responses(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.rstrip(b'\r\n').decode('ascii', 'replace')
+                log_event(LOGGER, DEBUG, 'tcp.response', host=self.address[0], port=self.address[1], line=line)
+                if self._ack is not None:
+                    ack_pattern, acknowledged = self._ack
+                    if not acknowledged.done() and ack_pattern.search(line):
+                        acknowledged.set_result(True)
+        except (OSError, ValueError):
+            pass
+        if self.writer is writer:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self._reading is not None:
+            if self._reading is not asyncio.Task.current_task():
+                self._reading.cancel()
+            self._reading = None
+        if self._ack is not None and not self._ack[1].done():
+            self._ack[1].set_exception(ConnectionResetError('{}:{} closed the connection.'.format(*self.address)))
+
+    async def _write(self, data):
+        if self.writer is None:
+            raise ConnectionResetError('{}:{} closed the connection.'.format(*self.address))
+        self.writer.write(data)
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.write_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Timed out writing to {}:{}.'.format(*self.address))
+
+    async def write(self, data):
+        reconnected = not self.connected
+        if reconnected:
+            await self.connect()
+        try:
+            await self._write(data)
+        except OSError:
+            self.close()
+            if reconnected:
+                raise
+            LOGGER.info('Connection to %s:%s failed; reconnecting once.', *self.address)
+            await self.connect()
+            try:
+                await self._write(data)
+            except OSError:
+                self.close()
+                raise
+
+    async def send(self, frames, ack_pattern=None, ack_timeout=1.0):
+        """
+        Like TcpConnectionPool.send(): the frames go out in one write, or
+        with ``ack_pattern`` one at a time, each waiting up to
+        ``ack_timeout`` seconds for a matching response line.
+        """
+        async with self.lock:
+            if ack_pattern is None:
+                await self.write(b''.join(frames))
+                return
+            for frame in frames:
+                acknowledged = asyncio.get_event_loop().create_future()
+                self._ack = (ack_pattern, acknowledged)
+                try:
+                    await self.write(frame)
+                    await asyncio.wait_for(acknowledged, ack_timeout)
+                except asyncio.TimeoutError:
+                    LOGGER.warning(
+                        '%s:%s did not acknowledge %r within %.1fs.', self.address[0], self.address[1], frame, ack_timeout
+                    )
+                finally:
+                    self._ack = None
+                    if acknowledged.done() and not acknowledged.cancelled():
+                        # Retrieved, so that a close() mid-write isn't logged
+                        # as an unhandled exception.
+                        acknowledged.exception()
+
+
+def get_tcp_connection(host, port):
+    try:
+        return TCP_CONNECTIONS[(host, port)]
+    except KeyError:
+        return TCP_CONNECTIONS.setdefault((host, port), AsyncTcpConnection(
+            (host, port),
+            connect_timeout=settings.RIKER_TCP_CONNECT_TIMEOUT,
+            write_timeout=settings.RIKER_TCP_WRITE_TIMEOUT,
+            backoff_max=settings.RIKER_TCP_BACKOFF_MAX,
+        ))
+
+
+def close_tcp_connections():
+    for connection in TCP_CONNECTIONS.values():
+        connection.close()
+    TCP_CONNECTIONS.clear()
+
+
+async def send_tcp_command(host, port, command, ack_pattern=None, ack_timeout=1.0):
+    await get_tcp_connection(host, port).send(encode_commands(command), ack_pattern, ack_timeout)
+
+
+async def prewarm_tcp(addresses):
+    """
+    Connect to every (host, port) in ``addresses`` ahead of its first
+    command. Hosts that can't be reached are logged and left for
+    send_tcp_command() to retry.
+    """
+    async def connect(host, port):
+        connection = get_tcp_connection(host, port)
+        async with connection.lock:
+            if connection.connected:
+                return
+            try:
+                await connection.connect()
+            except OSError as error:
+                LOGGER.warning('Could not connect to %s:%s ahead of time: %s', host, port, error)
+
+    await asyncio.gather(*(connect(host, port) for host, port in addresses))
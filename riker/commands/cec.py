@@ -0,0 +1,202 @@
+import re
+from collections import deque
+from logging import getLogger
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+from threading import Condition, Event, Lock, Thread
+from time import monotonic
+
+LOGGER = getLogger(__name__)
+
+# cec-client prints this once it has opened the adapter and accepts commands.
+READY_MARKER = 'waiting for input'
+
+# At log level 8 (traffic), every frame cec-client puts on the bus is echoed as
+# "TRAFFIC: [ <ms>]\t<< 10:44:01".
+ACK_PATTERN = re.compile(r'<<\s+([0-9a-f]{2}(?::[0-9a-f]{2})*)', re.IGNORECASE)
+
+# The answer to "pow <address>", e.g. "power status: standby".
+POWER_STATUS_PATTERN = re.compile(r'power status:\s*\S+')
+
+
+class CecUnavailable(ConnectionError):
+    pass
+
+
+class CecSession(object):
+    """
+    Keeps one cec-client process running and talks to it frame by frame.
+
+    Readiness and acknowledgements are read from cec-client's output rather
+    than assumed after a fixed sleep. Up to ``window`` frames may be in flight
+    without an acknowledgement; a frame that isn't acknowledged within
+    ``ack_timeout`` seconds gives up its slot. If cec-client exits, it is
+    restarted with exponential backoff.
+    """
+
+    def __init__(self, command=('cec-client', '-d', '8'), ready_timeout=30.0, ack_timeout=1.0,
+                 window=4, restart_backoff=1.0, restart_backoff_max=60.0):
+        self.command = list(command)
+        self.ready_timeout = ready_timeout
+        self.ack_timeout = ack_timeout
+        self.window = window
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+        self.process = None
+        self.restarts = 0
+        self.ready = Event()
+        self.in_flight = deque()
+        self.waiters = []
+        self._flow = Condition()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._failures = 0
+
+    def start(self):
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self._stopped.clear()
+                self._spawn()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            process, self.process = self.process, None
+        if process is not None and process.poll() is None:
+            try:
+                process.stdin.write('q\n')
+                process.stdin.flush()
+            except OSError:
+                pass
+            try:
+                process.wait(5)
+            except TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def _spawn(self):
+        self.ready.clear()
+        self.process = Popen(
+            self.command,
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=STDOUT,
+            bufsize=1,
+            universal_newlines=True,
+        )
+        Thread(target=self._read_output, args=(self.process,), name='riker-cec-reader', daemon=True).start()
+
+    def _read_output(self, process):
+        for line in process.stdout:
+            if not self.ready.is_set() and READY_MARKER in line:
+                LOGGER.info('cec-client is ready.')
+                self._failures = 0
+                self.ready.set()
+                continue
+            match = ACK_PATTERN.search(line)
+            if match:
+                self._acknowledge(match.group(1).lower())
+            elif self.waiters:
+                self._answer(line)
+        status = process.wait()
+        with self._flow:
+            self.in_flight.clear()
+            self._flow.notify_all()
+        if self._stopped.is_set() or process is not self.process:
+            return
+        self.ready.clear()
+        self._failures += 1
+        delay = min(self.restart_backoff * 2 ** (self._failures - 1), self.restart_backoff_max)
+        LOGGER.error('cec-client exited with status %s; restarting in %.1f seconds.', status, delay)
+        if self._stopped.wait(delay):
+            return
+        with self._lock:
+            if process is self.process:
+                self.restarts += 1
+                self._spawn()
+
+    def _acknowledge(self, frame):
+        with self._flow:
+            for index, (pending, _) in enumerate(self.in_flight):
+                if pending == frame:
+                    del self.in_flight[index]
+                    self._flow.notify_all()
+                    return
+
+    def _answer(self, line):
+        with self._flow:
+            for waiter in self.waiters:
+                match = waiter['pattern'].search(line)
+                if match and waiter['answer'] is None:
+                    waiter['answer'] = match.group(0)
+                    self._flow.notify_all()
+
+    def _wait_for_slot(self):
+        while len(self.in_flight) >= self.window:
+            frame, deadline = self.in_flight[0]
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                LOGGER.warning('cec-client did not acknowledge %s.', frame)
+                self.in_flight.popleft()
+            else:
+                self._flow.wait(remaining)
+
+    def send_frames(self, frames):
+        if self.process is None:
+            self.start()
+        if not self.ready.wait(self.ready_timeout):
+            raise CecUnavailable('cec-client is not ready.')
+        with self._flow:
+            for frame in frames:
+                self._wait_for_slot()
+                try:
+                    self.process.stdin.write('tx {}\n'.format(frame))
+                    self.process.stdin.flush()
+                except (OSError, ValueError, AttributeError) as error:
+                    raise CecUnavailable('Could not write to cec-client: {}'.format(error))
+                self.in_flight.append((frame.lower(), monotonic() + self.ack_timeout))
+
+    def query(self, command, pattern, timeout):
+        """
+        Write a cec-client command such as "pow 0" and return the first
+        part of its output that matches ``pattern``, or None after
+        ``timeout`` seconds.
+        """
+        if self.process is None:
+            self.start()
+        if not self.ready.wait(self.ready_timeout):
+            raise CecUnavailable('cec-client is not ready.')
+        waiter = {'pattern': pattern, 'answer': None}
+        deadline = monotonic() + timeout
+        with self._flow:
+            self.waiters.append(waiter)
+            try:
+                try:
+                    self.process.stdin.write('{}\n'.format(command))
+                    self.process.stdin.flush()
+                except (OSError, ValueError, AttributeError) as error:
+                    raise CecUnavailable('Could not write to cec-client: {}'.format(error))
+                while waiter['answer'] is None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._flow.wait(remaining)
+                return waiter['answer']
+            finally:
+                self.waiters.remove(waiter)
+
+    def wait_for_acks(self, timeout=None):
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._flow:
+            while self.in_flight:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._flow.wait(remaining)
+        return True
+
+    def send_key(self, source, sink, command):
+        address = '{}{}'.format(source, sink)
+        self.send_frames([
+            '{}:44:{}'.format(address, command),
+            '{}:45'.format(address),
+        ])
@@ -0,0 +1,140 @@
+import binascii
+from concurrent.futures import Future
+from logging import getLogger
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import sleep
+
+import serial
+
+LOGGER = getLogger(__name__)
+
+_STOP = object()
+
+
+class SerialQueueFull(RuntimeError):
+    pass
+
+
+def decode_frame(command):
+    """
+    Serial commands are stored as hex strings; decode them once, up front.
+    """
+    if isinstance(command, bytes):
+        return command
+    return binascii.unhexlify(command)
+
+
+class SerialPortWriter(Thread):
+    """
+    Owns one serial port and writes queued frames to it on its own thread.
+
+    Frames that are queued back to back are merged into a single write unless
+    the device needs ``inter_frame_gap`` seconds between frames. Each frame's
+    Future reports the write's outcome; failures are also logged, and the port
+    is reopened for the next frame. A frame submitted with ``read=True`` ends
+    its batch, and its Future's result is the device's reply instead.
+    """
+
+    def __init__(self, port, baud, bytesize, timeout, inter_frame_gap=0, queue_depth=32):
+        self.port = port
+        self.baud = baud
+        self.bytesize = bytesize
+        self.timeout = timeout
+        self.inter_frame_gap = inter_frame_gap
+        self.queue = Queue(maxsize=queue_depth)
+        self.serial = None
+        super(SerialPortWriter, self).__init__(name='riker-serial-{}'.format(port), daemon=True)
+
+    def submit(self, frame, read=False):
+        future = Future()
+        try:
+            self.queue.put_nowait((frame, future, read))
+        except Full:
+            raise SerialQueueFull('Write queue for serial port {} is full.'.format(self.port))
+        return future
+
+    def stop(self):
+        self.queue.put(_STOP)
+        self.join()
+
+    def open(self):
+        self.serial = serial.Serial(
+            self.port,
+            baudrate=self.baud,
+            bytesize=self.bytesize,
+            timeout=self.timeout,
+            write_timeout=self.timeout,
+        )
+
+    def close(self):
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except serial.SerialException:
+                pass
+            self.serial = None
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        if self.inter_frame_gap or batch[0] is _STOP or batch[0][2]:
+            return batch
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Empty:
+                return batch
+            batch.append(job)
+            if job is _STOP or job[2]:
+                return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            stopping = batch[-1] is _STOP
+            jobs = [job for job in batch if job is not _STOP]
+            if jobs:
+                self.write(jobs)
+            if stopping:
+                self.close()
+                return
+            if self.inter_frame_gap:
+                sleep(self.inter_frame_gap)
+
+    def write(self, jobs):
+        jobs = [job for job in jobs if job[1].set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        futures = [future for _, future, _ in jobs]
+        try:
+            if self.serial is None:
+                self.open()
+            data = b''.join(frame for frame, _, _ in jobs)
+            written = self.serial.write(data)
+            if written is not None and written < len(data):
+                raise serial.SerialTimeoutException(
+                    'Wrote {} of {} bytes to {}.'.format(written, len(data), self.port)
+                )
+            self.serial.flush()
+            reply = self.read_reply() if jobs[-1][2] else None
+        except (serial.SerialException, OSError) as error:
+            LOGGER.error('Writing %d frame(s) to serial port %s failed: %s', len(jobs), self.port, error)
+            self.close()
+            for future in futures:
+                future.set_exception(error)
+        else:
+            for future in futures[:-1]:
+                future.set_result(len(data))
+            futures[-1].set_result(len(data) if reply is None else reply)
+
+    def read_reply(self):
+        """
+        Wait up to the port's timeout for the device to answer, then read
+        until it stops sending.
+        """
+        reply = self.serial.read(1)
+        waiting = self.serial.in_waiting if reply else 0
+        while waiting:
+            reply += self.serial.read(waiting)
+            waiting = self.serial.in_waiting
+        return reply
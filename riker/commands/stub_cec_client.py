@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+A stand-in for cec-client that needs no CEC adapter.
+
+It prints a ready marker after STUB_CEC_READY_DELAY seconds and echoes every
+"tx" frame back as a traffic line, like cec-client does at log level 8, and
+answers "pow" with STUB_CEC_POWER_STATUS. If STUB_CEC_EXIT_AFTER is set, it
+exits with status 1 after that many frames.
+"""
+import os
+import sys
+import time
+
+
+def main():
+    ready_delay = float(os.getenv('STUB_CEC_READY_DELAY', '0.1'))
+    exit_after = int(os.getenv('STUB_CEC_EXIT_AFTER', '0'))
+    power_status = os.getenv('STUB_CEC_POWER_STATUS', 'on')
+    started = time.time()
+    print('opening a connection to the CEC adapter...', flush=True)
+    time.sleep(ready_delay)
+    print('waiting for input', flush=True)
+    frames = 0
+    for line in sys.stdin:
+        line = line.strip()
+        if line == 'q':
+            return 0
+        if line.startswith('pow '):
+            print('power status: {}'.format(power_status), flush=True)
+            continue
+        if not line.startswith('tx '):
+            continue
+        frames += 1
+        elapsed = int((time.time() - started) * 1000)
+        print('TRAFFIC: [{:8d}]\t<< {}'.format(elapsed, line[3:].strip().lower()), flush=True)
+        if exit_after and frames >= exit_after:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
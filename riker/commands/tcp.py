@@ -0,0 +1,272 @@
+import select
+import socket
+from logging import DEBUG, getLogger
+from threading import Lock, Thread
+from time import monotonic
+
+from riker.logutils import log_event
+
+LOGGER = getLogger(__name__)
+
+KEEPALIVE_OPTIONS = [
+    ('TCP_KEEPIDLE', 10),
+    ('TCP_KEEPINTVL', 5),
+    ('TCP_KEEPCNT', 3),
+]
+
+
+def encode_command(command):
+    """
+    TCP commands are stored as text and sent as CRLF-terminated ASCII.
+    """
+    if isinstance(command, bytes):
+        return command
+    return (command + '\r\n').encode('ascii')
+
+
+def encode_commands(commands):
+    """
+    The frames for one command or a list of commands.
+    """
+    if isinstance(commands, (list, tuple)):
+        return [encode_command(command) for command in commands]
+    return [encode_command(commands)]
+
+
+class TcpUnavailable(ConnectionError):
+    pass
+
+
+class PooledConnection(object):
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.lock = Lock()
+        self.buffer = b''
+        self.last_used = 0
+        self.failures = 0
+        self.retry_at = 0
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        self.buffer = b''
+
+
+class TcpConnectionPool(object):
+    """
+    Long-lived TCP connections keyed by (host, port).
+
+    Connections use SO_KEEPALIVE and bounded connect and write timeouts. A
+    connection that has been idle for longer than ``idle_probe`` seconds is
+    checked before reuse, so a peer that went away is noticed before the write
+    rather than after it. Failed connects back off exponentially, and sends
+    during the backoff window fail immediately instead of hanging the caller.
+
+    Lines the peer sends back are read without blocking whenever a connection
+    is used, and passed to every callable in ``response_handlers`` as
+    ``(host, port, line)``.
+    """
+
+    def __init__(self, connect_timeout=2.0, write_timeout=2.0, idle_probe=30.0,
+                 backoff_initial=0.5, backoff_max=30.0):
+        self.connect_timeout = connect_timeout
+        self.write_timeout = write_timeout
+        self.idle_probe = idle_probe
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.connections = {}
+        self.response_handlers = []
+        self._lock = Lock()
+
+    def get(self, host, port):
+        address = (host, port)
+        try:
+            return self.connections[address]
+        except KeyError:
+            with self._lock:
+                return self.connections.setdefault(address, PooledConnection(address))
+
+    def connect(self, connection):
+        now = monotonic()
+        if now < connection.retry_at:
+            raise TcpUnavailable(
+                'Not reconnecting to {}:{} for another {:.1f} seconds.'.format(
+                    connection.address[0],
+                    connection.address[1],
+                    connection.retry_at - now,
+                )
+            )
+        try:
+            sock = socket.create_connection(connection.address, timeout=self.connect_timeout)
+        except OSError:
+            connection.failures += 1
+            connection.retry_at = now + min(
+                self.backoff_initial * 2 ** (connection.failures - 1),
+                self.backoff_max,
+            )
+            raise
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in KEEPALIVE_OPTIONS:
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.write_timeout)
+        connection.sock = sock
+        connection.failures = 0
+        connection.retry_at = 0
+        connection.last_used = monotonic()
+        LOGGER.info('Connected to %s:%s.', *connection.address)
+
+    def read_responses(self, connection, timeout=0):
+        """
+        Read whatever the peer has sent, waiting at most ``timeout`` seconds
+        for the first bytes, and return the complete lines. Raises
+        ConnectionResetError if the peer closed the connection.
+        """
+        data = b''
+        while select.select([connection.sock], [], [], timeout)[0]:
+            chunk = connection.sock.recv(4096, socket.MSG_DONTWAIT)
+            if not chunk:
+                raise ConnectionResetError('{}:{} closed the connection.'.format(*connection.address))
+            data += chunk
+            timeout = 0
+        if not data:
+            return []
+        lines = (connection.buffer + data).split(b'\n')
+        connection.buffer = lines.pop()
+        lines = [line.rstrip(b'\r').decode('ascii', 'replace') for line in lines]
+        for line in lines:
+            log_event(LOGGER, DEBUG, 'tcp.response', host=connection.address[0], port=connection.address[1], line=line)
+            for handler in self.response_handlers:
+                try:
+                    handler(connection.address[0], connection.address[1], line)
+                except Exception:
+                    LOGGER.exception('Response handler failed for %r from %s:%s.', line, *connection.address)
+        return lines
+
+    def is_healthy(self, connection):
+        """
+        A socket that is readable but returns no data has been closed by the
+        peer. Anything else it has sent is passed to the response handlers.
+        """
+        try:
+            self.read_responses(connection)
+        except OSError:
+            return False
+        return True
+
+    def wait_for_ack(self, connection, ack_pattern, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            lines = self.read_responses(connection, remaining)
+            if any(ack_pattern.search(line) for line in lines):
+                return True
+
+    def query(self, host, port, data, timeout):
+        """
+        Send ``data`` and return the response lines that arrive within
+        ``timeout`` seconds; stops at the first read that completes a line.
+        """
+        connection = self.get(host, port)
+        with connection.lock:
+            self.write(connection, data)
+            deadline = monotonic() + timeout
+            try:
+                while True:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return []
+                    lines = self.read_responses(connection, remaining)
+                    if lines:
+                        return lines
+            except OSError:
+                connection.close()
+                raise
+            finally:
+                connection.last_used = monotonic()
+
+    def write(self, connection, data):
+        reconnected = connection.sock is None
+        if reconnected:
+            self.connect(connection)
+        try:
+            connection.sock.sendall(data)
+        except OSError:
+            connection.close()
+            if reconnected:
+                raise
+            LOGGER.info('Connection to %s:%s failed; reconnecting once.', *connection.address)
+            self.connect(connection)
+            try:
+                connection.sock.sendall(data)
+            except OSError:
+                connection.close()
+                raise
+
+    def send(self, host, port, data, ack_pattern=None, ack_timeout=1.0):
+        """
+        Send ``data``, one frame or a list of frames. Without ``ack_pattern``
+        the frames go out in a single sendall(); with it, one at a time, each
+        waiting up to ``ack_timeout`` seconds for a response line that matches
+        the compiled pattern before the next is sent.
+        """
+        frames = data if isinstance(data, list) else [data]
+        connection = self.get(host, port)
+        with connection.lock:
+            if connection.sock is not None and monotonic() - connection.last_used > self.idle_probe:
+                if not self.is_healthy(connection):
+                    LOGGER.info('Connection to %s:%s went away while idle.', host, port)
+                    connection.close()
+            if ack_pattern is None:
+                self.write(connection, b''.join(frames))
+                if not self.is_healthy(connection):
+                    connection.close()
+            else:
+                for frame in frames:
+                    self.write(connection, frame)
+                    try:
+                        acknowledged = self.wait_for_ack(connection, ack_pattern, ack_timeout)
+                    except OSError:
+                        connection.close()
+                        raise
+                    if not acknowledged:
+                        LOGGER.warning('%s:%s did not acknowledge %r within %.1fs.', host, port, frame, ack_timeout)
+            connection.last_used = monotonic()
+
+    def prewarm(self, addresses):
+        """
+        Connect to every (host, port) in the background, so the first command
+        for each doesn't pay for the handshake.
+        """
+        def warm(host, port):
+            connection = self.get(host, port)
+            with connection.lock:
+                if connection.sock is None:
+                    try:
+                        self.connect(connection)
+                    except OSError as error:
+                        LOGGER.warning('Could not pre-connect to %s:%s: %s', host, port, error)
+
+        threads = [
+            Thread(target=warm, args=address, name='riker-tcp-prewarm', daemon=True)
+            for address in set(addresses)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def close(self):
+        with self._lock:
+            connections, self.connections = self.connections, {}
+        for connection in connections.values():
+            with connection.lock:
+                connection.close()
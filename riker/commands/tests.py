@@ -0,0 +1,340 @@
+import asyncio
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from unittest import mock
+
+import serial
+
+from django.test import SimpleTestCase
+
+import commands.utils
+from commands import aio
+from commands.cec import POWER_STATUS_PATTERN, CecSession
+from commands.serialport import SerialPortWriter, decode_frame
+from commands.tcp import TcpConnectionPool, TcpUnavailable
+
+
+class LoopbackServer(object):
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def accept(self):
+        conn, _ = self.listener.accept()
+        conn.settimeout(5)
+        return conn
+
+    def close(self):
+        self.listener.close()
+
+
+class TcpConnectionPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = LoopbackServer()
+        self.addCleanup(self.server.close)
+        self.pool = TcpConnectionPool(idle_probe=0, backoff_initial=60)
+        self.addCleanup(self.pool.close)
+
+    def test_reuses_connection(self):
+        self.pool.send('127.0.0.1', self.server.port, b'VU\r\n')
+        conn = self.server.accept()
+        self.addCleanup(conn.close)
+        self.pool.send('127.0.0.1', self.server.port, b'VD\r\n')
+        received = b''
+        while len(received) < 8:
+            received += conn.recv(8)
+        self.assertEqual(received, b'VU\r\nVD\r\n')
+        sock = self.pool.get('127.0.0.1', self.server.port).sock
+        self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+
+    def test_reconnects_when_peer_closed_while_idle(self):
+        self.pool.send('127.0.0.1', self.server.port, b'VU\r\n')
+        first = self.server.accept()
+        first.recv(8)
+        first.close()
+        self.pool.send('127.0.0.1', self.server.port, b'VD\r\n')
+        second = self.server.accept()
+        self.addCleanup(second.close)
+        self.assertEqual(second.recv(8), b'VD\r\n')
+
+    def test_backs_off_after_failed_connect(self):
+        port = self.server.port
+        self.server.close()
+        with self.assertRaises(ConnectionRefusedError):
+            self.pool.send('127.0.0.1', port, b'VU\r\n')
+        with self.assertRaises(TcpUnavailable):
+            self.pool.send('127.0.0.1', port, b'VU\r\n')
+
+    def test_batch_is_one_write_and_responses_are_read(self):
+        responses = []
+        self.pool.response_handlers.append(lambda host, port, line: responses.append(line))
+        self.pool.send('127.0.0.1', self.server.port, [b'PWR?\r\n', b'VOL?\r\n'])
+        conn = self.server.accept()
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.recv(64), b'PWR?\r\nVOL?\r\n')
+        conn.sendall(b'PWR0\r\nVOL05')
+        conn.sendall(b'0\r\n')
+        time.sleep(0.05)
+        self.pool.send('127.0.0.1', self.server.port, b'MUT?\r\n')
+        self.assertEqual(responses, ['PWR0', 'VOL050'])
+
+    def test_waits_for_ack_per_command(self):
+        def serve():
+            conn = self.server.accept()
+            self.addCleanup(conn.close)
+            for _ in range(2):
+                conn.recv(64)
+                time.sleep(0.05)
+                conn.sendall(b'R\r\n')
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        start = time.monotonic()
+        self.pool.send('127.0.0.1', self.server.port, [b'PO\r\n', b'FN19\r\n'], re.compile('^R$'), 2.0)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertLess(time.monotonic() - start, 2.0)
+
+    def test_prewarm(self):
+        for thread in self.pool.prewarm([('127.0.0.1', self.server.port)]):
+            thread.join()
+        conn = self.server.accept()
+        self.addCleanup(conn.close)
+        self.assertIsNotNone(self.pool.get('127.0.0.1', self.server.port).sock)
+
+
+class AsyncTransportTests(SimpleTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(aio.close_tcp_connections)
+
+    def start_server(self, handle):
+        server = self.loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', 0))
+
+        def close():
+            aio.close_tcp_connections()
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+
+        self.addCleanup(close)
+        return server.sockets[0].getsockname()[1]
+
+    def test_concurrent_sends_share_one_connection(self):
+        received = []
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                received.append(line)
+                # Chatter the sender never asks for, ahead of the ack.
+                writer.write(b'NOISE\r\n' * 100 + b'OK\r\n')
+
+        port = self.start_server(handle)
+        ack = re.compile('^OK$')
+        self.loop.run_until_complete(asyncio.wait_for(asyncio.gather(*(
+            aio.send_tcp_command('127.0.0.1', port, ['A{}'.format(n), 'B{}'.format(n)], ack_pattern=ack)
+            for n in range(3)
+        )), 5))
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(len(received), 6)
+
+    def test_failed_connects_back_off(self):
+        with self.assertRaises(ConnectionRefusedError):
+            self.loop.run_until_complete(aio.send_tcp_command('127.0.0.1', 1, 'VU'))
+        with self.assertRaises(TcpUnavailable):
+            self.loop.run_until_complete(aio.send_tcp_command('127.0.0.1', 1, 'VU'))
+
+    def test_tcp_commands_reuse_connection(self):
+        received = []
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                received.append(line)
+
+        port = self.start_server(handle)
+
+        async def send():
+            await aio.send_tcp_command('127.0.0.1', port, 'VU')
+            await aio.send_tcp_command('127.0.0.1', port, 'VD')
+            while len(received) < 2:
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(asyncio.wait_for(send(), 5))
+        self.assertEqual(received, [b'VU\r\n', b'VD\r\n'])
+        self.assertEqual(len(connections), 1)
+
+    def test_prewarmed_connection_is_used(self):
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            await reader.read()
+
+        port = self.start_server(handle)
+        self.loop.run_until_complete(asyncio.wait_for(aio.prewarm_tcp({('127.0.0.1', port)}), 5))
+        self.assertIn(('127.0.0.1', port), aio.TCP_CONNECTIONS)
+        with self.assertLogs('commands.aio', 'WARNING'):
+            self.loop.run_until_complete(asyncio.wait_for(aio.prewarm_tcp({('127.0.0.1', 1)}), 5))
+        self.loop.run_until_complete(asyncio.wait_for(aio.send_tcp_command('127.0.0.1', port, 'VU'), 5))
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(len(connections), 1)
+
+
+STUB_CEC_CLIENT = [sys.executable, os.path.join(os.path.dirname(__file__), 'stub_cec_client.py')]
+
+
+class AsyncCecClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        patcher = mock.patch('commands.aio.CEC_CLIENT', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_client_is_started_from_settings(self):
+        with self.settings(RIKER_CEC_CLIENT=' '.join(STUB_CEC_CLIENT + ['-d', '8'])):
+            client = aio.get_cec_client()
+        self.assertEqual(client.command, STUB_CEC_CLIENT + ['-d', '8'])
+        self.loop.run_until_complete(asyncio.wait_for(client.ensure_started(), 5))
+        self.assertTrue(client.ready.is_set())
+        client.process.kill()
+        self.loop.run_until_complete(client.process.wait())
+
+
+class CecSessionTests(SimpleTestCase):
+
+    def create_session(self, **kwargs):
+        session = CecSession(command=STUB_CEC_CLIENT, restart_backoff=0.01, **kwargs)
+        self.addCleanup(session.stop)
+        return session
+
+    def test_frames_are_acknowledged(self):
+        session = self.create_session(window=2)
+        session.start()
+        self.assertTrue(session.ready.wait(5))
+        for command in ['01', '02', '03']:
+            session.send_key(1, 0, command)
+        self.assertTrue(session.wait_for_acks(5))
+
+    @mock.patch.dict(os.environ, {'STUB_CEC_POWER_STATUS': 'standby'})
+    def test_power_status_query(self):
+        session = self.create_session()
+        self.assertEqual(session.query('pow 0', POWER_STATUS_PATTERN, 5), 'power status: standby')
+        self.assertEqual(session.waiters, [])
+
+    def test_unacknowledged_frames_give_up_their_slot(self):
+        session = self.create_session(window=1, ack_timeout=0.05)
+        with mock.patch.object(session, '_acknowledge'):
+            session.send_key(1, 0, '01')
+            self.assertEqual(len(session.in_flight), 1)
+
+    @mock.patch.dict(os.environ, {'STUB_CEC_EXIT_AFTER': '2'})
+    def test_restarts_after_crash(self):
+        session = self.create_session()
+        session.send_key(1, 0, '01')
+        first = session.process
+        first.wait(5)
+        deadline = time.time() + 5
+        while session.process is first and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(session.restarts, 1)
+        session.send_key(1, 0, '02')
+        self.assertTrue(session.wait_for_acks(5))
+
+
+class SerialPortWriterTests(SimpleTestCase):
+
+    def create_writer(self, **kwargs):
+        writer = SerialPortWriter('/dev/ttyFAKE', 9600, 8, 1, **kwargs)
+        patcher = mock.patch('commands.serialport.serial.Serial')
+        self.serial = patcher.start().return_value
+        self.serial.write.side_effect = len
+        self.addCleanup(patcher.stop)
+        return writer
+
+    def submit_all(self, writer, frames):
+        futures = [writer.submit(decode_frame(frame)) for frame in frames]
+        writer.start()
+        for future in futures:
+            future.result(5)
+        writer.stop()
+
+    def test_back_to_back_frames_are_merged(self):
+        writer = self.create_writer()
+        self.submit_all(writer, ['0822', '00', 'd6'])
+        self.serial.write.assert_called_once_with(b'\x08\x22\x00\xd6')
+
+    def test_inter_frame_gap(self):
+        writer = self.create_writer(inter_frame_gap=0.001)
+        self.submit_all(writer, ['0822', '00', 'd6'])
+        self.assertEqual(
+            [x[0][0] for x in self.serial.write.call_args_list],
+            [b'\x08\x22', b'\x00', b'\xd6'],
+        )
+
+    def test_errors_are_reported(self):
+        writer = self.create_writer()
+        self.serial.write.side_effect = serial.SerialTimeoutException('Write timeout')
+        future = writer.submit(b'\x00')
+        writer.start()
+        self.assertIsInstance(future.exception(5), serial.SerialTimeoutException)
+        self.serial.write.side_effect = len
+        writer.submit(b'\x01').result(5)
+        writer.stop()
+
+    def test_query_reads_reply(self):
+        writer = self.create_writer()
+        self.serial.read.side_effect = [b'\xa5', b'\x01']
+        type(self.serial).in_waiting = mock.PropertyMock(side_effect=[1, 0])
+        written = writer.submit(decode_frame('0822'))
+        reply = writer.submit(decode_frame('01'), read=True)
+        writer.start()
+        self.assertEqual(reply.result(5), b'\xa5\x01')
+        self.assertEqual(written.result(5), 3)
+        writer.stop()
+        self.serial.write.assert_called_once_with(b'\x08\x22\x01')
+
+    def test_release_stops_the_superseded_writer(self):
+        config = ('/dev/ttyFAKE', 9600, 8, 1, 0)
+        with mock.patch.dict('commands.utils.SERIAL_WRITERS', clear=True), \
+                mock.patch('commands.serialport.serial.Serial') as Serial:
+            Serial.return_value.write.side_effect = len
+            commands.utils.send_serial_command(*config + ('00',)).result(5)
+            writer = commands.utils.SERIAL_WRITERS[config]
+            commands.utils.release_serial_port(*config)
+            self.assertNotIn(config, commands.utils.SERIAL_WRITERS)
+        self.assertFalse(writer.is_alive())
+        Serial.return_value.close.assert_called_once_with()
+
+    def test_writes_to_pty(self):
+        master, slave = os.openpty()
+        self.addCleanup(os.close, master)
+        self.addCleanup(os.close, slave)
+        writer = SerialPortWriter(os.ttyname(slave), 9600, 8, 1)
+        writer.start()
+        writer.submit(decode_frame('082200')).result(5)
+        writer.stop()
+        self.assertEqual(os.read(master, 3), b'\x08\x22\x00')
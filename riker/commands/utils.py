@@ -1,62 +1,130 @@
 import binascii
-import socket
-from subprocess import Popen, PIPE, STDOUT
-from time import sleep
+import shlex
+from logging import getLogger
+from threading import Lock
 
-import serial
-from py_irsend import irsend
+from django.conf import settings
 
-SERIAL_CONNECTIONS = {}
+from commands.cec import POWER_STATUS_PATTERN, CecSession
+from commands.tcp import TcpConnectionPool, encode_command, encode_commands
 
-TCP_CONNECTIONS = {}
+LOGGER = getLogger(__name__)
 
-CEC_CLIENT = None
+SERIAL_WRITERS = {}
 
+SERIAL_WRITERS_LOCK = Lock()
 
+TCP_POOL = None
+
+CEC_SESSION = None
+
+
+# Transport libraries (py_irsend, pyserial) are imported by the functions that
+# use them, so a listener only loads the ones its devices need.
 def send_infrared_command(device, command):
+    from py_irsend import irsend
     irsend.send_once(device, [command])
 
 
-def send_serial_command(port, baud, bytesize, timeout, command):
+def get_serial_writer(port, baud, bytesize, timeout, inter_frame_gap):
+    from commands.serialport import SerialPortWriter
+    key = (port, baud, bytesize, timeout, inter_frame_gap,)
     try:
-        ser = SERIAL_CONNECTIONS.pop((port, baud, bytesize, timeout,))
+        return SERIAL_WRITERS[key]
     except KeyError:
-        ser = serial.Serial(port, baudrate=baud, bytesize=bytesize, timeout=timeout)
-    bytecommand = binascii.unhexlify(command)
-    ser.write(bytecommand)
-    SERIAL_CONNECTIONS[(port, baud, bytesize, timeout,)] = ser
+        pass
+    with SERIAL_WRITERS_LOCK:
+        if key not in SERIAL_WRITERS:
+            writer = SerialPortWriter(
+                port,
+                baud,
+                bytesize,
+                timeout,
+                inter_frame_gap=inter_frame_gap,
+                queue_depth=settings.RIKER_SERIAL_QUEUE_DEPTH,
+            )
+            writer.start()
+            SERIAL_WRITERS[key] = writer
+        return SERIAL_WRITERS[key]
+
+
+def release_serial_port(port, baud, bytesize, timeout, inter_frame_gap):
+    """
+    Stop the writer for a serial configuration that no device uses any more,
+    once it has written what is queued, and close its port.
+    """
+    with SERIAL_WRITERS_LOCK:
+        writer = SERIAL_WRITERS.pop((port, baud, bytesize, timeout, inter_frame_gap,), None)
+    if writer is not None:
+        writer.stop()
+
+
+def log_serial_failure(port, future):
+    error = future.exception()
+    if error is not None:
+        LOGGER.error('Serial command on port %s failed: %s', port, error)
+
+
+def send_serial_command(port, baud, bytesize, timeout, inter_frame_gap, command):
+    """
+    Queue ``command`` (a frame from decode_frame, or a hex string) for the
+    port's writer thread and return the write's Future.
+    """
+    from commands.serialport import decode_frame
+    writer = get_serial_writer(port, baud, bytesize, timeout, inter_frame_gap)
+    future = writer.submit(decode_frame(command))
+    future.add_done_callback(lambda done: log_serial_failure(port, done))
+    return future
+
+
+def query_serial_state(port, baud, bytesize, timeout, inter_frame_gap, command, response_timeout):
+    """
+    Send a status query frame and return the reply as a hex string.
+    """
+    from commands.serialport import decode_frame
+    writer = get_serial_writer(port, baud, bytesize, timeout, inter_frame_gap)
+    reply = writer.submit(decode_frame(command), read=True).result(response_timeout)
+    return [binascii.hexlify(reply).decode('ascii')] if reply else []
+
+
+def get_cec_session():
+    global CEC_SESSION
+    if CEC_SESSION is None:
+        CEC_SESSION = CecSession(
+            command=shlex.split(settings.RIKER_CEC_CLIENT),
+            ack_timeout=settings.RIKER_CEC_ACK_TIMEOUT,
+            window=settings.RIKER_CEC_WINDOW,
+        )
+    return CEC_SESSION
 
 
 def send_cec_command(source, sink, command):
-    global CEC_CLIENT
-    if CEC_CLIENT is None:
-        CEC_CLIENT = Popen(
-            ['cec-client'],
-            stdin=PIPE,
-            bufsize=1,
-            universal_newlines=True,
+    get_cec_session().send_key(source, sink, command)
+
+
+def query_cec_power(source, sink, command, timeout):
+    """
+    Ask the sink for its power status, e.g. "power status: on".
+    """
+    answer = get_cec_session().query('pow {}'.format(sink), POWER_STATUS_PATTERN, timeout)
+    return [] if answer is None else [answer]
+
+
+def get_tcp_pool():
+    global TCP_POOL
+    if TCP_POOL is None:
+        TCP_POOL = TcpConnectionPool(
+            connect_timeout=settings.RIKER_TCP_CONNECT_TIMEOUT,
+            write_timeout=settings.RIKER_TCP_WRITE_TIMEOUT,
+            idle_probe=settings.RIKER_TCP_IDLE_PROBE,
+            backoff_max=settings.RIKER_TCP_BACKOFF_MAX,
         )
-        sleep(15)  # Wait for cec-client to be ready to receive commands
-    full_command = 'tx {source}{sink}:44:{command} \n tx {source}{sink}:45 \n'.format(
-        source=source,
-        sink=sink,
-        command=command
-    )
-    CEC_CLIENT.stdin.write(full_command)
+    return TCP_POOL
 
 
-def send_tcp_command(host, port, command, retries=5):
-    encoded_command = (command + '\r\n').encode('ascii')
-    try:
-        conn = TCP_CONNECTIONS.pop((host, port,))
-    except KeyError:
-        conn = socket.socket()
-        conn.connect((host, port))
-    try:
-        conn.send(encoded_command)
-    except BrokenPipeError:
-        if retries:
-            return send_tcp_command(host, port, command, retries=retries-1)
-        else:
-            raise
-    TCP_CONNECTIONS[(host, port)] = conn
\ No newline at end of file
+def send_tcp_command(host, port, command, ack_pattern=None, ack_timeout=1.0):
+    get_tcp_pool().send(host, port, encode_commands(command), ack_pattern, ack_timeout)
+
+
+def query_tcp_state(host, port, command, timeout):
+    return get_tcp_pool().query(host, port, encode_command(command), timeout)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Start the listener without the web stack:
+
+    ./listen.py [lirc_listen options]
+    ./listen.py riker_supervise [riker_supervise options]
+
+Unlike manage.py, this loads riker.worker_settings and skips the system
+checks, which the web process runs anyway. `manage.py benchmark_startup`
+compares the two.
+"""
+import os
+import sys
+from importlib import import_module
+
+WORKER_COMMANDS = ('lirc_listen', 'riker_supervise')
+
+
+def main(argv):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'riker.worker_settings')
+    import django
+    django.setup()
+    from django.core.management.base import CommandError
+
+    if len(argv) > 1 and argv[1] in WORKER_COMMANDS:
+        name, args = argv[1], argv[2:]
+    else:
+        name, args = WORKER_COMMANDS[0], argv[1:]
+    command = import_module('worker.management.commands.{}'.format(name)).Command()
+    options = vars(command.create_parser(os.path.basename(argv[0]), name).parse_args(args))
+    try:
+        command.execute(*options.pop('args', ()), skip_checks=True, **options)
+    except CommandError as error:
+        command.stderr.write('{}: {}'.format(error.__class__.__name__, error))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
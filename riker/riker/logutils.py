@@ -0,0 +1,93 @@
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+
+
+class Event(object):
+    """
+    A log message made of an event name and fields. Nothing is rendered until
+    a handler formats the record, which BackgroundHandler does on its own
+    thread.
+    """
+
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        if not self.fields:
+            return self.name
+        return '{} {}'.format(
+            self.name,
+            ' '.join('{}={!r}'.format(key, value) for key, value in sorted(self.fields.items())),
+        )
+
+
+def log_event(logger, level, name, **fields):
+    """
+    Log event ``name`` with ``fields`` if ``logger`` is enabled for ``level``;
+    otherwise this costs one level check.
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, Event(name, fields))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record; an Event's fields become top-level keys.
+    """
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+        }
+        if isinstance(record.msg, Event):
+            data['event'] = record.msg.name
+            data.update((key, value if isinstance(value, (int, float, bool)) else str(value))
+                        for key, value in record.msg.fields.items())
+        else:
+            data['message'] = record.getMessage()
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, sort_keys=True)
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Hands records to a writer thread through a bounded queue, so that logging
+    never blocks the caller on I/O. Records are formatted on the writer
+    thread; when the queue is full they are dropped and counted.
+    """
+
+    def __init__(self, stream=None, queue_size=10000):
+        super(BackgroundHandler, self).__init__(Queue(maxsize=queue_size))
+        self.dropped = 0
+        self.target = logging.StreamHandler(stream)
+        self.listener = QueueListener(self.queue, self.target)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        super(BackgroundHandler, self).setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.target.close()
+        super(BackgroundHandler, self).close()
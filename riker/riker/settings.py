@@ -131,3 +131,162 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Riker worker
+
+# Write-behind persistence of StateSet.status; the journal holds state changes
+# that have not been written to the database yet.
+RIKER_STATE_JOURNAL = os.getenv('RIKER_STATE_JOURNAL', os.path.join(BASE_DIR, 'state.journal'))
+
+RIKER_STATE_FLUSH_INTERVAL = float(os.getenv('RIKER_STATE_FLUSH_INTERVAL', '0.5'))
+
+# 'plan' runs presses against the compiled dispatch plan; 'orm' runs
+# RemoteButton.execute() on each press, with the button's graph prefetched.
+RIKER_EXECUTION = os.getenv('RIKER_EXECUTION', 'plan')
+
+# 'net' applies one state per StateSet for each press, in one write;
+# 'sequential' applies every side effect in order.
+RIKER_SIDE_EFFECT_MODE = os.getenv('RIKER_SIDE_EFFECT_MODE', 'net')
+
+# Macros with delayed commands keep running in the background. 'supersede'
+# cancels a running macro when a later press sends to one of its devices;
+# 'concurrent' lets them overlap.
+RIKER_SEQUENCE_POLICY = os.getenv('RIKER_SEQUENCE_POLICY', 'supersede')
+
+# StateSets with a StateQuery are polled so that they follow the devices'
+# real state; each query waits at most RIKER_STATE_QUERY_TIMEOUT seconds.
+# `lirc_listen --asyncio` can't poll, so it won't start while there are state
+# queries unless this is off.
+RIKER_STATE_FEEDBACK = os.getenv('RIKER_STATE_FEEDBACK', 'true').lower() == 'true'
+
+RIKER_STATE_QUERY_TIMEOUT = float(os.getenv('RIKER_STATE_QUERY_TIMEOUT', '1'))
+
+
+# Commands are sent through one queue per device. When a queue is full the
+# policy is one of 'block' (wait up to the timeout, in seconds), 'drop_newest'
+# or 'drop_oldest'.
+RIKER_DEVICE_QUEUE_DEPTH = int(os.getenv('RIKER_DEVICE_QUEUE_DEPTH', '16'))
+
+RIKER_DEVICE_QUEUE_POLICY = os.getenv('RIKER_DEVICE_QUEUE_POLICY', 'block')
+
+RIKER_DEVICE_QUEUE_TIMEOUT = float(os.getenv('RIKER_DEVICE_QUEUE_TIMEOUT', '0.5'))
+
+
+# TCP connections are kept open with keepalive and probed before reuse after
+# being idle for RIKER_TCP_IDLE_PROBE seconds. Failed connects back off
+# exponentially up to RIKER_TCP_BACKOFF_MAX seconds.
+RIKER_TCP_CONNECT_TIMEOUT = float(os.getenv('RIKER_TCP_CONNECT_TIMEOUT', '2'))
+
+RIKER_TCP_WRITE_TIMEOUT = float(os.getenv('RIKER_TCP_WRITE_TIMEOUT', '2'))
+
+RIKER_TCP_IDLE_PROBE = float(os.getenv('RIKER_TCP_IDLE_PROBE', '30'))
+
+RIKER_TCP_BACKOFF_MAX = float(os.getenv('RIKER_TCP_BACKOFF_MAX', '30'))
+
+RIKER_TCP_PREWARM = os.getenv('RIKER_TCP_PREWARM', 'true').lower() == 'true'
+
+
+# cec-client is started with the listener and must run at log level 8 so that
+# transmitted frames can be acknowledged. At most RIKER_CEC_WINDOW frames are
+# sent ahead of their acknowledgements.
+RIKER_CEC_CLIENT = os.getenv('RIKER_CEC_CLIENT', 'cec-client -d 8')
+
+RIKER_CEC_ACK_TIMEOUT = float(os.getenv('RIKER_CEC_ACK_TIMEOUT', '1'))
+
+RIKER_CEC_WINDOW = int(os.getenv('RIKER_CEC_WINDOW', '4'))
+
+
+# Path of lircd's socket, used by `lirc_listen --backend lircd`.
+RIKER_LIRCD_SOCKET = os.getenv('RIKER_LIRCD_SOCKET', '/var/run/lirc/lircd')
+
+
+# Extra inputs for lirc_listen, all fed into the same queue as LIRC. Addresses
+# are "[host:]port" and empty to disable; evdev devices are comma-separated.
+RIKER_TCP_TRIGGER = os.getenv('RIKER_TCP_TRIGGER', '')
+
+RIKER_HTTP_TRIGGER = os.getenv('RIKER_HTTP_TRIGGER', '')
+
+RIKER_EVDEV_DEVICES = [x for x in os.getenv('RIKER_EVDEV_DEVICES', '').split(',') if x]
+
+
+# Bearer tokens for the button-press API served on RIKER_HTTP_TRIGGER
+# (comma-separated; the API won't start without one), and the longest a
+# request with ?wait may wait for its presses to be dispatched, in seconds.
+RIKER_API_TOKENS = [x for x in os.getenv('RIKER_API_TOKENS', '').split(',') if x]
+
+RIKER_API_WAIT_TIMEOUT = float(os.getenv('RIKER_API_WAIT_TIMEOUT', '5'))
+
+
+# Receivers run by riker_supervise, comma-separated, each "name=backend:path"
+# where backend is lircd (path is its socket), evdev (path is the device) or
+# lirc (python-lirc; no path). A crashed receiver is restarted after a delay
+# that doubles, up to the maximum, while it keeps crashing.
+RIKER_RECEIVERS = [x for x in os.getenv('RIKER_RECEIVERS', '').split(',') if x]
+
+RIKER_RECEIVER_RESTART_DELAY = float(os.getenv('RIKER_RECEIVER_RESTART_DELAY', '1'))
+
+RIKER_RECEIVER_MAX_RESTART_DELAY = float(os.getenv('RIKER_RECEIVER_MAX_RESTART_DELAY', '30'))
+
+
+# Admin changes are sent to the running listener as datagrams on this socket
+# so that it can reload without restarting.
+RIKER_NOTIFY_SOCKET = os.getenv('RIKER_NOTIFY_SOCKET', os.path.join(BASE_DIR, 'notify.sock'))
+
+
+# When set, the admin exports the configuration to this snapshot file on every
+# change, before notifying the listener, and the listener runs from the
+# snapshot instead of the database. Create the first one with
+# `manage.py export_snapshot`.
+RIKER_SNAPSHOT_FILE = os.getenv('RIKER_SNAPSHOT_FILE', '')
+
+
+# Each serial port has a writer thread with a queue of this many frames.
+RIKER_SERIAL_QUEUE_DEPTH = int(os.getenv('RIKER_SERIAL_QUEUE_DEPTH', '32'))
+
+
+# `manage.py benchmark_startup` fails when listen.py takes longer than
+# RIKER_STARTUP_TARGET seconds to import everything the listener needs.
+RIKER_STARTUP_TARGET = float(os.getenv('RIKER_STARTUP_TARGET', '1.0'))
+
+
+# The listener writes its latency histograms to RIKER_METRICS_FILE every
+# RIKER_METRICS_INTERVAL seconds for /metrics/ and `manage.py riker_metrics`.
+RIKER_METRICS_FILE = os.getenv('RIKER_METRICS_FILE', os.path.join(BASE_DIR, 'metrics.json'))
+
+RIKER_METRICS_INTERVAL = float(os.getenv('RIKER_METRICS_INTERVAL', '10'))
+
+
+# Riker's loggers write through a background thread; keypress events are
+# logged at DEBUG. RIKER_LOG_FORMAT is 'text' or 'json'.
+RIKER_LOG_LEVEL = os.getenv('RIKER_LOG_LEVEL', 'INFO')
+
+RIKER_LOG_FORMAT = os.getenv('RIKER_LOG_FORMAT', 'text')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'text': {
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+        'json': {
+            '()': 'riker.logutils.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'riker': {
+            'class': 'riker.logutils.BackgroundHandler',
+            'stream': 'ext://sys.stderr',
+            'formatter': RIKER_LOG_FORMAT,
+        },
+    },
+    'loggers': {
+        app: {
+            'handlers': ['riker'],
+            'level': RIKER_LOG_LEVEL,
+            'propagate': False,
+        }
+        for app in ('commands', 'systemstate', 'worker')
+    },
+}
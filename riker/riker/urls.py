@@ -16,6 +16,9 @@ Including another URLconf
 from django.conf.urls import url
 from django.contrib import admin
 
+from worker import views as worker_views
+
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^metrics/$', worker_views.metrics, name='metrics'),
 ]
@@ -0,0 +1,19 @@
+"""
+Settings for the listener started by listen.py: the ORM and the two Riker
+apps, without the admin, auth, sessions, static files or middleware the web
+interface needs. Everything else comes from riker.settings.
+"""
+
+from riker.settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'systemstate',
+    'worker',
+]
+
+MIDDLEWARE = []
+
+TEMPLATES = []
+
+# The listener doesn't render anything, so skip loading translations.
+USE_I18N = False
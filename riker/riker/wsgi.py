@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "riker.settings")
 
 application = get_wsgi_application()
+
+# This is the process the admin runs in, so it publishes configuration
+# changes to the listener.
+from systemstate.signals import publish_changes  # noqa: E402
+
+publish_changes()
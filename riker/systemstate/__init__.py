@@ -0,0 +1 @@
+default_app_config = 'systemstate.apps.SystemstateConfig'
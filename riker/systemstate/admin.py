@@ -6,6 +6,7 @@ from systemstate.models import (
     Condition,
     StateSet,
     State,
+    StateQuery,
     StateSideEffect,
     Device,
     IrsendConfig,
@@ -39,10 +40,14 @@ class ConditionAdmin(admin.ModelAdmin):
 class InlineStateAdmin(admin.StackedInline):
     model = State
 
+class InlineStateQueryAdmin(admin.StackedInline):
+    model = StateQuery
+
 @admin.register(StateSet)
 class StateSetAdmin(admin.ModelAdmin):
     inlines = [
         InlineStateAdmin,
+        InlineStateQueryAdmin,
     ]
 
 @admin.register(IrsendConfig)
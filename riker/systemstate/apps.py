@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class SystemstateConfig(AppConfig):
     name = 'systemstate'
+
+    def ready(self):
+        from systemstate.signals import connect_signals
+        connect_signals()
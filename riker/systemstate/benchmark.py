@@ -0,0 +1,304 @@
+import os
+import platform
+import socket
+import sys
+from collections import namedtuple
+from threading import Thread
+from time import perf_counter
+
+import django
+from django.db import connection
+
+import commands.utils
+import systemstate.models
+from commands.cec import CecSession
+from systemstate.dispatch import Dispatcher
+from systemstate.executor import InlineExecutor
+from systemstate.loader import execute_button
+from systemstate.metrics import Histogram, MetricsRegistry
+from systemstate.models import (
+    RemoteButton,
+    Command,
+    CommandSet,
+    Condition,
+    StateSet,
+    State,
+    StateSideEffect,
+    Device,
+    IrsendConfig,
+    CecConfig,
+    SerialConfig,
+    TcpConfig,
+)
+from systemstate.statestore import StateStore
+
+GraphSize = namedtuple('GraphSize', ['name', 'buttons', 'macros', 'commands', 'depth'])
+
+SIZES = {
+    'small': GraphSize('small', 5, 2, 2, 1),
+    'medium': GraphSize('medium', 50, 4, 4, 3),
+    'large': GraphSize('large', 200, 8, 8, 6),
+}
+
+STUB_CEC_CLIENT = os.path.join(os.path.dirname(commands.utils.__file__), 'stub_cec_client.py')
+
+
+class LoopbackTcpServer(object):
+    """
+    Accepts connections on 127.0.0.1 and discards whatever it receives.
+    """
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.received = 0
+        Thread(target=self.accept, name='benchmark-tcp', daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            Thread(target=self.drain, args=(conn,), name='benchmark-tcp-conn', daemon=True).start()
+
+    def drain(self, conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                self.received += len(data)
+
+    def close(self):
+        self.listener.close()
+
+
+class PtySerialPort(object):
+    """
+    A pseudo-terminal standing in for a serial device; the master side is
+    drained so writes never block.
+    """
+
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        self.name = os.ttyname(self.slave)
+        self.received = 0
+        Thread(target=self.drain, name='benchmark-serial', daemon=True).start()
+
+    def drain(self):
+        while True:
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                return
+            if not data:
+                return
+            self.received += len(data)
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+class FakeTransports(object):
+    """
+    Points commands.utils at in-process fakes: a loopback TCP server, a pty
+    for serial, the stub cec-client and a no-op irsend.
+    """
+
+    def __init__(self):
+        self.tcp = LoopbackTcpServer()
+        self.serial = PtySerialPort()
+        self.infrared_commands = 0
+        self._saved = (
+            commands.utils.CEC_SESSION,
+            commands.utils.send_infrared_command,
+            systemstate.models.send_infrared_command,
+        )
+
+    def send_infrared_command(self, device, command):
+        self.infrared_commands += 1
+
+    def __enter__(self):
+        commands.utils.CEC_SESSION = CecSession(command=[sys.executable, STUB_CEC_CLIENT])
+        commands.utils.CEC_SESSION.start()
+        commands.utils.send_infrared_command = self.send_infrared_command
+        systemstate.models.send_infrared_command = self.send_infrared_command
+        return self
+
+    def __exit__(self, *exc_info):
+        commands.utils.CEC_SESSION.stop()
+        (
+            commands.utils.CEC_SESSION,
+            commands.utils.send_infrared_command,
+            systemstate.models.send_infrared_command,
+        ) = self._saved
+        for writer in list(commands.utils.SERIAL_WRITERS.values()):
+            writer.stop()
+        commands.utils.SERIAL_WRITERS.clear()
+        commands.utils.get_tcp_pool().close()
+        self.tcp.close()
+        self.serial.close()
+
+
+def create_condition_chain(name, state, depth):
+    """
+    Nest ``depth`` conditions, alternating any/all, that are met exactly when
+    ``state`` is active.
+    """
+    condition = Condition.objects.create(name='{} 0'.format(name), condition_type='all')
+    condition.states.add(state)
+    for level in range(1, depth):
+        parent = Condition.objects.create(
+            name='{} {}'.format(name, level),
+            condition_type='any' if level % 2 else 'all',
+        )
+        parent.nested_conditions.add(condition)
+        condition = parent
+    return condition
+
+
+def clear_graph():
+    for model in (RemoteButton, Condition, StateSet, Device, TcpConfig, SerialConfig, CecConfig, IrsendConfig):
+        model.objects.all().delete()
+
+
+def seed_graph(size, transports):
+    """
+    Create ``size.buttons`` buttons, each with its own two-state StateSet and
+    ``size.macros`` macros that alternate between the two states, so that half
+    of a button's macros run on every press.
+    """
+    devices = [
+        ('tcp', Device.objects.create(
+            name='Benchmark receiver',
+            tcp_config=TcpConfig.objects.create(host='127.0.0.1', port=transports.tcp.port),
+        )),
+        ('serial', Device.objects.create(
+            name='Benchmark projector',
+            serial_config=SerialConfig.objects.create(
+                port_name=transports.serial.name,
+                baud_rate=9600,
+                byte_size=8,
+                timeout=1,
+            ),
+        )),
+        ('cec', Device.objects.create(
+            name='Benchmark TV',
+            cec_config=CecConfig.objects.create(source_address=1, target_address=0),
+        )),
+        ('infrared', Device.objects.create(
+            name='Benchmark player',
+            irsend_config=IrsendConfig.objects.create(remote_name='benchmark'),
+        )),
+    ]
+    data = {'tcp': 'VU', 'serial': '082200', 'cec': '01', 'infrared': 'KEY_PLAY'}
+    codes = []
+    for button_number in range(size.buttons):
+        button = RemoteButton.objects.create(
+            lirc_code='BENCH_{}'.format(button_number),
+            repeat_mode='repeat',
+            repeat_delay=0,
+            repeat_coalesce=1,
+        )
+        codes.append(button.lirc_code)
+        state_set = StateSet.objects.create(name='Mode {}'.format(button_number), device=devices[0][1])
+        states = [
+            State.objects.create(name='A', state_set=state_set),
+            State.objects.create(name='B', state_set=state_set),
+        ]
+        state_set.status = states[0]
+        state_set.save()
+        conditions = [
+            create_condition_chain('Button {} {}'.format(button_number, state.name), state, size.depth)
+            for state in states
+        ]
+        for macro_number in range(size.macros):
+            macro = CommandSet.objects.create(
+                name='Macro {}.{}'.format(button_number, macro_number),
+                trigger=button,
+                condition=conditions[macro_number % 2],
+            )
+            for command_number in range(size.commands):
+                command_type, device = devices[(macro_number + command_number) % len(devices)]
+                Command.objects.create(
+                    device=device,
+                    trigger=macro,
+                    command_type=command_type,
+                    data=data[command_type],
+                )
+            StateSideEffect.objects.create(commands=macro).states.add(states[(macro_number + 1) % 2])
+    return codes
+
+
+def measure(press, codes, presses, warmup):
+    """
+    Press ``codes`` round-robin and summarise per-press latency in seconds.
+    Presses that raise are timed like any other and counted as errors.
+    """
+    for number in range(warmup):
+        try:
+            press(codes[number % len(codes)])
+        except Exception:
+            pass
+    histogram = Histogram(size=presses)
+    errors = 0
+    started = perf_counter()
+    for number in range(presses):
+        before = perf_counter()
+        try:
+            press(codes[number % len(codes)])
+        except Exception:
+            errors += 1
+        histogram.observe(perf_counter() - before)
+    elapsed = perf_counter() - started
+    summary = histogram.summary()
+    summary['errors'] = errors
+    summary['presses_per_second'] = presses / elapsed if elapsed else 0.0
+    return summary
+
+
+def run_size(size, presses, warmup, modes):
+    results = {'size': size._asdict()}
+    with FakeTransports() as transports:
+        clear_graph()
+        codes = seed_graph(size, transports)
+        if 'plan' in modes:
+            store = StateStore(flush_interval=0.05)
+            store.start()
+            dispatcher = Dispatcher(
+                store=store,
+                executor=InlineExecutor(MetricsRegistry()),
+                metrics=MetricsRegistry(),
+            )
+            started = perf_counter()
+            dispatcher.load()
+            results['plan_compile_seconds'] = perf_counter() - started
+            results['plan'] = measure(lambda code: dispatcher.push(code, 0), codes, presses, warmup)
+            store.stop()
+        if 'orm' in modes:
+            results['orm'] = measure(
+                execute_button,
+                codes,
+                presses,
+                warmup,
+            )
+        commands.utils.get_cec_session().wait_for_acks(5)
+        results['bytes_sent'] = {
+            'tcp': transports.tcp.received,
+            'serial': transports.serial.received,
+            'infrared_commands': transports.infrared_commands,
+        }
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'platform': platform.platform(),
+    }
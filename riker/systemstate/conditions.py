@@ -0,0 +1,117 @@
+from collections import OrderedDict, namedtuple
+from logging import getLogger
+
+LOGGER = getLogger(__name__)
+
+StateIndex = namedtuple('StateIndex', ['bits', 'state_sets', 'set_masks'])
+
+CompiledCondition = namedtuple('CompiledCondition', ['condition_type', 'mask', 'children'])
+
+# Matches nothing: any() of no states and no children.
+UNSATISFIABLE = CompiledCondition('any', 0, ())
+
+
+def build_state_index(states):
+    """
+    Assign one bit to every State, given (state_id, state_set_id) pairs.
+    """
+    bits = {}
+    state_sets = {}
+    set_masks = {}
+    for position, (state_id, state_set_id) in enumerate(states):
+        bit = 1 << position
+        bits[state_id] = bit
+        state_sets[state_id] = state_set_id
+        set_masks[state_set_id] = set_masks.get(state_set_id, 0) | bit
+    return StateIndex(bits, state_sets, set_masks)
+
+
+def state_vector(index, status):
+    """
+    Encode a {state_set_id: state_id} mapping as a bit vector.
+    """
+    vector = 0
+    for state_id in status.values():
+        if state_id is not None:
+            vector |= index.bits[state_id]
+    return vector
+
+
+def activate(index, vector, state_id):
+    bit = index.bits[state_id]
+    return (vector & ~index.set_masks[index.state_sets[state_id]]) | bit
+
+
+def is_active(index, vector, state_id):
+    return bool(vector & index.bits[state_id])
+
+
+def state_delta(index, state_ids):
+    """
+    The net change from activating ``state_ids`` in order: the last state
+    given for each StateSet, as {state_set_id: state_id}.
+    """
+    delta = OrderedDict()
+    for state_id in state_ids:
+        delta[index.state_sets[state_id]] = state_id
+    return delta
+
+
+def compile_conditions(conditions, index):
+    """
+    Flatten {condition_id: ConditionPlan} into CompiledConditions.
+
+    Nested conditions of the same type are folded into their parent's mask,
+    since any(a) or any(b) == any(a + b) and all(a) and all(b) == all(a + b).
+    Conditions whose nested_conditions refer back to themselves are logged
+    and compiled as never met; the rest compile as usual.
+    """
+    compiled = {}
+    visiting = []
+    cyclic = set()
+
+    def visit(condition_id):
+        if condition_id in compiled:
+            return compiled[condition_id]
+        if condition_id in visiting:
+            cycle = visiting[visiting.index(condition_id):]
+            cyclic.update(cycle)
+            LOGGER.warning(
+                'Nested conditions form a cycle (%s); treating them as never met.',
+                ' -> '.join(conditions[x].name for x in cycle + [condition_id]),
+            )
+            return UNSATISFIABLE
+        visiting.append(condition_id)
+        condition = conditions[condition_id]
+        condition_type = 'any' if condition.condition_type == 'any' else 'all'
+        mask = 0
+        for state_id in condition.states:
+            mask |= index.bits[state_id]
+        children = []
+        for nested_id in condition.nested_conditions:
+            nested = visit(nested_id)
+            if nested.condition_type == condition_type:
+                mask |= nested.mask
+                children.extend(nested.children)
+            else:
+                children.append(nested)
+        visiting.pop()
+        if condition_id in cyclic:
+            compiled[condition_id] = UNSATISFIABLE
+        else:
+            compiled[condition_id] = CompiledCondition(condition_type, mask, tuple(children))
+        return compiled[condition_id]
+
+    for condition_id in conditions:
+        visit(condition_id)
+    return compiled
+
+
+def evaluate(condition, vector):
+    if condition.condition_type == 'any':
+        if vector & condition.mask:
+            return True
+        return any(evaluate(x, vector) for x in condition.children)
+    if vector & condition.mask != condition.mask:
+        return False
+    return all(evaluate(x, vector) for x in condition.children)
@@ -0,0 +1,283 @@
+import re
+from functools import partial
+from logging import getLogger
+from threading import Lock
+
+from django.db import transaction
+
+import commands.utils
+from commands.tcp import encode_command
+from systemstate.models import (
+    Device,
+    IrsendConfig,
+    CecConfig,
+    SerialConfig,
+    TcpConfig,
+)
+
+LOGGER = getLogger(__name__)
+
+
+class DeviceTransport(object):
+    """
+    A device's sender for one command type, bound to its configuration once.
+    Reconfiguring it in place keeps ``send`` valid for every compiled command
+    that refers to it.
+    """
+
+    send_function = None
+    query_function = None
+    release_function = None
+
+    # Whether send_batch() sends several commands more cheaply than send().
+    batched = False
+
+    def __init__(self, transport, config):
+        self.transport = transport
+        self.configure(config)
+
+    def configure(self, config):
+        self.config = config
+        self._send = partial(getattr(self.transport, self.send_function), *config)
+
+    def encode(self, data):
+        return data
+
+    def send(self, data):
+        return self._send(data)
+
+    def send_batch(self, data):
+        for item in data:
+            self._send(item)
+
+    def query_args(self):
+        return self.config
+
+    def release(self, config):
+        """
+        Let the transport close what it keeps open for ``config``, once no
+        device uses that configuration any more.
+        """
+        function = getattr(self.transport, self.release_function or '', None)
+        if function is not None:
+            function(*config)
+
+    def query(self, data, timeout):
+        """
+        Ask the device for its state with ``data`` and return the response
+        lines. Raises NotImplementedError if the transport can't.
+        """
+        function = getattr(self.transport, self.query_function or '', None)
+        if function is None:
+            raise NotImplementedError('{} can not query device state.'.format(type(self).__name__))
+        return function(*self.query_args() + (data, timeout))
+
+
+class CecTransport(DeviceTransport):
+    send_function = 'send_cec_command'
+    query_function = 'query_cec_power'
+
+
+class TcpTransport(DeviceTransport):
+    """
+    Configured with (host, port, ack pattern, ack timeout). A batch is framed
+    into one write, or sent command by command when an ack pattern is set.
+    """
+
+    send_function = 'send_tcp_command'
+    query_function = 'query_tcp_state'
+    batched = True
+
+    def configure(self, config):
+        self.config = config
+        host, port, ack_pattern, ack_timeout = config
+        options = {}
+        if ack_pattern:
+            try:
+                options = {'ack_pattern': re.compile(ack_pattern), 'ack_timeout': ack_timeout}
+            except re.error as error:
+                LOGGER.error('Ignoring invalid ack pattern %r for %s:%s: %s', ack_pattern, host, port, error)
+        self._send = partial(getattr(self.transport, self.send_function), host, port, **options)
+
+    def encode(self, data):
+        return encode_command(data)
+
+    def send_batch(self, data):
+        return self._send(list(data))
+
+    def query_args(self):
+        return self.config[:2]
+
+
+class SerialTransport(DeviceTransport):
+    send_function = 'send_serial_command'
+    query_function = 'query_serial_state'
+    release_function = 'release_serial_port'
+
+    def encode(self, data):
+        # Only listeners with serial devices load pyserial.
+        from commands.serialport import decode_frame
+        return decode_frame(data)
+
+
+class InfraredTransport(DeviceTransport):
+    send_function = 'send_infrared_command'
+
+
+TRANSPORTS = {
+    'cec': CecTransport,
+    'tcp': TcpTransport,
+    'serial': SerialTransport,
+    'infrared': InfraredTransport,
+}
+
+
+def load_device_graph(device_id):
+    """
+    The subset of load_graph() that describes one device.
+    """
+    with transaction.atomic():
+        devices = list(
+            Device.objects.filter(pk=device_id).values_list(
+                'id', 'name', 'cec_config_id', 'tcp_config_id', 'serial_config_id', 'irsend_config_id'
+            )
+        )
+        if not devices:
+            return {'devices': []}
+        _, _, cec_id, tcp_id, serial_id, irsend_id = devices[0]
+        return {
+            'devices': devices,
+            'cec_configs': list(
+                CecConfig.objects.filter(pk=cec_id).values_list('id', 'source_address', 'target_address')
+            ),
+            'tcp_configs': list(
+                TcpConfig.objects.filter(pk=tcp_id).values_list('id', 'host', 'port', 'ack_pattern', 'ack_timeout')
+            ),
+            'serial_configs': list(
+                SerialConfig.objects.filter(pk=serial_id).values_list(
+                    'id', 'port_name', 'baud_rate', 'byte_size', 'timeout', 'inter_frame_gap'
+                )
+            ),
+            'irsend_configs': list(
+                IrsendConfig.objects.filter(pk=irsend_id).values_list('id', 'remote_name')
+            ),
+        }
+
+
+def device_configs(graph):
+    """
+    Map each device id in ``graph`` to {command type: send_*_command arguments}.
+    """
+    cec_configs = {pk: (source, target) for pk, source, target in graph['cec_configs']}
+    tcp_configs = {
+        pk: (host, port, ack_pattern or None, ack_timeout / 1000.0)
+        for pk, host, port, ack_pattern, ack_timeout in graph['tcp_configs']
+    }
+    serial_configs = {
+        pk: (port, baud, bytesize, timeout, gap / 1000.0)
+        for pk, port, baud, bytesize, timeout, gap in graph['serial_configs']
+    }
+    irsend_configs = {pk: (remote_name,) for pk, remote_name in graph['irsend_configs']}
+    configs = {}
+    for device_id, _, cec_id, tcp_id, serial_id, irsend_id in graph['devices']:
+        device = configs[device_id] = {}
+        if cec_id is not None:
+            device['cec'] = cec_configs[cec_id]
+        if tcp_id is not None:
+            device['tcp'] = tcp_configs[tcp_id]
+        if serial_id is not None:
+            device['serial'] = serial_configs[serial_id]
+        if irsend_id is not None:
+            device['infrared'] = irsend_configs[irsend_id]
+    return configs
+
+
+class DeviceRegistry(object):
+    """
+    One long-lived DeviceTransport per device and command type. Syncing with
+    new configuration only touches the transports whose configuration changed.
+    """
+
+    def __init__(self, transport=commands.utils):
+        self.transport = transport
+        self.devices = {}
+        self._lock = Lock()
+
+    def get(self, device_id, command_type):
+        return self.devices.get(device_id, {}).get(command_type)
+
+    def configs(self, command_type):
+        """
+        The configuration of every device's ``command_type`` transport.
+        """
+        return [device[command_type].config for device in self.devices.values() if command_type in device]
+
+    def sync_device(self, device_id, configs, superseded):
+        """
+        Bring one device's transports in line with ``configs``, adding the
+        (transport, old config) pairs it replaces to ``superseded``. Returns
+        False if the device gained or lost a command type.
+        """
+        current = self.devices.get(device_id, {})
+        for command_type, config in configs.items():
+            device_transport = current.get(command_type)
+            if device_transport is None:
+                current[command_type] = TRANSPORTS[command_type](self.transport, config)
+            elif device_transport.config != config:
+                LOGGER.info('Reconfiguring %s transport for device %s.', command_type, device_id)
+                superseded.append((device_transport, device_transport.config))
+                device_transport.configure(config)
+        unchanged = set(current) == set(configs)
+        for command_type in set(current) - set(configs):
+            superseded.append((current[command_type], current[command_type].config))
+            del current[command_type]
+        self.devices[device_id] = current
+        return unchanged
+
+    def sync(self, configs, transport=None):
+        superseded = []
+        with self._lock:
+            if transport is not None and transport is not self.transport:
+                self.transport = transport
+                self.devices = {}
+            for device_id in set(self.devices) - set(configs):
+                superseded.extend((x, x.config) for x in self.devices.pop(device_id).values())
+            for device_id, device in configs.items():
+                self.sync_device(device_id, device, superseded)
+        self.release(superseded)
+
+    def release(self, superseded):
+        """
+        Release the superseded configurations that no device still uses, so
+        that e.g. a serial port's old writer doesn't keep the port open.
+        """
+        with self._lock:
+            in_use = {
+                (type(device_transport), device_transport.config)
+                for device in self.devices.values()
+                for device_transport in device.values()
+            }
+        released = set()
+        for device_transport, config in superseded:
+            key = (type(device_transport), config)
+            if key in in_use or key in released:
+                continue
+            released.add(key)
+            try:
+                device_transport.release(config)
+            except Exception:
+                LOGGER.exception('Failed to release %s transport %r.', type(device_transport).__name__, config)
+
+    def refresh(self, device_id):
+        """
+        Re-read one device's configuration. Returns False if the compiled plan
+        needs rebuilding because the device's command types changed.
+        """
+        configs = device_configs(load_device_graph(device_id))
+        superseded = []
+        with self._lock:
+            if device_id not in configs:
+                return device_id not in self.devices
+            unchanged = self.sync_device(device_id, configs[device_id], superseded)
+        self.release(superseded)
+        return unchanged
@@ -0,0 +1,588 @@
+import binascii
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from itertools import count
+from logging import DEBUG, INFO, getLogger
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+
+import commands.utils
+from riker.logutils import log_event
+from systemstate.conditions import (
+    activate,
+    build_state_index,
+    compile_conditions,
+    evaluate,
+    is_active,
+    state_delta,
+    state_vector,
+)
+from systemstate.devices import DeviceRegistry, device_configs
+from systemstate.executor import CommandExecutor, Completion, InlineExecutor
+from systemstate.metrics import METRICS
+from systemstate.models import (
+    RemoteButton,
+    Command,
+    CommandSet,
+    Condition,
+    StateSet,
+    State,
+    StateSideEffect,
+    Device,
+    IrsendConfig,
+    CecConfig,
+    SerialConfig,
+    TcpConfig,
+    SEQUENTIAL_SIDE_EFFECTS,
+)
+from systemstate.repeat import RepeatLimiter, compile_policy
+from systemstate.scheduler import SUPERSEDE_SEQUENCES, Scheduler, Sequence
+from systemstate.snapshot import read_snapshot
+from systemstate.statestore import StateStore
+
+LOGGER = getLogger(__name__)
+
+
+DispatchPlan = namedtuple('DispatchPlan', ['buttons', 'macros', 'conditions', 'state_index', 'state_vector'])
+
+ButtonPlan = namedtuple('ButtonPlan', ['lirc_code', 'macros', 'repeat_policy'])
+
+MacroPlan = namedtuple('MacroPlan', ['name', 'condition', 'commands', 'side_effects'])
+
+CommandPlan = namedtuple(
+    'CommandPlan',
+    ['device', 'command_type', 'data', 'condition', 'handler', 'batch', 'delay', 'wait_until', 'wait_timeout'],
+)
+
+ConditionPlan = namedtuple('ConditionPlan', ['name', 'condition_type', 'states', 'nested_conditions'])
+
+
+def load_graph():
+    """
+    Read every row the dispatch plan depends on as plain tuples, in one
+    consistent transaction and a fixed number of queries.
+    """
+    with transaction.atomic():
+        return {
+            'buttons': list(
+                RemoteButton.objects.order_by('id').values_list(
+                    'id', 'lirc_code', 'repeat_mode', 'repeat_delay', 'repeat_coalesce', 'max_rate'
+                )
+            ),
+            'command_sets': list(
+                CommandSet.objects.order_by('id').values_list('id', 'name', 'trigger_id', 'condition_id')
+            ),
+            'commands': list(
+                Command.objects.order_by('id').values_list(
+                    'id', 'trigger_id', 'device_id', 'command_type', 'data', 'condition_id',
+                    'delay', 'wait_until_id', 'wait_timeout',
+                )
+            ),
+            'conditions': list(
+                Condition.objects.order_by('id').values_list('id', 'name', 'condition_type')
+            ),
+            'condition_states': list(
+                Condition.states.through.objects.order_by('id').values_list('condition_id', 'state_id')
+            ),
+            'nested_conditions': list(
+                Condition.nested_conditions.through.objects.order_by('id').values_list(
+                    'from_condition_id', 'to_condition_id'
+                )
+            ),
+            'state_sets': list(
+                StateSet.objects.order_by('id').values_list('id', 'name', 'device_id', 'status_id')
+            ),
+            'states': list(
+                State.objects.order_by('id').values_list('id', 'name', 'state_set_id')
+            ),
+            'side_effects': list(
+                StateSideEffect.objects.order_by('id').values_list('id', 'commands_id')
+            ),
+            'side_effect_states': list(
+                StateSideEffect.states.through.objects.order_by('id').values_list(
+                    'statesideeffect_id', 'state_id'
+                )
+            ),
+            'devices': list(
+                Device.objects.order_by('id').values_list(
+                    'id', 'name', 'cec_config_id', 'tcp_config_id', 'serial_config_id', 'irsend_config_id'
+                )
+            ),
+            'cec_configs': list(
+                CecConfig.objects.values_list('id', 'source_address', 'target_address')
+            ),
+            'tcp_configs': list(
+                TcpConfig.objects.values_list('id', 'host', 'port', 'ack_pattern', 'ack_timeout')
+            ),
+            'serial_configs': list(
+                SerialConfig.objects.values_list(
+                    'id', 'port_name', 'baud_rate', 'byte_size', 'timeout', 'inter_frame_gap'
+                )
+            ),
+            'irsend_configs': list(
+                IrsendConfig.objects.values_list('id', 'remote_name')
+            ),
+        }
+
+
+def compile_plan(graph, transport=commands.utils, devices=None):
+    """
+    Compile ``graph`` into a DispatchPlan whose commands are bound to the
+    transports in ``devices``, a DeviceRegistry that is synced with the
+    graph's device configuration first.
+    """
+    if devices is None:
+        devices = DeviceRegistry(transport)
+    devices.sync(device_configs(graph), transport)
+
+    condition_states = {}
+    for condition_id, state_id in graph['condition_states']:
+        condition_states.setdefault(condition_id, []).append(state_id)
+    nested_conditions = {}
+    for from_id, to_id in graph['nested_conditions']:
+        nested_conditions.setdefault(from_id, []).append(to_id)
+    state_index = build_state_index((pk, state_set_id) for pk, _, state_set_id in graph['states'])
+    conditions = compile_conditions({
+        pk: ConditionPlan(
+            name,
+            condition_type,
+            tuple(condition_states.get(pk, ())),
+            tuple(nested_conditions.get(pk, ())),
+        ) for pk, name, condition_type in graph['conditions']
+    }, state_index)
+
+    commands = {}
+    for pk, trigger_id, device_id, command_type, data, condition_id, delay, wait_until, wait_timeout in graph['commands']:
+        handler = batch = None
+        device_transport = devices.get(device_id, command_type)
+        if device_transport is not None:
+            try:
+                data = device_transport.encode(data)
+            except (binascii.Error, TypeError, UnicodeError):
+                LOGGER.error('%s command %s has invalid data %r; skipping it.', command_type, pk, data)
+            else:
+                handler = device_transport.send
+                if device_transport.batched:
+                    batch = device_transport.send_batch
+        commands.setdefault(trigger_id, []).append(CommandPlan(
+            device_id,
+            command_type,
+            data,
+            condition_id,
+            handler,
+            batch,
+            delay / 1000.0,
+            wait_until,
+            wait_timeout / 1000.0,
+        ))
+
+    side_effect_states = {}
+    for side_effect_id, state_id in graph['side_effect_states']:
+        side_effect_states.setdefault(side_effect_id, []).append(state_id)
+    side_effects = {}
+    for side_effect_id, command_set_id in graph['side_effects']:
+        side_effects.setdefault(command_set_id, []).extend(side_effect_states.get(side_effect_id, ()))
+
+    macros = {}
+    macros_by_name = {}
+    for pk, name, trigger_id, condition_id in graph['command_sets']:
+        macro = MacroPlan(
+            name,
+            condition_id,
+            tuple(commands.get(pk, ())),
+            tuple(side_effects.get(pk, ())),
+        )
+        macros.setdefault(trigger_id, []).append(macro)
+        if name in macros_by_name:
+            LOGGER.warning(
+                'Several macros are named %r; running it by name runs the oldest and ignores macro %s.',
+                name,
+                pk,
+            )
+        macros_by_name.setdefault(name, macro)
+
+    return DispatchPlan(
+        buttons={
+            lirc_code: ButtonPlan(
+                lirc_code,
+                tuple(macros.get(pk, ())),
+                compile_policy(*repeat_policy),
+            ) for pk, lirc_code, *repeat_policy in graph['buttons']
+        },
+        macros=macros_by_name,
+        conditions=conditions,
+        state_index=state_index,
+        state_vector=state_vector(
+            state_index,
+            {pk: status_id for pk, _, _, status_id in graph['state_sets']},
+        ),
+    )
+
+
+class Dispatcher(object):
+    """
+    Executes button presses against a compiled, immutable DispatchPlan so that
+    a keypress never has to read from the database.
+    """
+
+    def __init__(self, store=None, executor=None, transport=commands.utils, metrics=METRICS,
+                 side_effect_mode=None, scheduler=None, sequence_policy=None):
+        self.plan = None
+        self.snapshot = None
+        self.side_effect_mode = side_effect_mode or settings.RIKER_SIDE_EFFECT_MODE
+        self.sequence_policy = sequence_policy or settings.RIKER_SEQUENCE_POLICY
+        self.scheduler = scheduler or Scheduler(metrics)
+        self.sequences = set()
+        self.feedback = None
+        self._presses = count(1)
+        self.state_vector = 0
+        self.store = store or StateStore()
+        self.executor = executor or InlineExecutor(metrics)
+        self.transport = transport
+        self.devices = DeviceRegistry(transport)
+        self.metrics = metrics
+        self.repeats = RepeatLimiter()
+        self._lock = Lock()
+        self._load_lock = Lock()
+        self._activated = None
+        self._tick = None
+        self._condition_time = 0.0
+
+    def load(self):
+        """
+        Compile a new plan while presses keep running against the old one,
+        then swap it in. State activated during the compile is replayed onto
+        the new plan so that no press is lost.
+        """
+        with self._load_lock:
+            with self._lock:
+                self._activated = []
+            try:
+                with self.store.lock:
+                    graph = self.read_graph()
+                    unflushed = self.store.unflushed()
+                plan = compile_plan(graph, self.transport, self.devices)
+                with self._lock:
+                    vector = plan.state_vector
+                    for state_id in list(unflushed.values()) + self._activated:
+                        if state_id in plan.state_index.bits:
+                            vector = activate(plan.state_index, vector, state_id)
+                    self.plan = plan
+                    self.state_vector = vector
+                    self.cancel_sequences(reason='the dispatch plan was rebuilt')
+            finally:
+                with self._lock:
+                    self._activated = None
+        return plan
+
+    def use_snapshot(self, path):
+        """
+        Read the configuration from the snapshot at ``path`` instead of the
+        database. With no database to write to, the store keeps state changes
+        in its journal.
+        """
+        self.snapshot = path
+        self.store.database = False
+
+    def read_graph(self):
+        if self.snapshot is not None:
+            return read_snapshot(self.snapshot)['graph']
+        return load_graph()
+
+    def reload(self):
+        if self.plan is None:
+            return
+        try:
+            self.load()
+        except Exception:
+            LOGGER.exception('Failed to rebuild dispatch plan; keeping the previous one.')
+
+    def refresh_device(self, device_id):
+        """
+        Apply a change to one device's configuration without recompiling the
+        plan, unless the device gained or lost a command type.
+        """
+        if self.plan is None:
+            return
+        if self.snapshot is not None:
+            # The snapshot has the device's new configuration only as part
+            # of the whole graph.
+            self.reload()
+            return
+        try:
+            if self.devices.refresh(device_id):
+                return
+        except Exception:
+            LOGGER.exception('Failed to refresh device %s; rebuilding the dispatch plan.', device_id)
+        self.reload()
+
+    def has_button(self, code):
+        plan = self.plan
+        return plan is not None and code in plan.buttons
+
+    def condition_met(self, condition_id):
+        start = monotonic()
+        met = evaluate(self.plan.conditions[condition_id], self.state_vector)
+        self._condition_time += monotonic() - start
+        return met
+
+    def push(self, code, repeat=None, received=None, on_sent=None):
+        """
+        Execute the button with ``code``. ``repeat`` is the input's repeat
+        count if it reports one, and ``received`` the monotonic() time the
+        event arrived, if it was queued before reaching the dispatcher.
+        Returns the number of macros that ran, or None if the press was
+        ignored. ``on_sent``, if given, is called with the number of commands
+        that failed once all of the press's commands, including delayed
+        steps, have been sent.
+        """
+        if self.plan is None:
+            self.load()
+        start = monotonic()
+        if received is not None:
+            self.metrics.observe('receive', code, start - received)
+        completion = Completion(on_sent) if on_sent is not None else None
+        try:
+            with self._lock:
+                plan = self.plan
+                button = plan.buttons.get(code)
+                self.metrics.observe('lookup', code, monotonic() - start)
+                if button is None:
+                    log_event(LOGGER, DEBUG, 'button.unknown', button=code)
+                    return
+                if not self.repeats.allow(code, button.repeat_policy, repeat, received):
+                    return
+                log_event(LOGGER, DEBUG, 'button.execute', button=code)
+                ran = self.run_macros(code, button.macros, completion)
+        finally:
+            if completion is not None:
+                completion.close()
+        self.metrics.observe('press', code, monotonic() - start)
+        return ran
+
+    def run_macro(self, name, received=None, on_sent=None):
+        """
+        Run the CommandSet called ``name`` as if its button had been pressed,
+        but without repeat handling or the button's other macros. Returns
+        whether its conditions were met; raises KeyError for unknown names.
+        """
+        if self.plan is None:
+            self.load()
+        start = monotonic()
+        if received is not None:
+            self.metrics.observe('receive', name, start - received)
+        completion = Completion(on_sent) if on_sent is not None else None
+        try:
+            with self._lock:
+                macro = self.plan.macros[name]
+                ran = self.run_macros(name, (macro,), completion)
+        finally:
+            if completion is not None:
+                completion.close()
+        self.metrics.observe('press', name, monotonic() - start)
+        return bool(ran)
+
+    def run_macros(self, label, macros, completion=None):
+        """
+        Execute the commands of every macro whose condition is met, then apply
+        their side effects, all in one tick. Must be called with the dispatch
+        lock held.
+        """
+        self._condition_time = 0.0
+        press = next(self._presses)
+        effects = []
+        ran = 0
+        with self.tick():
+            for macro in macros:
+                if macro.condition is not None and not self.condition_met(macro.condition):
+                    log_event(LOGGER, DEBUG, 'macro.skipped', button=label, macro=macro.name)
+                    continue
+                if self.sequence_policy == SUPERSEDE_SEQUENCES:
+                    self.cancel_sequences({command.device for command in macro.commands}, press, 'a new press')
+                self.advance_sequence(Sequence(macro.name, press, macro.commands, completion))
+                effects += macro.side_effects
+                ran += 1
+            self.metrics.observe('conditions', label, self._condition_time)
+            with self.metrics.timer('side_effects', label):
+                if self.side_effect_mode == SEQUENTIAL_SIDE_EFFECTS:
+                    for state_id in effects:
+                        self.activate(state_id)
+                else:
+                    self.activate_many(effects)
+        return ran
+
+    @contextmanager
+    def tick(self):
+        """
+        Hold back the commands sent inside the block and submit them together
+        at its end, so that consecutive commands for one device over a
+        batching transport go out in a single send. Must be used with the
+        dispatch lock held.
+        """
+        if self._tick is not None:
+            yield
+            return
+        self._tick = []
+        try:
+            yield
+        finally:
+            commands, self._tick = self._tick, None
+            self.submit_commands(commands)
+
+    def submit_commands(self, commands):
+        runs = OrderedDict()
+        for command, completion in commands:
+            device_runs = runs.setdefault(command.device, [])
+            if device_runs and command.batch is not None and device_runs[-1][0] == command.batch:
+                device_runs[-1][1].append((command, completion))
+            else:
+                device_runs.append((command.batch, [(command, completion)]))
+        for device, device_runs in runs.items():
+            for batch, run in device_runs:
+                callback = self.completion_callback({completion for _, completion in run})
+                if len(run) == 1:
+                    command = run[0][0]
+                    self.executor.submit(device, command.handler, command.data, callback=callback)
+                else:
+                    self.executor.submit(device, batch, [command.data for command, _ in run], callback=callback)
+
+    def completion_callback(self, completions):
+        """
+        An executor callback that reports one send to each of ``completions``.
+        """
+        completions.discard(None)
+        if not completions:
+            return None
+        for completion in completions:
+            completion.add()
+
+        def callback(error):
+            for completion in completions:
+                completion.done(error)
+        return callback
+
+    def advance_sequence(self, sequence):
+        """
+        Send the sequence's commands until one has to wait, then schedule its
+        resumption. Must be called with the dispatch lock held.
+        """
+        while sequence.steps:
+            command = sequence.steps[0]
+            if command.delay and not sequence.delayed:
+                sequence.delayed = True
+                sequence.timer = self.scheduler.call_later(
+                    command.delay, self.resume_sequence, sequence, label=sequence.label
+                )
+                self.sequences.add(sequence)
+                return
+            if command.wait_until is not None and not sequence.timed_out and not self.state_active(command.wait_until):
+                if not sequence.waiting:
+                    sequence.waiting = True
+                    sequence.timer = self.scheduler.call_later(
+                        command.wait_timeout, self.sequence_timed_out, sequence, label=sequence.label
+                    )
+                    self.sequences.add(sequence)
+                return
+            sequence.next_step()
+            self.execute_command(command, sequence.completion)
+        self.sequences.discard(sequence)
+        sequence.finish()
+
+    def resume_sequence(self, sequence):
+        with self._lock, self.tick():
+            if not sequence.cancelled:
+                self.advance_sequence(sequence)
+
+    def sequence_timed_out(self, sequence):
+        with self._lock, self.tick():
+            if sequence.cancelled:
+                return
+            LOGGER.warning('%s timed out waiting for state %s; continuing.', sequence.label, sequence.steps[0].wait_until)
+            sequence.timed_out = True
+            self.advance_sequence(sequence)
+
+    def cancel_sequences(self, devices=None, press=None, reason=None):
+        """
+        Cancel in-flight sequences from earlier presses that send to any of
+        ``devices``, or every sequence if ``devices`` is None. Must be called
+        with the dispatch lock held.
+        """
+        for sequence in list(self.sequences):
+            if sequence.press == press or (devices is not None and not sequence.devices & devices):
+                continue
+            log_event(LOGGER, DEBUG, 'sequence.cancelled', macro=sequence.label, reason=reason)
+            sequence.cancel()
+            self.sequences.discard(sequence)
+
+    def reconcile(self, state_id):
+        """
+        Make ``state_id`` active because its device reported it. Returns
+        whether that changed anything.
+        """
+        with self._lock, self.tick():
+            if self.plan is None or state_id not in self.plan.state_index.bits or self.state_active(state_id):
+                return False
+            log_event(LOGGER, INFO, 'state.reconciled', state=state_id)
+            self.activate_many((state_id,))
+            return True
+
+    def state_active(self, state_id):
+        state_index = self.plan.state_index
+        return state_id in state_index.bits and is_active(state_index, self.state_vector, state_id)
+
+    def execute_command(self, command, completion=None):
+        if command.condition is not None and not self.condition_met(command.condition):
+            return
+        if command.handler is None:
+            LOGGER.error(
+                'Device {} has no {} configuration; skipping command {}.'.format(
+                    command.device,
+                    command.command_type,
+                    command.data,
+                )
+            )
+            return
+        if self._tick is not None:
+            self._tick.append((command, completion))
+        else:
+            callback = self.completion_callback({completion})
+            self.executor.submit(command.device, command.handler, command.data, callback=callback)
+
+    def activate(self, state_id):
+        self.activate_many((state_id,))
+
+    def activate_many(self, state_ids):
+        """
+        Apply ``state_ids`` as one net change, where the last state given for
+        each StateSet wins, and hand it to the store as a single write.
+        """
+        state_index = self.plan.state_index
+        changes = state_delta(state_index, state_ids)
+        if not changes:
+            return
+        for state_id in changes.values():
+            self.state_vector = activate(state_index, self.state_vector, state_id)
+            if self._activated is not None:
+                self._activated.append(state_id)
+        self.store.write_many(changes)
+        if self.feedback is not None:
+            self.feedback.expect(changes)
+        for sequence in list(self.sequences):
+            if sequence.waiting:
+                self.advance_sequence(sequence)
+
+
+DISPATCHER = Dispatcher(
+    store=StateStore(
+        journal_path=settings.RIKER_STATE_JOURNAL,
+        flush_interval=settings.RIKER_STATE_FLUSH_INTERVAL,
+    ),
+    executor=CommandExecutor(
+        queue_depth=settings.RIKER_DEVICE_QUEUE_DEPTH,
+        policy=settings.RIKER_DEVICE_QUEUE_POLICY,
+        timeout=settings.RIKER_DEVICE_QUEUE_TIMEOUT,
+    ),
+)
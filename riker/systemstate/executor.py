@@ -0,0 +1,254 @@
+import asyncio
+from logging import getLogger
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import monotonic
+
+from systemstate.metrics import METRICS
+
+LOGGER = getLogger(__name__)
+
+BLOCK = 'block'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+
+QUEUE_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+_STOP = object()
+
+
+class CommandDropped(Exception):
+    pass
+
+
+def report(callback, error):
+    """
+    Tell a submit() caller that its command was sent (``error`` is None),
+    failed, or was dropped.
+    """
+    if callback is None:
+        return
+    try:
+        callback(error)
+    except Exception:
+        LOGGER.exception('Command completion callback failed.')
+
+
+class Completion(object):
+    """
+    Counts the commands sent on behalf of one press and calls
+    ``callback(failures)`` once every one of them has been reported and
+    close() has been called, so that no more can be added.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.pending = 1
+        self.failures = 0
+        self._lock = Lock()
+
+    def add(self):
+        with self._lock:
+            self.pending += 1
+
+    def done(self, error=None):
+        with self._lock:
+            self.pending -= 1
+            if error is not None:
+                self.failures += 1
+            finished = self.pending == 0
+        if finished:
+            self.callback(self.failures)
+
+    def close(self):
+        self.done()
+
+
+class InlineExecutor(object):
+    """
+    Runs every command immediately on the calling thread.
+    """
+
+    def __init__(self, metrics=METRICS):
+        self.metrics = metrics
+
+    def submit(self, device_id, handler, *args, callback=None):
+        with self.metrics.timer('send', device_id):
+            try:
+                handler(*args)
+            except Exception as error:
+                report(callback, error)
+                raise
+        report(callback, None)
+
+    def stop(self):
+        pass
+
+
+class DeviceWorker(Thread):
+
+    def __init__(self, device_id, queue_depth, metrics=METRICS):
+        self.device_id = device_id
+        self.queue = Queue(maxsize=queue_depth)
+        self.metrics = metrics
+        self.dropped = 0
+        super(DeviceWorker, self).__init__(name='riker-device-{}'.format(device_id), daemon=True)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is _STOP:
+                return
+            handler, args, enqueued, callback = job
+            started = monotonic()
+            self.metrics.observe('queue', self.device_id, started - enqueued)
+            error = None
+            try:
+                handler(*args)
+            except Exception as failure:
+                LOGGER.exception('Command %r for device %s failed.', args, self.device_id)
+                error = failure
+            self.metrics.observe('send', self.device_id, monotonic() - started)
+            report(callback, error)
+
+
+class CommandExecutor(object):
+    """
+    Sends commands through one ordered queue and worker thread per Device, so
+    that a slow device only delays its own commands.
+
+    When a device's queue is full, ``policy`` decides what happens: ``block``
+    waits up to ``timeout`` seconds for room before dropping the new command,
+    ``drop_newest`` drops the new command immediately, and ``drop_oldest``
+    discards the oldest queued command to make room.
+
+    ``callback``, if given to submit(), is called from the worker thread with
+    None once the command has been sent, or with the exception if it failed
+    or was dropped.
+    """
+
+    def __init__(self, queue_depth=16, policy=BLOCK, timeout=0.5, metrics=METRICS):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError('Unknown queue policy {!r}; expected one of {}.'.format(policy, QUEUE_POLICIES))
+        self.queue_depth = queue_depth
+        self.policy = policy
+        self.timeout = timeout
+        self.metrics = metrics
+        self.workers = {}
+        self._lock = Lock()
+
+    def get_worker(self, device_id):
+        try:
+            return self.workers[device_id]
+        except KeyError:
+            pass
+        with self._lock:
+            if device_id not in self.workers:
+                worker = DeviceWorker(device_id, self.queue_depth, self.metrics)
+                worker.start()
+                self.workers[device_id] = worker
+            return self.workers[device_id]
+
+    def submit(self, device_id, handler, *args, callback=None):
+        worker = self.get_worker(device_id)
+        job = (handler, args, monotonic(), callback)
+        try:
+            if self.policy == BLOCK:
+                worker.queue.put(job, timeout=self.timeout)
+            elif self.policy == DROP_NEWEST:
+                worker.queue.put_nowait(job)
+            else:
+                self._put_dropping_oldest(worker, job)
+        except Full:
+            worker.dropped += 1
+            LOGGER.warning('Queue for device %s is full; dropped command %r.', device_id, args)
+            report(callback, CommandDropped(device_id))
+
+    def _put_dropping_oldest(self, worker, job):
+        while True:
+            try:
+                worker.queue.put_nowait(job)
+                return
+            except Full:
+                try:
+                    dropped_handler, dropped_args, _, dropped_callback = worker.queue.get_nowait()
+                except Empty:
+                    continue
+                worker.dropped += 1
+                LOGGER.warning(
+                    'Queue for device %s is full; dropped command %r.',
+                    worker.device_id,
+                    dropped_args,
+                )
+                report(dropped_callback, CommandDropped(worker.device_id))
+
+    def stop(self):
+        with self._lock:
+            workers, self.workers = self.workers, {}
+        for worker in workers.values():
+            worker.queue.put(_STOP)
+        for worker in workers.values():
+            worker.join()
+
+
+class AsyncCommandExecutor(object):
+    """
+    The asyncio counterpart of CommandExecutor: one ordered queue and task per
+    Device on a single event loop. Handlers are coroutine functions and
+    submit() must be called from the loop's thread. A full queue can't block
+    the loop, so the ``block`` policy behaves like ``drop_newest``.
+    """
+
+    def __init__(self, loop=None, queue_depth=16, policy=BLOCK, metrics=METRICS):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError('Unknown queue policy {!r}; expected one of {}.'.format(policy, QUEUE_POLICIES))
+        self.loop = loop or asyncio.get_event_loop()
+        self.metrics = metrics
+        self.queue_depth = queue_depth
+        self.policy = policy
+        self.queues = {}
+        self.tasks = {}
+        self.dropped = {}
+
+    def get_queue(self, device_id):
+        try:
+            return self.queues[device_id]
+        except KeyError:
+            queue = self.queues[device_id] = asyncio.Queue(maxsize=self.queue_depth)
+            self.tasks[device_id] = self.loop.create_task(self.run(device_id, queue))
+            return queue
+
+    async def run(self, device_id, queue):
+        while True:
+            handler, args, enqueued, callback = await queue.get()
+            started = monotonic()
+            self.metrics.observe('queue', device_id, started - enqueued)
+            error = None
+            try:
+                await handler(*args)
+            except Exception as failure:
+                LOGGER.exception('Command %r for device %s failed.', args, device_id)
+                error = failure
+            self.metrics.observe('send', device_id, monotonic() - started)
+            report(callback, error)
+
+    def submit(self, device_id, handler, *args, callback=None):
+        queue = self.get_queue(device_id)
+        if queue.full() and self.policy == DROP_OLDEST:
+            dropped_handler, dropped_args, _, dropped_callback = queue.get_nowait()
+            self._dropped(device_id, dropped_args, dropped_callback)
+        try:
+            queue.put_nowait((handler, args, monotonic(), callback))
+        except asyncio.QueueFull:
+            self._dropped(device_id, args, callback)
+
+    def _dropped(self, device_id, args, callback):
+        self.dropped[device_id] = self.dropped.get(device_id, 0) + 1
+        LOGGER.warning('Queue for device %s is full; dropped command %r.', device_id, args)
+        report(callback, CommandDropped(device_id))
+
+    def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.queues = {}
+        self.tasks = {}
@@ -0,0 +1,179 @@
+import re
+from logging import DEBUG, getLogger
+from threading import Lock
+
+from django.db import transaction
+
+from riker.logutils import log_event
+from systemstate.models import State, StateQuery
+from systemstate.scheduler import Scheduler
+from systemstate.snapshot import read_snapshot
+
+LOGGER = getLogger(__name__)
+
+# Seconds between the first polls of successive StateSets, so that starting
+# up doesn't query every device at once.
+STAGGER = 0.2
+
+
+class PolledStateSet(object):
+    """
+    A StateSet with a StateQuery. It is polled every ``interval`` seconds,
+    which doubles from min_interval up to max_interval while the device agrees
+    with the dispatcher, and drops back to min_interval after a change.
+    """
+
+    def __init__(self, state_set, device, command_type, data, min_interval, max_interval):
+        self.state_set = state_set
+        self.device = device
+        self.command_type = command_type
+        self.data = data
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.timer = None
+
+
+def load_feedback():
+    with transaction.atomic():
+        return {
+            'queries': list(
+                StateQuery.objects.order_by('id').values_list(
+                    'state_set_id', 'state_set__device_id', 'command_type', 'data', 'min_interval', 'max_interval'
+                )
+            ),
+            'patterns': list(
+                State.objects.exclude(feedback_pattern='').order_by('id').values_list(
+                    'id', 'state_set_id', 'state_set__device_id', 'feedback_pattern'
+                )
+            ),
+        }
+
+
+def read_feedback(snapshot=None):
+    """
+    load_feedback() from ``snapshot`` if given, or from the database.
+    """
+    if snapshot is not None:
+        return read_snapshot(snapshot)['feedback']
+    return load_feedback()
+
+
+class FeedbackPoller(object):
+    """
+    Keeps the dispatcher's StateSets in line with what the devices report.
+    Each StateSet with a StateQuery is polled through its device's transport
+    on the poller's own scheduler thread, and a response that matches one of
+    its States' feedback patterns makes that State active. Lines a TCP device
+    sends on its own are matched too, so devices that announce their changes
+    need little polling.
+    """
+
+    def __init__(self, dispatcher, timeout=1.0, scheduler=None):
+        self.dispatcher = dispatcher
+        self.timeout = timeout
+        self.scheduler = scheduler or Scheduler(dispatcher.metrics)
+        self.polled = {}
+        self.patterns = {}
+        self.subscriptions = {}
+        self._lock = Lock()
+
+    def load(self):
+        graph = read_feedback(self.dispatcher.snapshot)
+        patterns = {}
+        subscriptions = {}
+        for state_id, state_set_id, device_id, pattern in graph['patterns']:
+            try:
+                patterns.setdefault(state_set_id, []).append((state_id, re.compile(pattern)))
+            except re.error as error:
+                LOGGER.error('Ignoring invalid feedback pattern %r for state %s: %s', pattern, state_id, error)
+                continue
+            subscriptions.setdefault(device_id, set()).add(state_set_id)
+        with self._lock:
+            for polled in self.polled.values():
+                if polled.timer is not None:
+                    polled.timer.cancel()
+            self.patterns = patterns
+            self.subscriptions = subscriptions
+            self.polled = {}
+            for position, row in enumerate(graph['queries']):
+                polled = self.polled[row[0]] = PolledStateSet(*row)
+                self.schedule(polled, position * STAGGER)
+
+    def start(self, tcp_pool=None):
+        self.load()
+        if tcp_pool is not None:
+            tcp_pool.response_handlers.append(self.tcp_response)
+
+    def reload(self, plan=None):
+        try:
+            self.load()
+        except Exception:
+            LOGGER.exception('Failed to reload state queries; keeping the previous ones.')
+
+    def stop(self):
+        self.scheduler.stop()
+
+    def schedule(self, polled, delay):
+        """
+        (Re)schedule the next poll of ``polled``. Must be called with the
+        poller's lock held.
+        """
+        if polled.timer is not None:
+            polled.timer.cancel()
+        polled.timer = self.scheduler.call_later(delay, self.poll, polled, label='feedback')
+
+    def poll(self, polled):
+        with self._lock:
+            if self.polled.get(polled.state_set) is not polled:
+                return
+        changed = False
+        transport = self.dispatcher.devices.get(polled.device, polled.command_type)
+        try:
+            if transport is None:
+                raise NotImplementedError('Device {} has no {} configuration.'.format(polled.device, polled.command_type))
+            lines = transport.query(polled.data, self.timeout)
+        except Exception as error:
+            LOGGER.warning('Polling state set %s failed: %s', polled.state_set, error)
+        else:
+            log_event(LOGGER, DEBUG, 'state.polled', state_set=polled.state_set, response=lines)
+            changed = self.reconcile(polled.state_set, lines)
+        with self._lock:
+            if self.polled.get(polled.state_set) is polled:
+                polled.interval = polled.min_interval if changed else min(polled.interval * 2, polled.max_interval)
+                self.schedule(polled, polled.interval)
+
+    def match(self, state_set_id, lines):
+        for state_id, pattern in self.patterns.get(state_set_id, ()):
+            if any(pattern.search(line) for line in lines):
+                return state_id
+
+    def reconcile(self, state_set_id, lines):
+        state_id = self.match(state_set_id, lines)
+        return state_id is not None and self.dispatcher.reconcile(state_id)
+
+    def expect(self, changes):
+        """
+        Called by the dispatcher with {state_set_id: state_id} when it has
+        assumed a change, so that the device is asked soon whether it
+        happened.
+        """
+        with self._lock:
+            for state_set_id in changes:
+                polled = self.polled.get(state_set_id)
+                if polled is not None:
+                    polled.interval = polled.min_interval
+                    self.schedule(polled, polled.min_interval)
+
+    def tcp_response(self, host, port, line):
+        """
+        TcpConnectionPool response handler. It runs with the connection
+        locked, so reconciling is left to the poller's thread.
+        """
+        for device_id, state_set_ids in self.subscriptions.items():
+            transport = self.dispatcher.devices.get(device_id, 'tcp')
+            if transport is None or tuple(transport.config[:2]) != (host, port):
+                continue
+            for state_set_id in state_set_ids:
+                if self.match(state_set_id, [line]) is not None:
+                    self.scheduler.call_later(0, self.reconcile, state_set_id, [line], label='feedback')
@@ -0,0 +1,103 @@
+from logging import getLogger
+
+from django.db.models import Prefetch
+
+from systemstate.models import (
+    RemoteButton,
+    Command,
+    Condition,
+    State,
+)
+
+LOGGER = getLogger(__name__)
+
+CONFIG_FIELDS = [
+    'device__cec_config',
+    'device__tcp_config',
+    'device__serial_config',
+    'device__irsend_config',
+]
+
+
+def load_conditions(condition_ids):
+    """
+    The Conditions in ``condition_ids`` and every condition nested in them,
+    with their states, keyed by id. Each condition's ``loaded_states`` and
+    ``loaded_nested_conditions`` hold what Condition.met() needs, with nested
+    conditions pointing at the same instances, so that it can recurse to any
+    depth without another query. Takes one query per level of nesting, plus
+    two.
+    """
+    nested_ids = {}
+    frontier = set(condition_ids)
+    while frontier:
+        for condition_id in frontier:
+            nested_ids[condition_id] = []
+        rows = list(Condition.nested_conditions.through.objects.filter(
+            from_condition_id__in=frontier,
+        ).order_by('id').values_list('from_condition_id', 'to_condition_id'))
+        for from_id, to_id in rows:
+            nested_ids[from_id].append(to_id)
+        frontier = {to_id for _, to_id in rows} - set(nested_ids)
+    conditions = {
+        condition.pk: condition for condition in Condition.objects.filter(pk__in=nested_ids).prefetch_related(
+            Prefetch('states', queryset=State.objects.select_related('state_set'), to_attr='loaded_states'),
+        )
+    }
+    for condition in conditions.values():
+        condition.loaded_nested_conditions = [conditions[pk] for pk in nested_ids[condition.pk]]
+    return conditions
+
+
+def load_button(lirc_code):
+    """
+    Fetch the RemoteButton for ``lirc_code`` together with everything its
+    execute() touches: macros, commands, devices and their configs, side
+    effects, and the conditions they use. Takes the same number of queries
+    however many macros the button has. Raises RemoteButton.DoesNotExist.
+    """
+    button = RemoteButton.objects.prefetch_related(
+        'macros',
+        Prefetch('macros__commands', queryset=Command.objects.select_related(*CONFIG_FIELDS)),
+        Prefetch('macros__side_effects__states', queryset=State.objects.select_related('state_set')),
+    ).get(lirc_code=lirc_code)
+    condition_ids = set()
+    for macro in button.macros.all():
+        condition_ids.add(macro.condition_id)
+        condition_ids.update(command.condition_id for command in macro.commands.all())
+    condition_ids.discard(None)
+    conditions = load_conditions(condition_ids)
+
+    # Share one StateSet instance per id, so that a state activated by a side
+    # effect is seen by every condition that reads it.
+    state_sets = {}
+
+    def share_state_set(state):
+        state.state_set = state_sets.setdefault(state.state_set_id, state.state_set)
+
+    for condition in conditions.values():
+        for state in condition.loaded_states:
+            share_state_set(state)
+    for macro in button.macros.all():
+        if macro.condition_id is not None:
+            macro.condition = conditions[macro.condition_id]
+        for command in macro.commands.all():
+            if command.condition_id is not None:
+                command.condition = conditions[command.condition_id]
+        for side_effect in macro.side_effects.all():
+            for state in side_effect.states.all():
+                share_state_set(state)
+    return button
+
+
+def execute_button(lirc_code):
+    """
+    Run a button through the ORM execution path, as RemoteButton.execute().
+    """
+    try:
+        button = load_button(lirc_code)
+    except RemoteButton.DoesNotExist:
+        LOGGER.warning('Did not find handler for remote button with code %s.', lirc_code)
+        return False
+    button.execute()
+    return True
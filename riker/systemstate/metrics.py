@@ -0,0 +1,134 @@
+import json
+import os
+from collections import deque
+from contextlib import contextmanager
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+LOGGER = getLogger(__name__)
+
+# Stages of a keypress, in the order they happen.
+STAGES = [
+    'receive',
+    'lookup',
+    'conditions',
+    'scheduler',
+    'queue',
+    'send',
+    'side_effects',
+    'press',
+]
+
+
+class Histogram(object):
+    """
+    Latency samples in seconds. Percentiles are computed over the most recent
+    ``size`` samples; count, total and max cover every sample.
+    """
+
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, ordered, fraction):
+        if not ordered:
+            return 0.0
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(ordered, 0.50),
+            'p95': self.percentile(ordered, 0.95),
+            'p99': self.percentile(ordered, 0.99),
+            'max': self.max,
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Histograms keyed by stage and by a label within the stage: the button code
+    for per-press stages and the device id for per-command stages.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = Lock()
+        self._stopped = Event()
+
+    def observe(self, stage, label, seconds):
+        key = (stage, str(label))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage, label):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, label, monotonic() - start)
+
+    def snapshot(self):
+        with self._lock:
+            items = [(key, histogram.summary()) for key, histogram in self.histograms.items()]
+        stages = {}
+        for (stage, label), summary in items:
+            stages.setdefault(stage, {})[label] = summary
+        return {'time': time(), 'pid': os.getpid(), 'stages': stages}
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+    def write_snapshot(self, path):
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'w') as snapshot:
+            json.dump(self.snapshot(), snapshot)
+        os.replace(temporary_path, path)
+
+    def publish(self, path, interval):
+        """
+        Write a snapshot to ``path`` every ``interval`` seconds so that other
+        processes (the web server, management commands) can read it.
+        """
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.write_snapshot(path)
+                except OSError:
+                    LOGGER.exception('Could not write metrics to %s.', path)
+
+        self._stopped.clear()
+        thread = Thread(target=run, name='riker-metrics', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as snapshot:
+            return json.load(snapshot)
+    except (OSError, ValueError):
+        return None
+
+
+METRICS = MetricsRegistry()
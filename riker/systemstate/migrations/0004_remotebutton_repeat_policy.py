@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('systemstate', '0003_condition_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remotebutton',
+            name='max_rate',
+            field=models.FloatField(blank=True, help_text='Maximum number of times per second this button is acted on.', null=True),
+        ),
+        migrations.AddField(
+            model_name='remotebutton',
+            name='repeat_coalesce',
+            field=models.PositiveIntegerField(default=2, help_text='After the delay, act on one of every this many repeat events.'),
+        ),
+        migrations.AddField(
+            model_name='remotebutton',
+            name='repeat_delay',
+            field=models.PositiveIntegerField(default=3, help_text='Number of repeat events to ignore after the initial press.'),
+        ),
+        migrations.AddField(
+            model_name='remotebutton',
+            name='repeat_mode',
+            field=models.CharField(choices=[('repeat', 'Repeat'), ('once', 'Once per press'), ('held', 'Repeat only while held')], default='repeat', max_length=6),
+        ),
+    ]
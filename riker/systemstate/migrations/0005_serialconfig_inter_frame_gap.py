@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('systemstate', '0004_remotebutton_repeat_policy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serialconfig',
+            name='inter_frame_gap',
+            field=models.PositiveIntegerField(default=0, help_text='Milliseconds to wait between frames; 0 allows back-to-back frames to be sent in one write.'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('systemstate', '0005_serialconfig_inter_frame_gap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='command',
+            name='delay',
+            field=models.PositiveIntegerField(default=0, help_text='Milliseconds to wait after the previous command in the macro before sending this one.'),
+        ),
+        migrations.AddField(
+            model_name='command',
+            name='wait_timeout',
+            field=models.PositiveIntegerField(default=10000, help_text='Milliseconds to wait for the state before sending anyway.'),
+        ),
+        migrations.AddField(
+            model_name='command',
+            name='wait_until',
+            field=models.ForeignKey(blank=True, help_text='Before sending, wait until this state is active.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='systemstate.State'),
+        ),
+    ]
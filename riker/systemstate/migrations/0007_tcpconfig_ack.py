@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import systemstate.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('systemstate', '0006_command_timing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tcpconfig',
+            name='ack_pattern',
+            field=models.CharField(blank=True, default='', help_text='Regular expression for the response line that acknowledges a command. When set, each command waits for it before the next is sent.', max_length=255, validators=[systemstate.models.validate_pattern]),
+        ),
+        migrations.AddField(
+            model_name='tcpconfig',
+            name='ack_timeout',
+            field=models.PositiveIntegerField(default=1000, help_text='Milliseconds to wait for the acknowledgement.'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import systemstate.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('systemstate', '0007_tcpconfig_ack'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateQuery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command_type', models.CharField(choices=[('tcp', 'TCP'), ('cec', 'CEC power status'), ('serial', 'Serial')], max_length=255)),
+                ('data', models.CharField(blank=True, help_text='The query command. Not used for CEC, which asks for the power status.', max_length=255)),
+                ('min_interval', models.PositiveIntegerField(default=5, help_text='Seconds between polls after the state has changed.')),
+                ('max_interval', models.PositiveIntegerField(default=300, help_text='Seconds between polls once the state has been stable for a while.')),
+                ('state_set', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='query', to='systemstate.StateSet')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='state',
+            name='feedback_pattern',
+            field=models.CharField(blank=True, default='', help_text='Regular expression for the device response that means this state is active.', max_length=255, validators=[systemstate.models.validate_pattern]),
+        ),
+    ]
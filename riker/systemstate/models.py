@@ -1,6 +1,10 @@
-from logging import getLogger
+import re
+from collections import OrderedDict
+from logging import DEBUG, getLogger
 
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 
 from commands.utils import(
     send_cec_command,
@@ -9,25 +13,82 @@ from commands.utils import(
     send_tcp_command,
 )
 
+from riker.logutils import log_event
+
 LOGGER = getLogger(__name__)
 
+# How the side effects of a press are applied: 'net' writes only the last
+# state each StateSet is given, in one transaction; 'sequential' runs every
+# StateSideEffect in order, saving each state as it goes.
+NET_SIDE_EFFECTS = 'net'
+SEQUENTIAL_SIDE_EFFECTS = 'sequential'
+
+
+def net_side_effects(effects):
+    """
+    The states left active after running ``effects`` in order, one per
+    StateSet.
+    """
+    states = OrderedDict()
+    for effect in effects:
+        for state in effect.states.all():
+            states[state.state_set_id] = state
+            states.move_to_end(state.state_set_id)
+    return list(states.values())
+
+
+def validate_pattern(value):
+    try:
+        re.compile(value)
+    except re.error as error:
+        raise ValidationError('Not a valid regular expression: {}'.format(error))
+
 
 class RemoteButton(models.Model):
 
+    REPEAT_MODES = [
+        ('repeat', 'Repeat'),
+        ('once', 'Once per press'),
+        ('held', 'Repeat only while held'),
+    ]
+
     lirc_code = models.CharField(
         unique=True,
         max_length=255,
     )
+    repeat_mode = models.CharField(
+        max_length=6,
+        choices=REPEAT_MODES,
+        default='repeat',
+    )
+    repeat_delay = models.PositiveIntegerField(
+        default=3,
+        help_text='Number of repeat events to ignore after the initial press.',
+    )
+    repeat_coalesce = models.PositiveIntegerField(
+        default=2,
+        help_text='After the delay, act on one of every this many repeat events.',
+    )
+    max_rate = models.FloatField(
+        null=True,
+        blank=True,
+        help_text='Maximum number of times per second this button is acted on.',
+    )
 
     def execute(self):
         effects = []
-        LOGGER.warning('Executing macros: {}'.format(self.macros.all()))
+        log_event(LOGGER, DEBUG, 'button.execute', button=self.lirc_code)
         for command in self.macros.all():
             side_effects = command.execute()
             if side_effects is not None:
                 effects += side_effects
-        for effect in effects:
-            effect.execute()
+        if settings.RIKER_SIDE_EFFECT_MODE == SEQUENTIAL_SIDE_EFFECTS:
+            for effect in effects:
+                effect.execute()
+            return
+        with transaction.atomic():
+            for state in net_side_effects(effects):
+                state.activate()
 
     def __repr__(self):
         return self.lirc_code
@@ -59,6 +120,21 @@ class Command(models.Model):
         blank=True,
         max_length=255,
     )
+    delay = models.PositiveIntegerField(
+        default=0,
+        help_text='Milliseconds to wait after the previous command in the macro before sending this one.',
+    )
+    wait_until = models.ForeignKey(
+        'State',
+        related_name='+',
+        null=True,
+        blank=True,
+        help_text='Before sending, wait until this state is active.',
+    )
+    wait_timeout = models.PositiveIntegerField(
+        default=10000,
+        help_text='Milliseconds to wait for the state before sending anyway.',
+    )
 
     def execute(self):
         handler = self.device.get_handler(self.command_type)
@@ -90,10 +166,10 @@ class CommandSet(models.Model):
 
     def execute(self):
         if self.condition is not None and not self.condition.met():
-            LOGGER.warning('Conditions for {} were not met.'.format(self))
+            log_event(LOGGER, DEBUG, 'macro.skipped', macro=self.name)
             return None
         for command in self.commands.all():
-            LOGGER.warning('Conditions for {} were met. Executing command {}.'.format(self, command))
+            log_event(LOGGER, DEBUG, 'command.execute', macro=self.name, command=command.pk)
             command.execute()
         return list(self.side_effects.all())
 
@@ -125,8 +201,14 @@ class Condition(models.Model):
             check_method = any
         else:
             check_method = all
-        states_met = check_method(x.is_active() for x in self.states.all())
-        nested_conditions_met = check_method(x.met() for x in self.nested_conditions.all())
+        # systemstate.loader attaches the states and nested conditions it
+        # fetched up front.
+        if hasattr(self, 'loaded_states'):
+            states, nested_conditions = self.loaded_states, self.loaded_nested_conditions
+        else:
+            states, nested_conditions = self.states.all(), self.nested_conditions.all()
+        states_met = check_method(x.is_active() for x in states)
+        nested_conditions_met = check_method(x.met() for x in nested_conditions)
         return check_method([states_met, nested_conditions_met])
 
     def __repr__(self):
@@ -160,13 +242,22 @@ class State(models.Model):
     state_set = models.ForeignKey(
         'StateSet',
     )
+    feedback_pattern = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        validators=[validate_pattern],
+        help_text='Regular expression for the device response that means this state is active.',
+    )
 
     def is_active(self):
-        return self == self.state_set.status
+        return self.state_set.status_id == self.pk
 
     def activate(self):
+        # An update() rather than save(), so that a press doesn't look like a
+        # configuration change to the post_save receivers in signals.py.
         self.state_set.status = self
-        self.state_set.save()
+        StateSet.objects.filter(pk=self.state_set_id).update(status=self)
 
     def __repr__(self):
         return self.name
@@ -175,6 +266,47 @@ class State(models.Model):
         return self.__repr__()
 
 
+class StateQuery(models.Model):
+    """
+    How to ask a device which of a StateSet's states it is really in. The
+    response is matched against each State's feedback pattern.
+    """
+
+    QUERY_TYPES = [
+        ('tcp', 'TCP'),
+        ('cec', 'CEC power status'),
+        ('serial', 'Serial'),
+    ]
+
+    state_set = models.OneToOneField(
+        'StateSet',
+        related_name='query',
+    )
+    command_type = models.CharField(
+        max_length=255,
+        choices=QUERY_TYPES,
+    )
+    data = models.CharField(
+        max_length=255,
+        blank=True,
+        help_text='The query command. Not used for CEC, which asks for the power status.',
+    )
+    min_interval = models.PositiveIntegerField(
+        default=5,
+        help_text='Seconds between polls after the state has changed.',
+    )
+    max_interval = models.PositiveIntegerField(
+        default=300,
+        help_text='Seconds between polls once the state has been stable for a while.',
+    )
+
+    def __repr__(self):
+        return 'Query for {}'.format(self.state_set.name)
+
+    def __str__(self):
+        return self.__repr__()
+
+
 class StateSideEffect(models.Model):
     commands = models.ForeignKey(
         'CommandSet',
@@ -244,12 +376,13 @@ class CecConfig(models.Model):
     target_address = models.PositiveIntegerField()
 
     def handler(self, command):
-        LOGGER.warning(
-            'Sending CEC command {} from {} to {}.'.format(
-                command,
-                self.source_address,
-                self.target_address,
-            )
+        log_event(
+            LOGGER,
+            DEBUG,
+            'cec.send',
+            command=command,
+            source=self.source_address,
+            target=self.target_address,
         )
         send_cec_command(
             self.source_address,
@@ -270,22 +403,19 @@ class SerialConfig(models.Model):
     baud_rate = models.PositiveIntegerField()
     byte_size = models.PositiveIntegerField()
     timeout = models.PositiveIntegerField()
+    inter_frame_gap = models.PositiveIntegerField(
+        default=0,
+        help_text='Milliseconds to wait between frames; 0 allows back-to-back frames to be sent in one write.',
+    )
 
     def handler(self, command):
-        LOGGER.warning(
-            'Sending serial command "{}" on port {} with byte size {}, baud rate {}, and timeout {}.'.format(
-                command,
-                self.port_name,
-                self.byte_size,
-                self.baud_rate,
-                self.timeout,
-            )
-        )
+        log_event(LOGGER, DEBUG, 'serial.send', command=command, port=self.port_name)
         send_serial_command(
             self.port_name,
             self.baud_rate,
             self.byte_size,
             self.timeout,
+            self.inter_frame_gap / 1000.0,
             command,
         )
 
@@ -300,16 +430,31 @@ class TcpConfig(models.Model):
 
     host = models.CharField(max_length=255)
     port = models.PositiveIntegerField()
+    ack_pattern = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        validators=[validate_pattern],
+        help_text='Regular expression for the response line that acknowledges a command. '
+                  'When set, each command waits for it before the next is sent.',
+    )
+    ack_timeout = models.PositiveIntegerField(
+        default=1000,
+        help_text='Milliseconds to wait for the acknowledgement.',
+    )
 
     def handler(self, command):
-        LOGGER.warning(
-            'Sending TCP command "{}" to host {} on port number {}.'.format(
-                command,
+        log_event(LOGGER, DEBUG, 'tcp.send', command=command, host=self.host, port=self.port)
+        if self.ack_pattern:
+            send_tcp_command(
                 self.host,
                 self.port,
+                command,
+                ack_pattern=re.compile(self.ack_pattern),
+                ack_timeout=self.ack_timeout / 1000.0,
             )
-        )
-        send_tcp_command(self.host, self.port, command)
+        else:
+            send_tcp_command(self.host, self.port, command)
 
     def __repr__(self):
         return 'TCP config' +  (' for {}'.format(self.device) if hasattr(self, 'device') else '')
@@ -323,9 +468,7 @@ class IrsendConfig(models.Model):
     remote_name = models.CharField(max_length=255)
 
     def handler(self, command):
-        LOGGER.warning(
-            'Sending IR command "{}" with remote "{}".'.format(command, self.remote_name)
-        )
+        log_event(LOGGER, DEBUG, 'infrared.send', command=command, remote=self.remote_name)
         send_infrared_command(self.remote_name, command)
 
     def __repr__(self):
@@ -0,0 +1,147 @@
+import json
+import os
+import socket
+from logging import getLogger
+from threading import Thread
+from time import monotonic
+
+from django.conf import settings
+from django.db import close_old_connections
+
+LOGGER = getLogger(__name__)
+
+# Datagrams that arrive within this many seconds of each other are applied as
+# one change, so that an admin save touching several rows reloads once.
+DEBOUNCE = 0.05
+
+
+def notify(kind, pk=None, path=None):
+    """
+    Tell a running listener that configuration changed. ``kind`` is 'plan'
+    for anything that needs the dispatch plan rebuilt, or 'device' with the
+    device's ``pk`` when only its transport configuration changed. Does
+    nothing if no listener is bound to the socket.
+    """
+    path = path or settings.RIKER_NOTIFY_SOCKET
+    message = json.dumps({'kind': kind, 'id': pk}).encode('ascii')
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sender.setblocking(False)
+        sender.sendto(message, path)
+    except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+        pass
+    finally:
+        sender.close()
+
+
+class ChangeListener(Thread):
+    """
+    Receives change notifications on a Unix datagram socket and applies them
+    to ``dispatcher`` off the input path: a plan change recompiles the plan
+    and calls ``on_reload(plan)``, a device change rebinds that device's
+    transports only.
+
+    With ``loop``, changes are applied on that event loop's thread instead,
+    since asyncio transports and timers must only be touched from there.
+    """
+
+    def __init__(self, dispatcher, path=None, on_reload=None, debounce=DEBOUNCE, loop=None):
+        self.dispatcher = dispatcher
+        self.loop = loop
+        self.path = path or settings.RIKER_NOTIFY_SOCKET
+        self.on_reload = on_reload
+        self.debounce = debounce
+        self.socket = None
+        super(ChangeListener, self).__init__(name='riker-notify', daemon=True)
+
+    def bind(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+
+    def start(self):
+        self.bind()
+        super(ChangeListener, self).start()
+
+    def stop(self):
+        notify('stop', path=self.path)
+        self.join()
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def receive(self, timeout=None):
+        self.socket.settimeout(timeout)
+        try:
+            message = json.loads(self.socket.recv(4096).decode('ascii'))
+        except socket.timeout:
+            return None
+        except ValueError:
+            LOGGER.warning('Ignoring malformed change notification.')
+            return {}
+        return message
+
+    def collect(self):
+        """
+        Wait for a notification, then gather any that follow within the
+        debounce window. Returns (plan changed, changed device ids), or None
+        when asked to stop.
+        """
+        messages = [self.receive()]
+        deadline = monotonic() + self.debounce
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            message = self.receive(remaining)
+            if message is None:
+                break
+            messages.append(message)
+        if any(message.get('kind') == 'stop' for message in messages):
+            return None
+        plan_changed = any(message.get('kind') == 'plan' for message in messages)
+        devices = {message['id'] for message in messages if message.get('kind') == 'device'}
+        return plan_changed, devices
+
+    def apply(self, plan_changed, devices):
+        start = monotonic()
+        close_old_connections()
+        if plan_changed:
+            self.dispatcher.reload()
+            if self.on_reload is not None:
+                self.on_reload(self.dispatcher.plan)
+        else:
+            for device_id in devices:
+                self.dispatcher.refresh_device(device_id)
+        LOGGER.info(
+            'Applied configuration change (plan: %s, devices: %s) in %.1f ms.',
+            plan_changed,
+            sorted(devices),
+            (monotonic() - start) * 1000,
+        )
+
+    def try_apply(self, plan_changed, devices):
+        try:
+            self.apply(plan_changed, devices)
+        except Exception:
+            LOGGER.exception('Failed to apply configuration change.')
+
+    def run(self):
+        try:
+            while True:
+                changes = self.collect()
+                if changes is None:
+                    return
+                if self.loop is None:
+                    self.try_apply(*changes)
+                else:
+                    self.loop.call_soon_threadsafe(self.try_apply, *changes)
+        finally:
+            self.close()
@@ -0,0 +1,78 @@
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+
+RepeatPolicy = namedtuple('RepeatPolicy', ['mode', 'delay', 'coalesce', 'min_interval'])
+
+DEFAULT_POLICY = RepeatPolicy('repeat', 3, 2, 0)
+
+# Inputs that can't report repeat counts (python-lirc) are treated as
+# repeating when the same code arrives again within this many seconds.
+REPEAT_GAP = 0.25
+
+# In "held" mode, a repeat that waited longer than this before reaching the
+# dispatcher belongs to a button that has most likely been released.
+HELD_TIMEOUT = 0.25
+
+
+def compile_policy(mode, delay, coalesce, max_rate):
+    return RepeatPolicy(
+        mode,
+        delay,
+        max(coalesce, 1),
+        1.0 / max_rate if max_rate else 0,
+    )
+
+
+class RepeatLimiter(object):
+    """
+    Applies each button's RepeatPolicy to incoming events and counts what it
+    lets through. Every event is tallied as ``executed``, ``merged`` (absorbed
+    by the delay or coalescing) or ``dropped`` (once mode, stale in held mode,
+    or over the rate limit).
+    """
+
+    def __init__(self, repeat_gap=REPEAT_GAP, held_timeout=HELD_TIMEOUT):
+        self.repeat_gap = repeat_gap
+        self.held_timeout = held_timeout
+        self.counters = {}
+        self._last_event = (None, 0, 0)
+        self._last_executed = {}
+        self._lock = Lock()
+
+    def count(self, code, outcome):
+        counters = self.counters.get(code)
+        if counters is None:
+            counters = self.counters[code] = {'executed': 0, 'merged': 0, 'dropped': 0}
+        counters[outcome] += 1
+
+    def infer_repeat(self, code, received):
+        last_code, last_received, last_repeat = self._last_event
+        if code == last_code and received - last_received <= self.repeat_gap:
+            return last_repeat + 1
+        return 0
+
+    def allow(self, code, policy, repeat=None, received=None):
+        now = monotonic()
+        received = now if received is None else received
+        with self._lock:
+            if repeat is None:
+                repeat = self.infer_repeat(code, received)
+            self._last_event = (code, received, repeat)
+            outcome = self.classify(code, policy, repeat, received, now)
+            if outcome == 'executed':
+                self._last_executed[code] = now
+            self.count(code, outcome)
+        return outcome == 'executed'
+
+    def classify(self, code, policy, repeat, received, now):
+        if repeat:
+            if policy.mode == 'once':
+                return 'dropped'
+            if policy.mode == 'held' and now - received > self.held_timeout:
+                return 'dropped'
+            if repeat <= policy.delay or (repeat - policy.delay) % policy.coalesce:
+                return 'merged'
+        if policy.min_interval and now - self._last_executed.get(code, -policy.min_interval) < policy.min_interval:
+            return 'dropped'
+        return 'executed'
@@ -0,0 +1,163 @@
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from logging import getLogger
+from threading import Condition, Thread
+from time import monotonic
+
+from systemstate.metrics import METRICS
+
+LOGGER = getLogger(__name__)
+
+# What a press does to in-flight sequences that send to the same devices.
+SUPERSEDE_SEQUENCES = 'supersede'
+CONCURRENT_SEQUENCES = 'concurrent'
+
+SEQUENCE_POLICIES = (SUPERSEDE_SEQUENCES, CONCURRENT_SEQUENCES)
+
+
+class Timer(object):
+
+    __slots__ = ('due', 'callback', 'args', 'label', 'cancelled')
+
+    def __init__(self, due, callback, args, label):
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.label = label
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Runs callbacks after a delay on one background thread, ordered by a heap
+    of due times, so that waiting never blocks the caller. How late each
+    callback runs is recorded as the 'scheduler' stage.
+    """
+
+    def __init__(self, metrics=METRICS):
+        self.metrics = metrics
+        self._heap = []
+        self._order = count()
+        self._condition = Condition()
+        self._thread = None
+        self._stopping = False
+
+    def call_later(self, delay, callback, *args, label=None):
+        timer = Timer(monotonic() + delay, callback, args, label)
+        with self._condition:
+            heappush(self._heap, (timer.due, next(self._order), timer))
+            if self._thread is None:
+                self._stopping = False
+                self._thread = Thread(target=self.run, name='riker-scheduler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return timer
+
+    def next_timer(self):
+        with self._condition:
+            while not self._stopping:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                remaining = self._heap[0][0] - monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                return heappop(self._heap)[2]
+
+    def run(self):
+        while True:
+            timer = self.next_timer()
+            if timer is None:
+                return
+            if timer.cancelled:
+                continue
+            self.metrics.observe('scheduler', timer.label, monotonic() - timer.due)
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                LOGGER.exception('Scheduled callback for %s failed.', timer.label)
+
+    def stop(self):
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._heap = []
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+
+
+class LoopScheduler(object):
+    """
+    The asyncio counterpart of Scheduler: callbacks run on ``loop``, so that
+    they may submit to an AsyncCommandExecutor. call_later() must be called
+    from the loop's thread.
+    """
+
+    def __init__(self, loop, metrics=METRICS):
+        self.loop = loop
+        self.metrics = metrics
+
+    def call_later(self, delay, callback, *args, label=None):
+        due = self.loop.time() + delay
+
+        def run():
+            self.metrics.observe('scheduler', label, self.loop.time() - due)
+            try:
+                callback(*args)
+            except Exception:
+                LOGGER.exception('Scheduled callback for %s failed.', label)
+
+        return self.loop.call_at(due, run)
+
+    def stop(self):
+        pass
+
+
+class Sequence(object):
+    """
+    The remaining steps of one macro run. Each step may wait ``delay``
+    seconds after the step before it, and then for ``wait_until`` to become
+    active, for at most ``wait_timeout`` seconds. ``completion``, if given,
+    is held open until the sequence finishes or is cancelled.
+    """
+
+    def __init__(self, label, press, steps, completion=None):
+        self.label = label
+        self.press = press
+        self.completion = completion
+        if completion is not None:
+            completion.add()
+        self.steps = deque(steps)
+        self.devices = {step.device for step in steps}
+        self.timer = None
+        self.delayed = False
+        self.waiting = False
+        self.timed_out = False
+        self.cancelled = False
+
+    def next_step(self):
+        """
+        Mark the current step as sent and reset the per-step flags.
+        """
+        self.steps.popleft()
+        self.delayed = self.waiting = self.timed_out = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def finish(self, error=None):
+        completion, self.completion = self.completion, None
+        if completion is not None:
+            completion.done(error)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.finish('cancelled')
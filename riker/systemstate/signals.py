@@ -0,0 +1,126 @@
+from logging import getLogger
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from systemstate.dispatch import DISPATCHER
+from systemstate.notify import notify
+from systemstate.snapshot import export_snapshot
+from systemstate.models import (
+    RemoteButton,
+    Command,
+    CommandSet,
+    Condition,
+    StateSet,
+    State,
+    StateQuery,
+    StateSideEffect,
+    Device,
+    IrsendConfig,
+    CecConfig,
+    SerialConfig,
+    TcpConfig,
+)
+
+LOGGER = getLogger(__name__)
+
+PLAN_MODELS = [
+    RemoteButton,
+    Command,
+    CommandSet,
+    Condition,
+    StateSet,
+    State,
+    StateQuery,
+    StateSideEffect,
+    Device,
+]
+
+CONFIG_MODELS = [
+    IrsendConfig,
+    CecConfig,
+    SerialConfig,
+    TcpConfig,
+]
+
+PLAN_RELATIONS = [
+    Condition.states.through,
+    Condition.nested_conditions.through,
+    StateSideEffect.states.through,
+]
+
+
+# Only the web process, where the admin edits the configuration, replaces the
+# snapshot and notifies the listener; see riker/wsgi.py. Other processes that
+# write to the database, like the benchmarks, must leave the listener alone.
+PUBLISH = False
+
+
+def publish_changes(enabled=True):
+    global PUBLISH
+    PUBLISH = enabled
+
+
+def publish_snapshot():
+    """
+    Replace the listener's snapshot before notifying it, so that it reloads
+    from the new one.
+    """
+    if not settings.RIKER_SNAPSHOT_FILE:
+        return
+    try:
+        export_snapshot(settings.RIKER_SNAPSHOT_FILE)
+    except Exception:
+        LOGGER.exception('Failed to export the configuration snapshot to %s.', settings.RIKER_SNAPSHOT_FILE)
+
+
+def plan_changed():
+    DISPATCHER.reload()
+    if PUBLISH:
+        publish_snapshot()
+        notify('plan')
+
+
+def device_changed(device_id):
+    DISPATCHER.refresh_device(device_id)
+    if PUBLISH:
+        publish_snapshot()
+        notify('device', device_id)
+
+
+def rebuild_dispatch_plan(sender, **kwargs):
+    transaction.on_commit(plan_changed)
+
+
+def refresh_device_transport(sender, instance, **kwargs):
+    try:
+        device_id = instance.device.pk
+    except Device.DoesNotExist:
+        return
+    transaction.on_commit(lambda: device_changed(device_id))
+
+
+def receivers():
+    for model in CONFIG_MODELS:
+        yield post_save, refresh_device_transport, model, 'refresh_device_save_{}'.format(model.__name__)
+        yield post_delete, rebuild_dispatch_plan, model, 'rebuild_plan_delete_{}'.format(model.__name__)
+    for model in PLAN_MODELS:
+        yield post_save, rebuild_dispatch_plan, model, 'rebuild_plan_save_{}'.format(model.__name__)
+        yield post_delete, rebuild_dispatch_plan, model, 'rebuild_plan_delete_{}'.format(model.__name__)
+    for through in PLAN_RELATIONS:
+        yield m2m_changed, rebuild_dispatch_plan, through, 'rebuild_plan_m2m_{}'.format(through.__name__)
+
+
+def connect_signals():
+    for signal, receiver, sender, dispatch_uid in receivers():
+        signal.connect(receiver, sender=sender, dispatch_uid=dispatch_uid)
+
+
+def disconnect_signals():
+    """
+    Stop reacting to configuration changes, e.g. while seeding a throwaway
+    database.
+    """
+    for signal, receiver, sender, dispatch_uid in receivers():
+        signal.disconnect(receiver, sender=sender, dispatch_uid=dispatch_uid)
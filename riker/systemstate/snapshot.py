@@ -0,0 +1,120 @@
+"""
+Compiled configuration snapshots: every row the listener reads, in one file,
+so that it can run without a database connection.
+
+A snapshot is a fixed header (magic, format version, encoding) followed by the
+payload, encoded with msgpack when it is installed and JSON otherwise.
+"""
+import json
+import os
+import struct
+import time
+
+from django.db import transaction
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = b'RIKERSNP'
+
+# Bump this whenever load_graph() or load_feedback() change the rows they
+# return, so that a listener never compiles a snapshot it can't read.
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('>8sHB')
+
+MSGPACK = 'msgpack'
+
+JSON = 'json'
+
+ENCODINGS = {MSGPACK: 1, JSON: 2}
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def default_encoding():
+    return MSGPACK if msgpack is not None else JSON
+
+
+def encode(payload, encoding):
+    if encoding == MSGPACK:
+        if msgpack is None:
+            raise SnapshotError('msgpack is not installed.')
+        return msgpack.packb(payload, use_bin_type=True)
+    if encoding == JSON:
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    raise SnapshotError('Unknown snapshot encoding {!r}.'.format(encoding))
+
+
+def decode(data, encoding):
+    if encoding == MSGPACK:
+        if msgpack is None:
+            raise SnapshotError('The snapshot is msgpack-encoded, but msgpack is not installed.')
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data.decode('utf-8'))
+
+
+def write_snapshot(path, graph, feedback, encoding=None):
+    """
+    Write ``graph`` (from load_graph()) and ``feedback`` (from
+    load_feedback()) to ``path``. The file is replaced atomically, so a
+    listener reading it sees either the old snapshot or the new one.
+    """
+    encoding = encoding or default_encoding()
+    data = encode({'created': time.time(), 'graph': graph, 'feedback': feedback}, encoding)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as snapshot:
+        snapshot.write(HEADER.pack(MAGIC, FORMAT_VERSION, ENCODINGS[encoding]))
+        snapshot.write(data)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary_path, path)
+    return HEADER.size + len(data)
+
+
+def read_snapshot(path):
+    """
+    Return the snapshot at ``path`` as {'created', 'graph', 'feedback'},
+    with every row as a tuple, as load_graph() and load_feedback() give them.
+    """
+    with open(path, 'rb') as snapshot:
+        data = snapshot.read()
+    try:
+        magic, version, encoding_id = HEADER.unpack_from(data)
+    except struct.error:
+        magic = version = encoding_id = None
+    if magic != MAGIC:
+        raise SnapshotError('{} is not a Riker snapshot.'.format(path))
+    if version != FORMAT_VERSION:
+        raise SnapshotError(
+            '{} has snapshot format {}, but this listener reads format {}; export it again.'.format(
+                path, version, FORMAT_VERSION,
+            )
+        )
+    encodings = {value: name for name, value in ENCODINGS.items()}
+    if encoding_id not in encodings:
+        raise SnapshotError('{} has an unknown encoding ({}).'.format(path, encoding_id))
+    payload = decode(data[HEADER.size:], encodings[encoding_id])
+    for section in ('graph', 'feedback'):
+        payload[section] = {
+            name: [tuple(row) for row in rows]
+            for name, rows in payload[section].items()
+        }
+    return payload
+
+
+def export_snapshot(path, encoding=None):
+    """
+    Read the configuration from the database and write it to ``path``.
+    """
+    # Imported here since both modules read snapshots themselves.
+    from systemstate.dispatch import load_graph
+    from systemstate.feedback import load_feedback
+    with transaction.atomic():
+        graph = load_graph()
+        feedback = load_feedback()
+    return write_snapshot(path, graph, feedback, encoding)
@@ -0,0 +1,165 @@
+import json
+import os
+from logging import getLogger
+from threading import Event, Lock, Thread
+
+from django.db import close_old_connections, transaction
+
+from systemstate.models import StateSet
+
+LOGGER = getLogger(__name__)
+
+
+class StateStore(object):
+    """
+    Write-behind persistence for StateSet.status.
+
+    Activations are coalesced per StateSet in memory and appended to a journal
+    immediately; a background thread writes the net changes to the database in
+    a single transaction and then compacts the journal. On start, anything
+    left in the journal by a crash is written back before the plan is loaded.
+
+    Without a database (``database=False``, for a listener running from a
+    snapshot) the journal is the only record, so changes move to ``retained``
+    and stay in the journal instead.
+
+    Until start() is called, or after stop(), changes are journalled and
+    held until the next flush().
+    """
+
+    def __init__(self, journal_path=None, flush_interval=0.5, database=True):
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.database = database
+        self.pending = {}
+        self.inflight = {}
+        self.retained = {}
+        self.lock = Lock()
+        self._journal = None
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.recover()
+        self._stopped.clear()
+        self._thread = Thread(target=self.run, name='riker-state-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def write(self, state_set_id, state_id):
+        self.write_many({state_set_id: state_id})
+
+    def write_many(self, changes):
+        """
+        Record ``changes``, a mapping of StateSet id to State id, as one
+        journal append, to be written by the next flush().
+        """
+        with self.lock:
+            self.pending.update(changes)
+            self.append_journal(changes)
+        if self.running:
+            self._wakeup.set()
+
+    def unflushed(self):
+        """
+        Changes not yet known to be committed, oldest first. Callers reading
+        StateSet rows should hold self.lock and overlay these on top.
+        """
+        changes = dict(self.retained)
+        changes.update(self.inflight)
+        changes.update(self.pending)
+        return changes
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                self._wakeup.wait()
+                self._wakeup.clear()
+                self.flush()
+                self._stopped.wait(self.flush_interval)
+        finally:
+            close_old_connections()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            if not self.database:
+                self.retained.update(self.pending)
+                self.pending = {}
+                self.compact_journal()
+                return
+            self.inflight, self.pending = self.pending, {}
+            if self._journal is not None:
+                os.fsync(self._journal.fileno())
+        try:
+            with transaction.atomic():
+                for state_set_id, state_id in self.inflight.items():
+                    StateSet.objects.filter(pk=state_set_id).update(status=state_id)
+        except Exception:
+            LOGGER.exception('Failed to write state changes %r; will retry.', self.inflight)
+            with self.lock:
+                self.inflight.update(self.pending)
+                self.pending, self.inflight = self.inflight, {}
+            return
+        with self.lock:
+            self.inflight = {}
+            self.compact_journal()
+
+    def recover(self):
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+        recovered = {}
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    state_set_id, state_id = json.loads(line)
+                except ValueError:
+                    LOGGER.warning('Ignoring truncated state journal entry %r.', line)
+                    continue
+                recovered[state_set_id] = state_id
+        LOGGER.info('Recovered %d unflushed state changes from %s.', len(recovered), self.journal_path)
+        with self.lock:
+            recovered.update(self.pending)
+            self.pending = recovered
+        self.flush()
+
+    def append_journal(self, changes):
+        if not self.journal_path:
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        self._journal.write(''.join(
+            json.dumps([state_set_id, state_id]) + '\n' for state_set_id, state_id in changes.items()
+        ))
+        self._journal.flush()
+
+    def compact_journal(self):
+        if not self.journal_path:
+            return
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        changes = dict(self.retained)
+        changes.update(self.pending)
+        temporary_path = self.journal_path + '.tmp'
+        with open(temporary_path, 'w') as journal:
+            for state_set_id, state_id in changes.items():
+                journal.write(json.dumps([state_set_id, state_id]) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary_path, self.journal_path)
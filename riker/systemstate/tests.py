@@ -1,3 +1,889 @@
-from django.test import TestCase
+import asyncio
+import os
+import queue
+import random
+import re
+import shutil
+import tempfile
+from threading import Event, get_ident
+from time import monotonic
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from systemstate.benchmark import FakeTransports, GraphSize, seed_graph
+from systemstate.conditions import evaluate, state_vector
+from systemstate.devices import DeviceRegistry
+from systemstate.dispatch import Dispatcher, compile_plan, load_graph
+from systemstate.executor import AsyncCommandExecutor, CommandExecutor, InlineExecutor
+from systemstate.feedback import FeedbackPoller
+from systemstate.loader import execute_button, load_conditions
+from systemstate.metrics import Histogram, MetricsRegistry
+from systemstate.notify import ChangeListener, notify
+from systemstate.repeat import RepeatLimiter, compile_policy
+from systemstate.scheduler import Scheduler, Timer
+from systemstate import signals
+from systemstate.snapshot import JSON, SnapshotError, export_snapshot, read_snapshot
+from systemstate.statestore import StateStore
+from systemstate.models import (
+    RemoteButton,
+    Command,
+    CommandSet,
+    Condition,
+    StateSet,
+    State,
+    StateQuery,
+    StateSideEffect,
+    Device,
+    TcpConfig,
+)
+
+
+class PowerToggleMixin(object):
+
+    def setUp(self):
+        self.receiver = Device.objects.create(
+            name='Receiver',
+            tcp_config=TcpConfig.objects.create(host='receiver.local', port=8102),
+        )
+        self.power = StateSet.objects.create(name='Receiver power', device=self.receiver)
+        self.on = State.objects.create(name='On', state_set=self.power)
+        self.off = State.objects.create(name='Off', state_set=self.power)
+        self.power.status = self.off
+        self.power.save()
+
+        self.is_on = Condition.objects.create(name='Receiver is on', condition_type='all')
+        self.is_on.states.add(self.on)
+        self.is_off = Condition.objects.create(name='Receiver is off', condition_type='all')
+        self.is_off.states.add(self.off)
+
+        self.button = RemoteButton.objects.create(lirc_code='KEY_POWER')
+        turn_on = CommandSet.objects.create(name='Turn on', trigger=self.button, condition=self.is_off)
+        Command.objects.create(device=self.receiver, trigger=turn_on, command_type='tcp', data='PO')
+        StateSideEffect.objects.create(commands=turn_on).states.add(self.on)
+        turn_off = CommandSet.objects.create(name='Turn off', trigger=self.button, condition=self.is_on)
+        Command.objects.create(device=self.receiver, trigger=turn_off, command_type='tcp', data='PF')
+        StateSideEffect.objects.create(commands=turn_off).states.add(self.off)
+
+
+class DispatchPlanTests(PowerToggleMixin, TestCase):
+
+    def test_compile_plan(self):
+        plan = compile_plan(load_graph())
+        button = plan.buttons['KEY_POWER']
+        self.assertEqual([x.name for x in button.macros], ['Turn on', 'Turn off'])
+        self.assertEqual(button.macros[0].commands[0].data, b'PO\r\n')
+        self.assertEqual(button.macros[0].side_effects, (self.on.pk,))
+        self.assertEqual(plan.state_vector, plan.state_index.bits[self.off.pk])
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_push_toggles_without_queries(self, send_tcp_command):
+        store = StateStore()
+        dispatcher = Dispatcher(store)
+        dispatcher.load()
+        with self.assertNumQueries(0):
+            dispatcher.push('KEY_POWER', 0)
+        send_tcp_command.assert_called_once_with('receiver.local', 8102, b'PO\r\n')
+        dispatcher.push('KEY_POWER', 0)
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'PF\r\n')
+        store.flush()
+        self.power.refresh_from_db()
+        self.assertEqual(self.power.status, self.off)
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_push_records_metrics(self, send_tcp_command):
+        metrics = MetricsRegistry()
+        dispatcher = Dispatcher(metrics=metrics)
+        dispatcher.load()
+        dispatcher.push('KEY_POWER', 0, monotonic())
+        stages = metrics.snapshot()['stages']
+        for stage in ['receive', 'lookup', 'conditions', 'side_effects', 'press']:
+            self.assertEqual(stages[stage]['KEY_POWER']['count'], 1)
+        self.assertEqual(stages['send'][str(self.receiver.pk)]['count'], 1)
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_config_change_rebinds_only_that_device(self, send_tcp_command):
+        dispatcher = Dispatcher()
+        dispatcher.load()
+        plan = dispatcher.plan
+        handler = plan.buttons['KEY_POWER'].macros[0].commands[0].handler
+        config = self.receiver.tcp_config
+        config.port = 23
+        config.save()
+        dispatcher.refresh_device(self.receiver.pk)
+        self.assertIs(dispatcher.plan, plan)
+        handler(b'PO\r\n')
+        send_tcp_command.assert_called_once_with('receiver.local', 23, b'PO\r\n')
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_reload_keeps_presses_made_while_compiling(self, send_tcp_command):
+        store = StateStore()
+        dispatcher = Dispatcher(store)
+        dispatcher.load()
+
+        def compile_during_press(*args):
+            dispatcher.push('KEY_POWER', 0)
+            return compile_plan(*args)
+
+        with mock.patch('systemstate.dispatch.compile_plan', compile_during_press):
+            dispatcher.reload()
+        self.assertEqual(dispatcher.state_vector, dispatcher.plan.state_index.bits[self.on.pk])
+        dispatcher.push('KEY_POWER', 0)
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'PF\r\n')
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_run_macro_by_name(self, send_tcp_command):
+        dispatcher = Dispatcher()
+        dispatcher.load()
+        self.assertFalse(dispatcher.run_macro('Turn off'))
+        self.assertTrue(dispatcher.run_macro('Turn on'))
+        send_tcp_command.assert_called_once_with('receiver.local', 8102, b'PO\r\n')
+        self.assertEqual(dispatcher.state_vector, dispatcher.plan.state_index.bits[self.on.pk])
+        with self.assertRaises(KeyError):
+            dispatcher.run_macro('Turn sideways')
+
+    def test_duplicate_macro_names_are_logged(self):
+        CommandSet.objects.create(name='Turn on', trigger=self.button, condition=self.is_on)
+        with self.assertLogs('systemstate.dispatch', 'WARNING') as logs:
+            plan = compile_plan(load_graph())
+        self.assertIn("'Turn on'", logs.output[0])
+        self.assertEqual(plan.macros['Turn on'].condition, self.is_off.pk)
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_commands_for_one_device_are_batched(self, send_tcp_command):
+        turn_on = CommandSet.objects.get(name='Turn on')
+        Command.objects.create(device=self.receiver, trigger=turn_on, command_type='tcp', data='FN19')
+        config = self.receiver.tcp_config
+        config.ack_pattern = '^R$'
+        config.save()
+        dispatcher = Dispatcher()
+        dispatcher.load()
+        dispatcher.push('KEY_POWER', 0)
+        send_tcp_command.assert_called_once_with(
+            'receiver.local',
+            8102,
+            [b'PO\r\n', b'FN19\r\n'],
+            ack_pattern=re.compile('^R$'),
+            ack_timeout=1.0,
+        )
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_on_sent_waits_for_the_device_worker(self, send_tcp_command):
+        release = Event()
+        send_tcp_command.side_effect = lambda *args: release.wait(5)
+        executor = CommandExecutor()
+        self.addCleanup(executor.stop)
+        dispatcher = Dispatcher(executor=executor)
+        dispatcher.load()
+        sent = queue.Queue()
+        dispatcher.push('KEY_POWER', 0, on_sent=sent.put)
+        with self.assertRaises(queue.Empty):
+            sent.get(timeout=0.05)
+        release.set()
+        self.assertEqual(sent.get(timeout=5), 0)
+        send_tcp_command.side_effect = OSError('unreachable')
+        dispatcher.push('KEY_POWER', 0, on_sent=sent.put)
+        self.assertEqual(sent.get(timeout=5), 1)
+        dispatcher.push('KEY_UNKNOWN', on_sent=sent.put)
+        self.assertEqual(sent.get(timeout=5), 0)
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_unknown_button(self, send_tcp_command):
+        dispatcher = Dispatcher()
+        dispatcher.load()
+        with self.assertNumQueries(0):
+            dispatcher.push('KEY_UNKNOWN')
+        self.assertFalse(send_tcp_command.called)
+
+
+class SideEffectOrderingTests(PowerToggleMixin, TestCase):
+    """
+    Two macros on one button set the same StateSet: on, then off. The later
+    macro wins in every mode.
+    """
+
+    def setUp(self):
+        super(SideEffectOrderingTests, self).setUp()
+        self.button = RemoteButton.objects.create(lirc_code='KEY_FLICKER')
+        flick_on = CommandSet.objects.create(name='Flick on', trigger=self.button)
+        StateSideEffect.objects.create(commands=flick_on).states.add(self.on)
+        flick_off = CommandSet.objects.create(name='Flick off', trigger=self.button)
+        StateSideEffect.objects.create(commands=flick_off).states.add(self.off)
+        StateSideEffect.objects.create(commands=flick_off).states.add(self.on, self.off)
+
+    def push(self, mode):
+        store = StateStore()
+        dispatcher = Dispatcher(store, side_effect_mode=mode)
+        dispatcher.load()
+        with mock.patch.object(store, 'write_many', wraps=store.write_many) as write_many:
+            dispatcher.push('KEY_FLICKER', 0)
+        self.power.refresh_from_db()
+        self.assertEqual(self.power.status, self.off)
+        self.assertEqual(dispatcher.state_vector, dispatcher.plan.state_index.bits[self.off.pk])
+        return write_many.call_count
+
+    def test_net_mode_writes_once(self):
+        self.assertEqual(self.push('net'), 1)
+
+    def test_sequential_mode_writes_every_effect(self):
+        self.assertEqual(self.push('sequential'), 4)
+
+    def test_orm_execute(self):
+        for mode, saves in [('net', 1), ('sequential', 4)]:
+            self.power.status = self.on
+            self.power.save()
+            with self.settings(RIKER_SIDE_EFFECT_MODE=mode):
+                with mock.patch.object(State, 'activate', autospec=True, side_effect=State.activate) as activate:
+                    self.button.execute()
+            self.power.refresh_from_db()
+            self.assertEqual(self.power.status, self.off)
+            self.assertEqual(activate.call_count, saves)
+
+
+class ManualScheduler(object):
+    """
+    Holds timers until the test fires them.
+    """
+
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback, *args, label=None):
+        timer = Timer(delay, callback, args, label)
+        self.timers.append(timer)
+        return timer
+
+    def fire(self):
+        timers = sorted((x for x in self.timers if not x.cancelled), key=lambda x: x.due)
+        self.timers = timers[1:]
+        timers[0].callback(*timers[0].args)
+        return timers[0]
+
+
+class SequenceTests(PowerToggleMixin, TestCase):
+    """
+    "Watch TV" switches the receiver's input 8s after powering it, or as
+    soon as the receiver reports that it is on.
+    """
+
+    def setUp(self):
+        super(SequenceTests, self).setUp()
+        watch_tv = CommandSet.objects.create(
+            name='Watch TV',
+            trigger=RemoteButton.objects.create(lirc_code='KEY_TV'),
+        )
+        Command.objects.create(device=self.receiver, trigger=watch_tv, command_type='tcp', data='PO')
+        self.switch = Command.objects.create(
+            device=self.receiver,
+            trigger=watch_tv,
+            command_type='tcp',
+            data='FN01',
+            delay=8000,
+        )
+        self.scheduler = ManualScheduler()
+
+    def dispatcher(self, policy='supersede'):
+        store = StateStore()
+        dispatcher = Dispatcher(store, scheduler=self.scheduler, sequence_policy=policy)
+        dispatcher.load()
+        return dispatcher
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_delayed_step_does_not_block(self, send_tcp_command):
+        dispatcher = self.dispatcher()
+        self.assertEqual(dispatcher.push('KEY_TV', 0), 1)
+        send_tcp_command.assert_called_once_with('receiver.local', 8102, b'PO\r\n')
+        self.assertEqual(self.scheduler.fire().due, 8.0)
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'FN01\r\n')
+        self.assertEqual(dispatcher.sequences, set())
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_later_press_supersedes_sequence(self, send_tcp_command):
+        dispatcher = self.dispatcher()
+        dispatcher.push('KEY_TV', 0)
+        dispatcher.push('KEY_POWER', 0)
+        self.assertEqual(dispatcher.sequences, set())
+        self.assertTrue(all(x.cancelled for x in self.scheduler.timers))
+        self.assertEqual(send_tcp_command.call_count, 2)
+
+        dispatcher = self.dispatcher('concurrent')
+        dispatcher.push('KEY_TV', 0)
+        dispatcher.push('KEY_POWER', 0)
+        self.scheduler.fire()
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'FN01\r\n')
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_wait_until_state(self, send_tcp_command):
+        self.switch.delay = 0
+        self.switch.wait_until = self.on
+        self.switch.wait_timeout = 2000
+        self.switch.save()
+        dispatcher = self.dispatcher()
+        dispatcher.push('KEY_TV', 0)
+        self.assertEqual(send_tcp_command.call_count, 1)
+        dispatcher.activate(self.on.pk)
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'FN01\r\n')
+        self.assertTrue(self.scheduler.timers[0].cancelled)
+
+        dispatcher.activate(self.off.pk)
+        dispatcher.push('KEY_TV', 0)
+        self.assertEqual(self.scheduler.fire().due, 2.0)
+        self.assertEqual(send_tcp_command.call_count, 4)
+
+
+class FeedbackTests(PowerToggleMixin, TestCase):
+    """
+    The receiver answers "?P" with PWR0 when it is on and PWR1 when it is in
+    standby.
+    """
+
+    def setUp(self):
+        super(FeedbackTests, self).setUp()
+        self.on.feedback_pattern = '^PWR0$'
+        self.on.save()
+        self.off.feedback_pattern = '^PWR[12]$'
+        self.off.save()
+        StateQuery.objects.create(state_set=self.power, command_type='tcp', data='?P', min_interval=5, max_interval=60)
+        store = StateStore()
+        self.dispatcher = Dispatcher(store)
+        self.dispatcher.load()
+        self.scheduler = ManualScheduler()
+        self.poller = FeedbackPoller(self.dispatcher, scheduler=self.scheduler)
+        self.poller.start()
+        self.dispatcher.feedback = self.poller
+
+    def receiver_on(self):
+        return self.dispatcher.state_active(self.on.pk)
+
+    @mock.patch('commands.utils.query_tcp_state', return_value=['PWR0'])
+    def test_poll_reconciles_and_backs_off(self, query_tcp_state):
+        self.scheduler.fire()
+        query_tcp_state.assert_called_once_with('receiver.local', 8102, '?P', 1.0)
+        self.assertTrue(self.receiver_on())
+        self.assertEqual(self.scheduler.fire().due, 5)
+        self.assertEqual(self.scheduler.fire().due, 10)
+        self.assertEqual(self.scheduler.fire().due, 20)
+        self.assertEqual(self.poller.polled[self.power.pk].interval, 40)
+
+    @mock.patch('commands.utils.query_tcp_state', side_effect=ConnectionRefusedError)
+    def test_press_is_confirmed_soon(self, query_tcp_state):
+        self.scheduler.fire()
+        self.assertEqual(self.poller.polled[self.power.pk].interval, 10)
+        with mock.patch.object(self.dispatcher, 'executor'):
+            self.dispatcher.push('KEY_POWER', 0)
+        self.assertEqual(self.poller.polled[self.power.pk].interval, 5)
+        self.assertTrue(self.receiver_on())
+
+    def test_unsolicited_tcp_response(self):
+        self.scheduler.timers = []
+        self.poller.tcp_response('receiver.local', 8102, 'PWR0')
+        self.poller.tcp_response('receiver.local', 8102, 'VOL050')
+        self.poller.tcp_response('other.local', 8102, 'PWR0')
+        self.scheduler.fire()
+        self.assertTrue(self.receiver_on())
+        self.assertEqual([x.due for x in self.scheduler.timers if not x.cancelled], [5])
+
+
+class SchedulerTests(SimpleTestCase):
+
+    def test_runs_in_due_order_and_records_lag(self):
+        metrics = MetricsRegistry()
+        scheduler = Scheduler(metrics)
+        self.addCleanup(scheduler.stop)
+        calls = []
+        done = Event()
+        scheduler.call_later(0.05, calls.append, 'second', label='Scene')
+        scheduler.call_later(0.01, calls.append, 'first', label='Scene')
+        scheduler.call_later(0.02, calls.append, 'cancelled', label='Scene').cancel()
+        scheduler.call_later(0.06, done.set, label='Scene')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, ['first', 'second'])
+        self.assertEqual(metrics.snapshot()['stages']['scheduler']['Scene']['count'], 3)
+
+
+class LoaderTests(PowerToggleMixin, TransactionTestCase):
+    """
+    A TransactionTestCase, so that the on_commit callbacks of the signal
+    receivers run and their queries are counted too.
+    """
+
+    def add_macros(self, button, count):
+        nested = Condition.objects.create(name='Receiver is off, nested', condition_type='any')
+        nested.nested_conditions.add(self.is_off)
+        for number in range(count):
+            macro = CommandSet.objects.create(
+                name='Scene {}'.format(number),
+                trigger=button,
+                condition=nested if number % 2 else self.is_off,
+            )
+            Command.objects.create(device=self.receiver, trigger=macro, command_type='tcp', data='PO')
+            Command.objects.create(
+                device=self.receiver,
+                trigger=macro,
+                command_type='tcp',
+                data='VU',
+                condition=self.is_on,
+            )
+            StateSideEffect.objects.create(commands=macro).states.add(self.on)
+
+    def count_queries(self, lirc_code):
+        StateSet.objects.filter(pk=self.power.pk).update(status=self.off)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(execute_button(lirc_code))
+        self.power.refresh_from_db()
+        self.assertEqual(self.power.status, self.on)
+        return len(queries)
+
+    @mock.patch('systemstate.signals.plan_changed')
+    @mock.patch('systemstate.models.send_tcp_command')
+    def test_query_count_does_not_grow_with_macros(self, send_tcp_command, plan_changed):
+        self.add_macros(RemoteButton.objects.create(lirc_code='KEY_SMALL'), 2)
+        self.add_macros(RemoteButton.objects.create(lirc_code='KEY_LARGE'), 10)
+        plan_changed.reset_mock()
+        self.assertEqual(self.count_queries('KEY_SMALL'), self.count_queries('KEY_LARGE'))
+        plan_changed.assert_not_called()
+        self.assertEqual(send_tcp_command.call_count, 12)
+        send_tcp_command.assert_called_with('receiver.local', 8102, 'PO')
+
+    def test_only_reachable_conditions_are_loaded(self):
+        nested = Condition.objects.create(name='Receiver is off, nested', condition_type='any')
+        nested.nested_conditions.add(self.is_off)
+        with self.assertNumQueries(4):
+            conditions = load_conditions({nested.pk})
+        self.assertEqual(set(conditions), {nested.pk, self.is_off.pk})
+        self.assertIs(conditions[nested.pk].loaded_nested_conditions[0], conditions[self.is_off.pk])
+        self.assertTrue(conditions[nested.pk].met())
+
+    def test_unknown_button(self):
+        with self.assertLogs('systemstate.loader', 'WARNING'):
+            self.assertFalse(execute_button('KEY_UNKNOWN'))
+
+
+class SignalTests(TestCase):
+
+    @mock.patch('systemstate.signals.notify')
+    @mock.patch('systemstate.signals.export_snapshot')
+    @mock.patch('systemstate.signals.DISPATCHER')
+    def test_only_the_web_process_publishes(self, dispatcher, export_snapshot, notify):
+        self.addCleanup(signals.publish_changes, signals.PUBLISH)
+        with self.settings(RIKER_SNAPSHOT_FILE='/tmp/riker.snapshot'):
+            signals.publish_changes(False)
+            signals.plan_changed()
+            signals.device_changed(3)
+            self.assertEqual(dispatcher.reload.call_count, 1)
+            self.assertFalse(export_snapshot.called)
+            self.assertFalse(notify.called)
+            signals.publish_changes()
+            signals.plan_changed()
+        export_snapshot.assert_called_once_with('/tmp/riker.snapshot')
+        notify.assert_called_once_with('plan')
+
+    @mock.patch('systemstate.signals.transaction.on_commit')
+    def test_disconnected_signals_ignore_changes(self, on_commit):
+        signals.disconnect_signals()
+        try:
+            RemoteButton.objects.create(lirc_code='KEY_SEEDED')
+        finally:
+            signals.connect_signals()
+        self.assertFalse(on_commit.called)
+        RemoteButton.objects.create(lirc_code='KEY_ADDED')
+        self.assertTrue(on_commit.called)
+
+
+class DeviceRegistryTests(SimpleTestCase):
+
+    def test_superseded_serial_config_is_released(self):
+        transport = mock.Mock()
+        registry = DeviceRegistry(transport)
+        old = ('/dev/ttyUSB0', 9600, 8, 1, 0.0)
+        new = ('/dev/ttyUSB0', 19200, 8, 1, 0.0)
+        registry.sync({1: {'serial': old}, 2: {'serial': old}})
+        registry.sync({1: {'serial': new}, 2: {'serial': old}})
+        self.assertFalse(transport.release_serial_port.called)
+        registry.sync({1: {'serial': new}})
+        transport.release_serial_port.assert_called_once_with(*old)
+
+
+class ChangeListenerTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        self.path = os.path.join(directory, 'notify.sock')
+        self.dispatcher = mock.Mock()
+        self.reloaded = Event()
+        self.listener = ChangeListener(
+            self.dispatcher,
+            path=self.path,
+            on_reload=lambda plan: self.reloaded.set(),
+            debounce=0.2,
+        )
+        self.listener.start()
+        self.addCleanup(self.listener.stop)
+
+    def test_device_changes_are_coalesced(self):
+        notify('device', 3, path=self.path)
+        notify('device', 4, path=self.path)
+        notify('device', 3, path=self.path)
+        deadline = monotonic() + 5
+        while self.dispatcher.refresh_device.call_count < 2 and monotonic() < deadline:
+            self.listener.join(0.01)
+        self.assertEqual(
+            sorted(x[0][0] for x in self.dispatcher.refresh_device.call_args_list),
+            [3, 4],
+        )
+        self.assertFalse(self.dispatcher.reload.called)
+
+    def test_plan_change_reloads_once(self):
+        notify('device', 3, path=self.path)
+        notify('plan', path=self.path)
+        self.assertTrue(self.reloaded.wait(5))
+        self.dispatcher.reload.assert_called_once_with()
+        self.assertFalse(self.dispatcher.refresh_device.called)
+
+
+class LoopChangeListenerTests(SimpleTestCase):
+
+    def test_changes_are_applied_on_the_loop(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        path = os.path.join(directory, 'notify.sock')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        threads = []
+        reloaded = Event()
+        dispatcher = mock.Mock()
+        dispatcher.reload.side_effect = lambda: threads.append(get_ident())
+        listener = ChangeListener(
+            dispatcher,
+            path=path,
+            on_reload=lambda plan: reloaded.set(),
+            debounce=0,
+            loop=loop,
+        )
+        listener.start()
+        self.addCleanup(listener.stop)
+        notify('plan', path=path)
+        self.assertTrue(loop.run_until_complete(loop.run_in_executor(None, reloaded.wait, 5)))
+        self.assertEqual(threads, [get_ident()])
+
+
+class StateStoreTests(PowerToggleMixin, TestCase):
+
+    def setUp(self):
+        super(StateStoreTests, self).setUp()
+        handle, self.journal_path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, self.journal_path)
+
+    def test_writes_are_coalesced(self):
+        store = StateStore(journal_path=self.journal_path)
+        store.write(self.power.pk, self.on.pk)
+        store.write(self.power.pk, self.off.pk)
+        store.write(self.power.pk, self.on.pk)
+        self.assertEqual(store.pending, {self.power.pk: self.on.pk})
+        with self.assertNumQueries(3):
+            store.flush()
+        self.power.refresh_from_db()
+        self.assertEqual(self.power.status, self.on)
+        with open(self.journal_path) as journal:
+            self.assertEqual(journal.read(), '')
+
+    def test_recover_from_journal(self):
+        with open(self.journal_path, 'w') as journal:
+            journal.write('[{0}, {1}]\n[{0}, {2}]\n[{0}, '.format(self.power.pk, self.off.pk, self.on.pk))
+        StateStore(journal_path=self.journal_path).recover()
+        self.power.refresh_from_db()
+        self.assertEqual(self.power.status, self.on)
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_reload_sees_unflushed_state(self, send_tcp_command):
+        store = StateStore()
+        dispatcher = Dispatcher(store)
+        dispatcher.load()
+        dispatcher.push('KEY_POWER', 0)
+        dispatcher.load()
+        dispatcher.push('KEY_POWER', 0)
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'PF\r\n')
+
+
+
+class SnapshotTests(PowerToggleMixin, TestCase):
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'riker.snapshot')
+        self.journal_path = os.path.join(directory, 'state.journal')
+        export_snapshot(self.path, JSON)
+
+    def create_dispatcher(self):
+        dispatcher = Dispatcher(StateStore(journal_path=self.journal_path))
+        dispatcher.use_snapshot(self.path)
+        return dispatcher
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_runs_without_queries_and_keeps_state_in_journal(self, send_tcp_command):
+        dispatcher = self.create_dispatcher()
+        with self.assertNumQueries(0):
+            dispatcher.load()
+            dispatcher.push('KEY_POWER', 0)
+            dispatcher.store.flush()
+        send_tcp_command.assert_called_once_with('receiver.local', 8102, b'PO\r\n')
+        restarted = self.create_dispatcher()
+        with self.assertNumQueries(0):
+            restarted.store.recover()
+            restarted.load()
+        self.assertEqual(restarted.state_vector, restarted.plan.state_index.bits[self.on.pk])
+
+    @mock.patch('commands.utils.send_tcp_command')
+    def test_reload_swaps_in_new_snapshot(self, send_tcp_command):
+        dispatcher = self.create_dispatcher()
+        dispatcher.load()
+        Command.objects.filter(data='PO').update(data='PWRON')
+        dispatcher.refresh_device(self.receiver.pk)
+        dispatcher.push('KEY_POWER', 0)
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'PO\r\n')
+        export_snapshot(self.path, JSON)
+        dispatcher.reload()
+        dispatcher.push('KEY_POWER', 0)
+        dispatcher.push('KEY_POWER', 0)
+        send_tcp_command.assert_called_with('receiver.local', 8102, b'PWRON\r\n')
+
+    def test_rejects_other_format_versions(self):
+        self.assertEqual(read_snapshot(self.path)['graph'], load_graph())
+        with open(self.path, 'r+b') as snapshot:
+            snapshot.seek(8)
+            snapshot.write(b'\x00\x63')
+        with self.assertRaises(SnapshotError):
+            read_snapshot(self.path)
+
+
+class HistogramTests(SimpleTestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram(size=100)
+        for value in range(1, 201):
+            histogram.observe(value / 1000.0)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 200)
+        self.assertEqual(summary['p50'], 0.151)
+        self.assertEqual(summary['p99'], 0.2)
+        self.assertEqual(summary['max'], 0.2)
+
+
+class RepeatLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.limiter = RepeatLimiter()
+
+    def allowed(self, policy, repeats, **kwargs):
+        return [x for x in repeats if self.limiter.allow('KEY_VOLUMEUP', policy, x, **kwargs)]
+
+    def test_delay_and_coalesce(self):
+        policy = compile_policy('repeat', 3, 2, None)
+        self.assertEqual(self.allowed(policy, range(10)), [0, 5, 7, 9])
+        self.assertEqual(
+            self.limiter.counters['KEY_VOLUMEUP'],
+            {'executed': 4, 'merged': 6, 'dropped': 0},
+        )
+
+    def test_once(self):
+        policy = compile_policy('once', 0, 1, None)
+        self.assertEqual(self.allowed(policy, [0, 1, 2, 0]), [0, 0])
+        self.assertEqual(self.limiter.counters['KEY_VOLUMEUP']['dropped'], 2)
+
+    def test_held_drops_stale_repeats(self):
+        policy = compile_policy('held', 0, 1, None)
+        stale = monotonic() - 1
+        self.assertEqual(self.allowed(policy, [0, 1, 2], received=stale), [0])
+        self.assertEqual(self.allowed(policy, [3]), [3])
+
+    def test_max_rate(self):
+        policy = compile_policy('repeat', 0, 1, 1)
+        self.assertEqual(self.allowed(policy, [0, 1, 2]), [0])
+        self.assertEqual(self.limiter.counters['KEY_VOLUMEUP']['dropped'], 2)
+
+    def test_infers_repeats_from_timing(self):
+        policy = compile_policy('once', 0, 1, None)
+        now = monotonic()
+        self.assertTrue(self.limiter.allow('KEY_UP', policy, received=now))
+        self.assertFalse(self.limiter.allow('KEY_UP', policy, received=now + 0.1))
+        self.assertTrue(self.limiter.allow('KEY_DOWN', policy, received=now + 0.2))
+        self.assertTrue(self.limiter.allow('KEY_UP', policy, received=now + 0.3))
+
+
+class CommandExecutorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.executor = CommandExecutor(queue_depth=2, policy='drop_newest')
+        self.addCleanup(self.executor.stop)
+        self.release = Event()
+        self.sent = []
+
+    def blocking_send(self, data):
+        self.release.wait(5)
+        self.sent.append(data)
+
+    def test_devices_run_in_parallel_and_in_order(self):
+        self.executor.queue_depth = 16
+        self.executor.submit('tv', self.blocking_send, 'slow')
+        for data in ['VU', 'VD']:
+            self.executor.submit('receiver', self.sent.append, data)
+        finished = Event()
+        self.executor.submit('receiver', lambda: finished.set())
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(self.sent, ['VU', 'VD'])
+        self.release.set()
+
+    def test_drop_newest_when_full(self):
+        started = Event()
+        self.executor.submit('tv', lambda: started.set() or self.blocking_send('1'))
+        self.assertTrue(started.wait(5))
+        for data in ['2', '3', '4']:
+            self.executor.submit('tv', self.blocking_send, data)
+        self.release.set()
+        self.executor.stop()
+        self.assertEqual(self.sent, ['1', '2', '3'])
+
+    def test_drop_oldest_when_full(self):
+        self.executor.policy = 'drop_oldest'
+        started = Event()
+        self.executor.submit('tv', lambda: started.set() or self.blocking_send('1'))
+        self.assertTrue(started.wait(5))
+        for data in ['2', '3', '4']:
+            self.executor.submit('tv', self.blocking_send, data)
+        self.release.set()
+        self.executor.stop()
+        self.assertEqual(self.sent, ['1', '3', '4'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            CommandExecutor(policy='shrug')
+
+
+class AsyncCommandExecutorTests(SimpleTestCase):
+
+    def test_devices_run_concurrently_and_in_order(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        executor = AsyncCommandExecutor(loop, queue_depth=4)
+        sent = []
+        tv_released = asyncio.Event(loop=loop)
+
+        async def send_tv(data):
+            await tv_released.wait()
+            sent.append(data)
+
+        async def send_receiver(data):
+            sent.append(data)
+            if data == 'VD':
+                tv_released.set()
+
+        executor.submit('tv', send_tv, 'KEY_HOME')
+        executor.submit('receiver', send_receiver, 'VU')
+        executor.submit('receiver', send_receiver, 'VD')
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+        executor.stop()
+        self.assertEqual(sent, ['VU', 'VD', 'KEY_HOME'])
+
+
+class ConditionEngineTests(TestCase):
+
+    def setUp(self):
+        device = Device.objects.create(name='Projector')
+        self.state_sets = []
+        for set_number in range(4):
+            state_set = StateSet.objects.create(name='Set {}'.format(set_number), device=device)
+            for state_number in range(3):
+                State.objects.create(name='State {}'.format(state_number), state_set=state_set)
+            self.state_sets.append(state_set)
+
+    def create_random_conditions(self, rng, count):
+        states = list(State.objects.all())
+        conditions = []
+        for number in range(count):
+            condition = Condition.objects.create(
+                name='Condition {}'.format(number),
+                condition_type=rng.choice(['any', 'all']),
+            )
+            condition.states.add(*rng.sample(states, rng.randint(0, 3)))
+            if conditions:
+                condition.nested_conditions.add(*rng.sample(conditions, rng.randint(0, min(3, len(conditions)))))
+            conditions.append(condition)
+        return conditions
+
+    def test_matches_model_semantics(self):
+        rng = random.Random(1701)
+        conditions = self.create_random_conditions(rng, 25)
+        for _ in range(20):
+            for state_set in self.state_sets:
+                state_set.status = rng.choice(list(state_set.state_set.all()) + [None])
+                state_set.save()
+            plan = compile_plan(load_graph())
+            for condition in conditions:
+                self.assertEqual(
+                    evaluate(plan.conditions[condition.pk], plan.state_vector),
+                    condition.met(),
+                    condition,
+                )
+
+    def test_empty_conditions(self):
+        any_condition = Condition.objects.create(name='Empty any', condition_type='any')
+        all_condition = Condition.objects.create(name='Empty all', condition_type='all')
+        plan = compile_plan(load_graph())
+        self.assertEqual(evaluate(plan.conditions[any_condition.pk], 0), any_condition.met())
+        self.assertEqual(evaluate(plan.conditions[all_condition.pk], 0), all_condition.met())
+
+    def test_same_type_nesting_is_flattened(self):
+        first, second = State.objects.filter(state_set=self.state_sets[0])[:2]
+        inner = Condition.objects.create(name='Inner', condition_type='any')
+        inner.states.add(second)
+        outer = Condition.objects.create(name='Outer', condition_type='any')
+        outer.states.add(first)
+        outer.nested_conditions.add(inner)
+        plan = compile_plan(load_graph())
+        compiled = plan.conditions[outer.pk]
+        self.assertEqual(compiled.children, ())
+        self.assertTrue(evaluate(compiled, state_vector(plan.state_index, {0: second.pk})))
+
+    def test_cycle_detection(self):
+        state = State.objects.filter(state_set=self.state_sets[0]).first()
+        first = Condition.objects.create(name='First', condition_type='any')
+        first.states.add(state)
+        second = Condition.objects.create(name='Second', condition_type='all')
+        first.nested_conditions.add(second)
+        second.nested_conditions.add(first)
+        parent = Condition.objects.create(name='Parent', condition_type='any')
+        parent.states.add(state)
+        parent.nested_conditions.add(first)
+        unrelated = Condition.objects.create(name='Unrelated', condition_type='all')
+        unrelated.states.add(state)
+        with self.assertLogs('systemstate.conditions', 'WARNING') as logs:
+            plan = compile_plan(load_graph())
+        self.assertIn('First -> Second -> First', logs.output[0])
+        vector = state_vector(plan.state_index, {self.state_sets[0].pk: state.pk})
+        self.assertFalse(evaluate(plan.conditions[first.pk], vector))
+        self.assertFalse(evaluate(plan.conditions[second.pk], vector))
+        self.assertTrue(evaluate(plan.conditions[parent.pk], vector))
+        self.assertTrue(evaluate(plan.conditions[unrelated.pk], vector))
+
+
+class BenchmarkGraphTests(TestCase):
+
+    def test_seeded_graph_alternates_macros(self):
+        with FakeTransports() as transports:
+            codes = seed_graph(GraphSize('tiny', 2, 2, 4, 3), transports)
+            dispatcher = Dispatcher(store=StateStore(), executor=InlineExecutor(MetricsRegistry()))
+            dispatcher.load()
+            dispatcher.push(codes[0], 0)
+            dispatcher.store.flush()
+            self.assertEqual(StateSet.objects.get(name='Mode 0').status.name, 'B')
+            self.assertEqual(StateSet.objects.get(name='Mode 1').status.name, 'A')
+            self.assertEqual(transports.infrared_commands, 1)
+            RemoteButton.objects.get(lirc_code=codes[0]).execute()
+            self.assertEqual(StateSet.objects.get(name='Mode 0').status.name, 'A')
+            self.assertEqual(transports.infrared_commands, 2)
@@ -1,14 +1,18 @@
-from logging import getLogger
+from django.conf import settings
 
-from systemstate.models import RemoteButton
+from systemstate.dispatch import DISPATCHER
+from systemstate.loader import execute_button
 
-LOGGER = getLogger(__name__)
 
-def push_button(code):
-    try:
-        button = RemoteButton.objects.get(lirc_code=code)
-    except RemoteButton.DoesNotExist:
-        LOGGER.warning('Did not find handler for remote button with code {}.'.format(code))
-    else:
-        LOGGER.warning('Executing command for button: {}'.format(button))
-        button.execute()
+def push_button(code, repeat=None, received=None, on_sent=None):
+    if settings.RIKER_EXECUTION == 'orm':
+        # RemoteButton.execute() has sent every command when it returns.
+        executed = execute_button(code)
+        if on_sent is not None:
+            on_sent(0)
+        return executed
+    return DISPATCHER.push(code, repeat, received, on_sent)
+
+
+def run_macro(name, received=None, on_sent=None):
+    return DISPATCHER.run_macro(name, received, on_sent)
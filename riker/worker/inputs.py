@@ -0,0 +1,397 @@
+import asyncio
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from logging import DEBUG, getLogger
+from time import monotonic
+from urllib.parse import unquote
+
+from django.conf import settings
+
+from riker.logutils import log_event
+from systemstate.utils import push_button, run_macro
+from worker.utils import listen_async, listen_lircd_async
+
+LOGGER = getLogger(__name__)
+
+InputEvent = namedtuple('InputEvent', ['source', 'kind', 'code', 'repeat', 'received', 'job'])
+
+PRESS = 'press'
+MACRO = 'macro'
+
+
+def parse_address(address, default_host='127.0.0.1'):
+    """
+    Parse "host:port" or "port" into a (host, port) tuple.
+    """
+    host, _, port = address.rpartition(':')
+    return host or default_host, int(port)
+
+
+class InputHub(object):
+    """
+    Runs any number of input sources on one event loop and feeds their events,
+    in arrival order, through a single queue into ``callback`` (push_button by
+    default) or, for macro events, ``macro_callback`` (run_macro). Sources
+    call the emitter they are given with ``(code, repeat, received)`` from the
+    event loop. An event may carry a ``job`` future, which is resolved with
+    ``(status, result)`` once the commands it caused have been sent; the
+    callbacks are given an ``on_sent`` function for that.
+
+    With ``blocking`` (the default under RIKER_EXECUTION=orm, which queries
+    the database and sends inline), events are dispatched on a worker thread
+    so that the loop keeps serving its sources.
+    """
+
+    def __init__(self, loop=None, callback=None, macro_callback=None, queue_size=256, blocking=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.callback = callback or push_button
+        self.macro_callback = macro_callback or run_macro
+        self.queue = asyncio.Queue(maxsize=queue_size, loop=self.loop)
+        self.blocking = settings.RIKER_EXECUTION == 'orm' if blocking is None else blocking
+        self.sources = []
+        self.dropped = 0
+        self._consumer = None
+        self._thread_pool = None
+
+    def add(self, source):
+        self.sources.append(source)
+        return source
+
+    def emitter(self, source_name):
+        def emit(code, repeat=None, received=None, kind=PRESS, job=None):
+            received = monotonic() if received is None else received
+            log_event(LOGGER, DEBUG, 'input.received', source=source_name, button=code, repeat=repeat)
+            try:
+                self.queue.put_nowait(InputEvent(source_name, kind, code, repeat, received, job))
+            except asyncio.QueueFull:
+                self.dropped += 1
+                LOGGER.warning('Input queue is full; dropped %s from %s.', code, source_name)
+                return False
+            return True
+        return emit
+
+    def start(self):
+        for source in self.sources:
+            result = source.start(self.loop, self.emitter(source.name))
+            if asyncio.iscoroutine(result):
+                self.loop.run_until_complete(result)
+        self._consumer = asyncio.ensure_future(self.consume(), loop=self.loop)
+
+    def stop(self):
+        for source in self.sources:
+            source.stop()
+        if self._consumer is not None:
+            self._consumer.cancel()
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+
+    def dispatch(self, event, on_sent=None):
+        if event.kind != MACRO:
+            return 'done', self.callback(event.code, event.repeat, event.received, on_sent=on_sent)
+        try:
+            return 'done', self.macro_callback(event.code, event.received, on_sent=on_sent)
+        except KeyError:
+            return 'unknown', None
+
+    def sent_future(self):
+        """
+        A future and an ``on_sent`` callback, safe to call from any thread,
+        that resolves it with the number of failed commands.
+        """
+        sent = self.loop.create_future()
+
+        def resolve(failures):
+            if not sent.done():
+                sent.set_result(failures)
+        return sent, lambda failures: self.loop.call_soon_threadsafe(resolve, failures)
+
+    def finish_job(self, job, result, sent):
+        if result[0] != 'done':
+            if not job.done():
+                job.set_result(result)
+            return
+
+        def finished(sent):
+            failures = sent.result()
+            if not job.done():
+                job.set_result(('failed', '{} command(s) failed'.format(failures)) if failures else result)
+        sent.add_done_callback(finished)
+
+    async def consume(self):
+        while True:
+            event = await self.queue.get()
+            sent = on_sent = None
+            if event.job is not None:
+                sent, on_sent = self.sent_future()
+            try:
+                if self.blocking:
+                    if self._thread_pool is None:
+                        # One thread, so that events keep their order and
+                        # share one database connection.
+                        self._thread_pool = ThreadPoolExecutor(max_workers=1)
+                    result = await self.loop.run_in_executor(self._thread_pool, self.dispatch, event, on_sent)
+                else:
+                    result = self.dispatch(event, on_sent)
+            except Exception as error:
+                LOGGER.exception('Dispatching %s from %s failed.', event.code, event.source)
+                result = ('failed', str(error))
+            if event.job is not None:
+                self.finish_job(event.job, result, sent)
+
+
+class InputSource(object):
+
+    name = None
+
+    def start(self, loop, emit):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class LircSource(InputSource):
+    """
+    Codes from python-lirc and a lircrc file.
+    """
+
+    name = 'lirc'
+
+    def __init__(self, lirc_name, lircrc_filename):
+        self.lirc_name = lirc_name
+        self.lircrc_filename = lircrc_filename
+
+    def start(self, loop, emit):
+        listen_async(self.lirc_name, self.lircrc_filename, callback=emit, loop=loop)
+
+
+class LircdSource(InputSource):
+    """
+    Events read straight from lircd's socket.
+    """
+
+    name = 'lircd'
+
+    def __init__(self, path, button_filter=None):
+        self.path = path
+        self.button_filter = button_filter
+        self.client = None
+
+    def start(self, loop, emit):
+        self.client = listen_lircd_async(self.path, callback=emit, button_filter=self.button_filter, loop=loop)
+
+    def stop(self):
+        if self.client is not None:
+            self.client.close()
+
+
+class ServerSource(InputSource):
+    """
+    A source that accepts connections with asyncio.start_server().
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.server = None
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def start(self, loop, emit):
+        self.server = await asyncio.start_server(
+            lambda reader, writer: self.handle(reader, writer, emit),
+            self.host,
+            self.port,
+            loop=loop,
+        )
+        LOGGER.info('Accepting %s input on %s:%s.', self.name, *self.address)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def handle(self, reader, writer, emit):
+        raise NotImplementedError
+
+
+class TcpTriggerSource(ServerSource):
+    """
+    Line-based triggers: each line is a button code, optionally followed by a
+    repeat count, e.g. "KEY_VOLUMEUP" or "KEY_VOLUMEUP 2".
+    """
+
+    name = 'tcp'
+
+    async def handle(self, reader, writer, emit):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                parts = line.decode('ascii', 'replace').split()
+                if not parts:
+                    continue
+                repeat = None
+                if len(parts) > 1:
+                    try:
+                        repeat = int(parts[1])
+                    except ValueError:
+                        pass
+                emit(parts[0], repeat)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+HttpRequest = namedtuple('HttpRequest', ['method', 'path', 'headers', 'body'])
+
+HTTP_REASONS = {
+    200: 'OK',
+    202: 'Accepted',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
+}
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+class HttpTriggerSource(ServerSource):
+    """
+    A minimal keep-alive HTTP/1.1 server: ``POST /press/<code>`` queues a
+    press and answers 202 straight away.
+    """
+
+    name = 'http'
+
+    max_body = 65536
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, _ = request_line.decode('ascii').split()
+        except ValueError:
+            raise HttpError(400, 'Malformed request line.')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > self.max_body:
+            raise HttpError(413, 'Request body is too large.')
+        body = (await reader.readexactly(length)) if length else b''
+        return HttpRequest(method, path, headers, body)
+
+    def write_response(self, writer, status, data, keep_alive=True):
+        body = json.dumps(data).encode('utf-8')
+        writer.write(
+            'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                status,
+                HTTP_REASONS.get(status, ''),
+                len(body),
+                'keep-alive' if keep_alive else 'close',
+            ).encode('ascii') + body
+        )
+
+    async def respond(self, request, emit, state):
+        """
+        Return (status, data) for ``request``. ``state`` holds anything that
+        should last for the lifetime of the connection.
+        """
+        if request.method != 'POST':
+            raise HttpError(405, 'Use POST.')
+        prefix = '/press/'
+        if not request.path.startswith(prefix) or len(request.path) == len(prefix):
+            raise HttpError(404, 'Not found.')
+        emit(unquote(request.path[len(prefix):]))
+        return 202, {'queued': True}
+
+    async def handle(self, reader, writer, emit):
+        state = {}
+        try:
+            while True:
+                request = None
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        return
+                    status, data = await self.respond(request, emit, state)
+                except HttpError as error:
+                    status, data = error.status, {'error': str(error)}
+                keep_alive = request is not None and request.headers.get('connection', '').lower() != 'close'
+                self.write_response(writer, status, data, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class EvdevSource(InputSource):
+    """
+    Key presses from an evdev input device such as a Bluetooth HID remote.
+    Key names (KEY_VOLUMEUP, ...) are used as button codes, which matches the
+    names lircd's devinput driver reports. Requires the evdev package.
+    """
+
+    name = 'evdev'
+
+    def __init__(self, path, grab=True):
+        self.path = path
+        self.grab = grab
+        self.device = None
+        self.repeats = {}
+
+    def start(self, loop, emit):
+        import evdev
+        self.device = evdev.InputDevice(self.path)
+        if self.grab:
+            self.device.grab()
+        LOGGER.info('Reading input from %s (%s).', self.path, self.device.name)
+
+        def read():
+            received = monotonic()
+            try:
+                events = list(self.device.read())
+            except BlockingIOError:
+                return
+            except OSError as error:
+                LOGGER.error('Lost input device %s: %s', self.path, error)
+                loop.remove_reader(self.device.fd)
+                return
+            for event in events:
+                if event.type != evdev.ecodes.EV_KEY or event.value == 0:
+                    continue
+                name = evdev.ecodes.KEY.get(event.code) or evdev.ecodes.BTN.get(event.code)
+                if name is None:
+                    continue
+                if isinstance(name, list):
+                    name = name[0]
+                repeat = self.repeats[name] = self.repeats.get(name, 0) + 1 if event.value == 2 else 0
+                emit(name, repeat, received)
+
+        loop.add_reader(self.device.fd, read)
+
+    def stop(self):
+        if self.device is not None:
+            self.device.close()
@@ -0,0 +1,133 @@
+import asyncio
+import select
+import socket
+from collections import namedtuple
+from logging import getLogger
+from time import sleep
+
+LOGGER = getLogger(__name__)
+
+DEFAULT_SOCKET = '/var/run/lirc/lircd'
+
+LircEvent = namedtuple('LircEvent', ['code', 'repeat', 'button', 'remote'])
+
+
+def parse_event(line):
+    """
+    Parse a lircd broadcast line such as "0000000000f40bf0 00 KEY_UP devinput".
+    """
+    parts = line.split()
+    if len(parts) != 4:
+        return None
+    code, repeat, button, remote = parts
+    try:
+        return LircEvent(code, int(repeat, 16), button, remote)
+    except ValueError:
+        return None
+
+
+class LircdClient(object):
+    """
+    Reads button events straight from lircd's Unix socket.
+
+    Unlike python-lirc there is no lircrc file: every event lircd broadcasts
+    is parsed and passed through ``button_filter``, which is consulted per
+    event so the set of buttons can change while the client is running.
+    Replies to lircd commands (BEGIN ... END blocks) are skipped.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, button_filter=None):
+        self.path = path
+        self.button_filter = button_filter
+        self.sock = None
+        self._buffer = b''
+        self._in_reply = False
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.setblocking(False)
+        self.sock = sock
+        self._buffer = b''
+        self._in_reply = False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_events(self):
+        """
+        Read whatever is available without blocking. Raises ConnectionError if
+        lircd closed the socket.
+        """
+        try:
+            data = self.sock.recv(4096)
+        except BlockingIOError:
+            return []
+        if not data:
+            raise ConnectionResetError('lircd closed the connection.')
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        events = []
+        for line in lines:
+            line = line.decode('ascii', 'replace').strip()
+            if line == 'BEGIN':
+                self._in_reply = True
+            elif line == 'END':
+                self._in_reply = False
+            elif not self._in_reply:
+                event = parse_event(line)
+                if event is None:
+                    LOGGER.debug('Ignoring unexpected lircd line %r.', line)
+                elif self.button_filter is None or self.button_filter(event.button):
+                    events.append(event)
+        return events
+
+    def events(self, reconnect_delay=1.0):
+        """
+        Yield events forever, reconnecting if lircd goes away.
+        """
+        while True:
+            try:
+                if self.sock is None:
+                    self.connect()
+                select.select([self.sock], [], [])
+                for event in self.read_events():
+                    yield event
+            except OSError as error:
+                LOGGER.error('Lost connection to lircd at %s: %s', self.path, error)
+                self.close()
+                sleep(reconnect_delay)
+
+    def watch(self, callback, loop=None, reconnect_delay=1.0):
+        """
+        Call ``callback(event)`` from the event loop for every event.
+        """
+        loop = loop or asyncio.get_event_loop()
+
+        def read():
+            try:
+                events = self.read_events()
+            except OSError as error:
+                LOGGER.error('Lost connection to lircd at %s: %s', self.path, error)
+                loop.remove_reader(self.fileno())
+                self.close()
+                loop.call_later(reconnect_delay, start)
+                return
+            for event in events:
+                callback(event)
+
+        def start():
+            try:
+                self.connect()
+            except OSError as error:
+                LOGGER.error('Could not connect to lircd at %s: %s', self.path, error)
+                loop.call_later(reconnect_delay, start)
+                return
+            loop.add_reader(self.fileno(), read)
+
+        start()
@@ -0,0 +1,80 @@
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from systemstate.benchmark import SIZES, environment, run_size
+from systemstate.signals import connect_signals, disconnect_signals
+
+MODES = ('plan', 'orm')
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Seed synthetic button graphs into a throwaway test database and measure '
+        'keypresses per second and per-press latency against fake transports.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            nargs='+',
+            choices=sorted(SIZES),
+            default=['small', 'medium', 'large'],
+            help='Graph sizes to benchmark.',
+        )
+        parser.add_argument(
+            '--modes',
+            nargs='+',
+            choices=MODES,
+            default=list(MODES),
+            help='"plan" pushes through the compiled dispatcher, "orm" through RemoteButton.execute().',
+        )
+        parser.add_argument(
+            '--presses',
+            type=int,
+            default=1000,
+            help='Timed presses per size and mode.',
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=50,
+            help='Untimed presses before each measurement.',
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file instead of stdout.',
+        )
+
+    def handle(self, *args, **options):
+        if options['verbosity'] < 2:
+            logging.disable(logging.WARNING)
+        # The seeded rows are throwaway; nothing should react to them.
+        disconnect_signals()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = {
+                'environment': environment(),
+                'presses': options['presses'],
+                'warmup': options['warmup'],
+                'results': [],
+            }
+            for name in options['sizes']:
+                if options['verbosity']:
+                    self.stderr.write('Benchmarking {} graph...'.format(name))
+                results['results'].append(
+                    run_size(SIZES[name], options['presses'], options['warmup'], options['modes'])
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            connect_signals()
+            logging.disable(logging.NOTSET)
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as destination:
+                destination.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,106 @@
+import json
+from statistics import median
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from worker.startup import measure
+
+# (name, settings module, whether the system checks run), as started by
+# manage.py and by listen.py.
+ENTRY_POINTS = (
+    ('manage.py', 'riker.settings', True),
+    ('listen.py', 'riker.worker_settings', False),
+)
+
+
+def summarize(runs, top):
+    """
+    The median of each timing over ``runs``, and the ``top`` modules that
+    took longest to import themselves.
+    """
+    modules = {}
+    for run in runs:
+        for name, times in run['modules'].items():
+            modules.setdefault(name, []).append(times)
+    slowest = sorted(
+        (
+            {
+                'module': name,
+                'self': median(times['self'] for times in samples),
+                'cumulative': median(times['cumulative'] for times in samples),
+            }
+            for name, samples in modules.items()
+        ),
+        key=lambda module: module['self'],
+        reverse=True,
+    )
+    return {
+        'seconds': {
+            key: median(run['seconds'][key] for run in runs)
+            for key in runs[0]['seconds']
+        },
+        'modules_imported': median(len(run['modules']) for run in runs),
+        'slowest_imports': slowest[:top],
+    }
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Start the listener in fresh interpreters through manage.py and through listen.py, '
+        'and report the startup time and the import time of each module.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--command',
+            choices=['lirc_listen', 'riker_supervise'],
+            default='lirc_listen',
+            help='The listener command whose imports are measured.',
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=5,
+            help='Measurements per entry point; the medians are reported.',
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=20,
+            help='How many of the slowest imports to report per entry point.',
+        )
+        parser.add_argument(
+            '--target',
+            type=float,
+            default=settings.RIKER_STARTUP_TARGET,
+            help='Fail if listen.py takes longer than this many seconds to start.',
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON results to this file instead of stdout.',
+        )
+
+    def handle(self, *args, **options):
+        results = {'command': options['command'], 'runs': options['runs'], 'target': options['target']}
+        for name, settings_module, checks in ENTRY_POINTS:
+            if options['verbosity']:
+                self.stderr.write('Measuring {}...'.format(name))
+            runs = [
+                measure(settings_module, options['command'], checks)
+                for _ in range(options['runs'])
+            ]
+            results[name] = summarize(runs, options['top'])
+        startup = results['listen.py']['seconds']['total']
+        results['target_met'] = startup <= options['target']
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as destination:
+                destination.write(output)
+        else:
+            self.stdout.write(output)
+        if not results['target_met']:
+            raise CommandError(
+                'listen.py took {:.3f}s to start; the target is {:.3f}s.'.format(startup, options['target'])
+            )
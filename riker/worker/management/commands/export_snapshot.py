@@ -0,0 +1,40 @@
+from time import monotonic
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from systemstate.snapshot import ENCODINGS, SnapshotError, default_encoding, export_snapshot, read_snapshot
+
+
+class Command(BaseCommand):
+
+    help = 'Export the configuration to a snapshot file that the listener can run from without a database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default=settings.RIKER_SNAPSHOT_FILE,
+            metavar='PATH',
+            help='Where to write the snapshot; defaults to RIKER_SNAPSHOT_FILE.',
+        )
+        parser.add_argument(
+            '--encoding',
+            choices=sorted(ENCODINGS),
+            default=default_encoding(),
+            help='msgpack (if installed) or JSON.',
+        )
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            raise CommandError('Give --output or set RIKER_SNAPSHOT_FILE.')
+        try:
+            size = export_snapshot(options['output'], options['encoding'])
+            start = monotonic()
+            read_snapshot(options['output'])
+            elapsed = monotonic() - start
+        except SnapshotError as error:
+            raise CommandError(str(error))
+        if options['verbosity']:
+            self.stdout.write('Wrote {} bytes of {} to {}; it reads back in {:.1f} ms.'.format(
+                size, options['encoding'], options['output'], elapsed * 1000,
+            ))
@@ -1,20 +1,163 @@
+import asyncio
+import os
+import queue
 from logging import getLogger
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from worker.utils import listen, create_lircrc_tempfile
+from systemstate.dispatch import DISPATCHER
+from systemstate.executor import AsyncCommandExecutor
+from systemstate.feedback import read_feedback
+from systemstate.metrics import METRICS
+from systemstate.scheduler import LoopScheduler
+from worker.inputs import (
+    EvdevSource,
+    InputHub,
+    LircSource,
+    LircdSource,
+    TcpTriggerSource,
+    parse_address,
+)
+from worker.pressapi import PressApiSource
+from worker.services import Services
+from worker.utils import (
+    listen,
+    listen_lircd,
+    create_lircrc_tempfile,
+    refresh_lircrc,
+)
 
 
 LOGGER = getLogger(__name__)
 
 class Command(BaseCommand):
 
-    def handle(*args, **options):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--asyncio',
+            action='store_true',
+            help='Run the listener and all device transports on one asyncio event loop.',
+        )
+        parser.add_argument(
+            '--backend',
+            choices=['lirc', 'lircd', 'none'],
+            default='lirc',
+            help='Read buttons through python-lirc and a lircrc file, straight from the lircd socket, or not at all.',
+        )
+        parser.add_argument(
+            '--lircd-socket',
+            default=settings.RIKER_LIRCD_SOCKET,
+            help='Path of the lircd socket for the lircd backend.',
+        )
+        parser.add_argument(
+            '--tcp-trigger',
+            default=settings.RIKER_TCP_TRIGGER,
+            metavar='[HOST:]PORT',
+            help='Also accept button codes, one per line, on this TCP address.',
+        )
+        parser.add_argument(
+            '--http-trigger',
+            default=settings.RIKER_HTTP_TRIGGER,
+            metavar='[HOST:]PORT',
+            help='Also serve the button-press API (POST /press/<code>, /press, /macro/<name>) on this address.',
+        )
+        parser.add_argument(
+            '--evdev',
+            action='append',
+            default=list(settings.RIKER_EVDEV_DEVICES),
+            metavar='PATH',
+            help='Also read key presses from this input device; may be given more than once.',
+        )
+        parser.add_argument(
+            '--snapshot',
+            default=settings.RIKER_SNAPSHOT_FILE,
+            metavar='PATH',
+            help='Run from this configuration snapshot (see export_snapshot) instead of the database.',
+        )
+
+    def handle(self, *args, **options):
         name = 'riker'
+        if options['http_trigger'] and not settings.RIKER_API_TOKENS:
+            raise CommandError('--http-trigger needs at least one token in RIKER_API_TOKENS.')
+        if options['snapshot']:
+            if not os.path.exists(options['snapshot']):
+                raise CommandError(
+                    'No snapshot at {}; create it with `manage.py export_snapshot`.'.format(options['snapshot'])
+                )
+            DISPATCHER.use_snapshot(options['snapshot'])
+        if options['asyncio'] and settings.RIKER_STATE_FEEDBACK:
+            # FeedbackPoller queries devices through the threaded transports.
+            if read_feedback(DISPATCHER.snapshot)['queries']:
+                raise CommandError(
+                    '--asyncio can\'t poll device state; remove the state queries '
+                    'or set RIKER_STATE_FEEDBACK=false.'
+                )
+            LOGGER.warning('State feedback is not available with --asyncio; device responses are not matched.')
+        DISPATCHER.store.start()
+        METRICS.publish(settings.RIKER_METRICS_FILE, settings.RIKER_METRICS_INTERVAL)
+        if options['asyncio']:
+            import commands.aio
+            loop = asyncio.get_event_loop()
+            DISPATCHER.transport = commands.aio
+            DISPATCHER.executor = AsyncCommandExecutor(
+                loop,
+                queue_depth=settings.RIKER_DEVICE_QUEUE_DEPTH,
+                policy=settings.RIKER_DEVICE_QUEUE_POLICY,
+            )
+            DISPATCHER.scheduler = LoopScheduler(loop)
+        DISPATCHER.load()
+        self.services = Services()
+        if options['asyncio']:
+            self.services.start_async_transports(asyncio.get_event_loop())
+        else:
+            self.services.start_transports()
+            if settings.RIKER_STATE_FEEDBACK:
+                self.services.start_feedback()
+        # The asyncio transports and timers belong to the event loop.
+        self.services.start_change_listener(asyncio.get_event_loop() if options['asyncio'] else None)
+        if options['asyncio'] or options['tcp_trigger'] or options['http_trigger'] or options['evdev']:
+            self.run_hub(name, options, asyncio.get_event_loop())
+            return
+        if options['backend'] == 'none':
+            raise CommandError('--backend none needs at least one other input.')
+        if options['backend'] == 'lircd':
+            LOGGER.info('Listening on lircd socket %s.', options['lircd_socket'])
+            listen_lircd(options['lircd_socket'], button_filter=DISPATCHER.has_button)
+            return
         fname = create_lircrc_tempfile(name)
-        LOGGER.warning(
-            'Created lircrc file at {}; starting to listen.'.format(
-                fname
+        LOGGER.info('Created lircrc file at %s; starting to listen.', fname)
+        # python-lirc's configuration belongs to the thread reading from it.
+        reloads = queue.Queue()
+        self.services.reload_hooks.append(lambda plan: reloads.put(plan.buttons))
+        listen(name, fname, reloads=reloads)
+
+    def run_hub(self, name, options, loop):
+        """
+        Run every configured input on the event loop, feeding one queue.
+        """
+        hub = InputHub(loop)
+        if options['backend'] == 'lircd':
+            LOGGER.info('Listening on lircd socket %s.', options['lircd_socket'])
+            hub.add(LircdSource(options['lircd_socket'], button_filter=DISPATCHER.has_button))
+        elif options['backend'] == 'lirc':
+            fname = create_lircrc_tempfile(name)
+            LOGGER.info('Created lircrc file at %s; starting to listen.', fname)
+            self.services.reload_hooks.append(
+                lambda plan: loop.call_soon_threadsafe(refresh_lircrc, name, fname, plan.buttons)
             )
-        )
-        listen(name, fname)
+            hub.add(LircSource(name, fname))
+        if options['tcp_trigger']:
+            hub.add(TcpTriggerSource(*parse_address(options['tcp_trigger'])))
+        if options['http_trigger']:
+            hub.add(PressApiSource(
+                *parse_address(options['http_trigger']),
+                tokens=settings.RIKER_API_TOKENS,
+                wait_timeout=settings.RIKER_API_WAIT_TIMEOUT
+            ))
+        for path in options['evdev']:
+            hub.add(EvdevSource(path))
+        if not hub.sources:
+            raise CommandError('No inputs configured.')
+        hub.start()
+        loop.run_forever()
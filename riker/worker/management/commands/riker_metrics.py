@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from systemstate.metrics import STAGES
+from worker.views import load_metrics
+
+
+class Command(BaseCommand):
+
+    help = 'Print keypress-to-wire latency percentiles recorded by the listener.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Print the raw snapshot as JSON.',
+        )
+
+    def handle(self, *args, **options):
+        snapshot = load_metrics()
+        if options['json']:
+            self.stdout.write(json.dumps(snapshot, indent=2, sort_keys=True))
+            return
+        row = '{:<14}{:<32}{:>8}{:>10}{:>10}{:>10}{:>10}'
+        self.stdout.write(row.format('stage', 'button/device', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        for stage in STAGES:
+            labels = snapshot['stages'].get(stage, {})
+            for label, summary in sorted(labels.items(), key=lambda x: -x[1]['p95']):
+                self.stdout.write(row.format(
+                    stage,
+                    label[:31],
+                    summary['count'],
+                    '{:.2f}'.format(summary['p50'] * 1000),
+                    '{:.2f}'.format(summary['p95'] * 1000),
+                    '{:.2f}'.format(summary['p99'] * 1000),
+                    '{:.2f}'.format(summary['max'] * 1000),
+                ))
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from logging import getLogger
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from systemstate.dispatch import DISPATCHER
+from systemstate.metrics import METRICS
+from worker.inputs import EvdevSource, InputHub, LircSource, LircdSource
+from worker.services import Services
+from worker.supervisor import Supervisor, parse_receiver
+from worker.utils import create_lircrc_tempfile, refresh_lircrc
+
+
+LOGGER = getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run one input worker per receiver, all feeding a single dispatcher.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--receiver',
+            action='append',
+            dest='receivers',
+            default=list(settings.RIKER_RECEIVERS),
+            metavar='NAME=BACKEND:PATH',
+            help='A receiver to listen on, e.g. kitchen=lircd:/var/run/lirc/lircd-kitchen; '
+                 'may be given more than once.',
+        )
+        parser.add_argument(
+            '--mode',
+            choices=['process', 'async'],
+            default='process',
+            help='Run each receiver in its own process (restarted if it crashes), '
+                 'or all of them as sources on one event loop.',
+        )
+        parser.add_argument(
+            '--snapshot',
+            default=settings.RIKER_SNAPSHOT_FILE,
+            metavar='PATH',
+            help='Run from this configuration snapshot (see export_snapshot) instead of the database.',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            receivers = [parse_receiver(value) for value in options['receivers']]
+        except ValueError as error:
+            raise CommandError(str(error))
+        if not receivers:
+            raise CommandError('No receivers configured; use --receiver or RIKER_RECEIVERS.')
+        if len({receiver.name for receiver in receivers}) < len(receivers):
+            raise CommandError('Receiver names must be unique.')
+
+        if options['snapshot']:
+            if not os.path.exists(options['snapshot']):
+                raise CommandError(
+                    'No snapshot at {}; create it with `manage.py export_snapshot`.'.format(options['snapshot'])
+                )
+            DISPATCHER.use_snapshot(options['snapshot'])
+        DISPATCHER.store.start()
+        METRICS.publish(settings.RIKER_METRICS_FILE, settings.RIKER_METRICS_INTERVAL)
+        DISPATCHER.load()
+        self.services = Services()
+        self.services.start_transports()
+        if settings.RIKER_STATE_FEEDBACK:
+            self.services.start_feedback()
+        self.services.start_change_listener()
+
+        if options['mode'] == 'async':
+            self.run_hub(receivers, asyncio.get_event_loop())
+            return
+        supervisor = Supervisor(
+            receivers,
+            restart_delay=settings.RIKER_RECEIVER_RESTART_DELAY,
+            max_restart_delay=settings.RIKER_RECEIVER_MAX_RESTART_DELAY,
+        )
+        self.services.reload_hooks.append(supervisor.reload)
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            pass
+
+    def run_hub(self, receivers, loop):
+        hub = InputHub(loop)
+        for receiver in receivers:
+            if receiver.backend == 'lircd':
+                source = LircdSource(receiver.path, button_filter=DISPATCHER.has_button)
+            elif receiver.backend == 'evdev':
+                source = EvdevSource(receiver.path)
+            else:
+                fname = create_lircrc_tempfile(receiver.name)
+                self.services.reload_hooks.append(
+                    lambda plan, name=receiver.name, fname=fname:
+                        loop.call_soon_threadsafe(refresh_lircrc, name, fname, plan.buttons)
+                )
+                source = LircSource(receiver.name, fname)
+            source.name = receiver.name
+            hub.add(source)
+        hub.start()
+        loop.run_forever()
@@ -0,0 +1,119 @@
+import asyncio
+import hmac
+import json
+from itertools import count
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from worker.inputs import MACRO, PRESS, HttpError, HttpTriggerSource
+
+# Jobs are remembered for this many seconds after they finish so that a
+# client can still ask for their outcome.
+JOB_RETENTION = 60.0
+
+
+class PressApiSource(HttpTriggerSource):
+    """
+    The button-press API served by the listener:
+
+        POST /press/<code>    press one button
+        POST /press           press several; body {"codes": [...]}
+        POST /macro/<name>    run one CommandSet by name
+        GET  /jobs/<id>       outcome of an earlier request
+
+    Requests are queued on the input hub and answered 202 with a job id;
+    ``?wait=<seconds>`` (or ``?wait=1``) answers once the job's commands
+    have been sent instead. The first request on a connection must carry
+    ``Authorization: Bearer <token>`` with one of ``tokens``, which may not be
+    empty; the connection stays authenticated for its keep-alive lifetime.
+    """
+
+    name = 'http'
+
+    def __init__(self, host, port, tokens=(), wait_timeout=5.0):
+        if not tokens:
+            raise ValueError('The button-press API needs at least one token.')
+        super(PressApiSource, self).__init__(host, port)
+        self.tokens = [token.encode('utf-8') for token in tokens]
+        self.wait_timeout = wait_timeout
+        self.jobs = {}
+        self._job_ids = count(1)
+        self._loop = None
+
+    async def start(self, loop, emit):
+        self._loop = loop
+        await super(PressApiSource, self).start(loop, emit)
+
+    def authenticate(self, request, state):
+        if state.get('authenticated'):
+            return
+        scheme, _, token = request.headers.get('authorization', '').partition(' ')
+        token = token.strip().encode('utf-8')
+        if scheme.lower() != 'bearer' or not any(hmac.compare_digest(token, x) for x in self.tokens):
+            raise HttpError(401, 'A valid bearer token is required.')
+        state['authenticated'] = True
+
+    def submit(self, emit, kind, code):
+        job_id = next(self._job_ids)
+        job = self._loop.create_future()
+        self.jobs[job_id] = job
+        job.add_done_callback(lambda _: self._loop.call_later(JOB_RETENTION, self.jobs.pop, job_id, None))
+        if not emit(code, kind=kind, job=job):
+            job.set_result(('dropped', None))
+        return job_id
+
+    def describe(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HttpError(404, 'Unknown job {}.'.format(job_id))
+        if not job.done():
+            return {'job': job_id, 'status': 'queued'}
+        status, result = job.result()
+        return {'job': job_id, 'status': status, 'result': result}
+
+    def wait_time(self, query):
+        values = query.get('wait')
+        if not values or values[-1] in ('', '0', 'false'):
+            return None
+        try:
+            wait = float(values[-1])
+        except ValueError:
+            raise HttpError(400, 'wait must be a number of seconds.')
+        return self.wait_timeout if wait == 1 else min(wait, self.wait_timeout)
+
+    def read_codes(self, request):
+        try:
+            body = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            raise HttpError(400, 'Body must be JSON.')
+        codes = body.get('codes') if isinstance(body, dict) else body
+        if not isinstance(codes, list) or not all(isinstance(x, str) and x for x in codes):
+            raise HttpError(400, 'Expected {"codes": ["KEY_...", ...]}.')
+        return codes
+
+    async def respond(self, request, emit, state):
+        self.authenticate(request, state)
+        url = urlsplit(request.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        if request.method == 'GET' and len(parts) == 2 and parts[0] == 'jobs':
+            try:
+                return 200, self.describe(int(parts[1]))
+            except ValueError:
+                raise HttpError(404, 'Unknown job {}.'.format(parts[1]))
+        if request.method != 'POST':
+            raise HttpError(405, 'Use POST.')
+        if parts == ['press']:
+            job_ids = [self.submit(emit, PRESS, code) for code in self.read_codes(request)]
+        elif len(parts) == 2 and parts[0] == 'press' and parts[1]:
+            job_ids = [self.submit(emit, PRESS, parts[1])]
+        elif len(parts) == 2 and parts[0] == 'macro' and parts[1]:
+            job_ids = [self.submit(emit, MACRO, parts[1])]
+        else:
+            raise HttpError(404, 'Not found.')
+        wait = self.wait_time(parse_qs(url.query))
+        if wait is not None:
+            pending = [self.jobs[job_id] for job_id in job_ids]
+            done, _ = await asyncio.wait(pending, timeout=wait, loop=self._loop)
+            if len(done) < len(pending):
+                return 504, {'jobs': [self.describe(job_id) for job_id in job_ids]}
+            return 200, {'jobs': [self.describe(job_id) for job_id in job_ids]}
+        return 202, {'jobs': job_ids}
@@ -0,0 +1,64 @@
+from django.conf import settings
+
+from commands.utils import get_cec_session, get_tcp_pool
+from systemstate.dispatch import DISPATCHER
+from systemstate.feedback import FeedbackPoller
+from systemstate.notify import ChangeListener
+
+
+class Services(object):
+    """
+    The background services a listening worker runs next to its inputs:
+    device transports, state feedback and the configuration change listener.
+    ``reload_hooks`` are called with the new plan whenever it is rebuilt.
+    """
+
+    def __init__(self, dispatcher=DISPATCHER):
+        self.dispatcher = dispatcher
+        self.reload_hooks = []
+
+    def start_transports(self):
+        if settings.RIKER_TCP_PREWARM:
+            get_tcp_pool().prewarm({config[:2] for config in self.dispatcher.devices.configs('tcp')})
+        self.start_cec_session(self.dispatcher.plan)
+        self.reload_hooks.append(self.start_cec_session)
+
+    def start_async_transports(self, loop):
+        """
+        start_transports() for the asyncio transports in commands.aio; the
+        connections are opened on ``loop``.
+        """
+        import commands.aio
+        if settings.RIKER_TCP_PREWARM:
+            loop.create_task(commands.aio.prewarm_tcp(
+                {tuple(config[:2]) for config in self.dispatcher.devices.configs('tcp')}
+            ))
+
+        def start_cec_session(plan):
+            if self.uses_cec():
+                loop.create_task(commands.aio.get_cec_client().ensure_started())
+
+        start_cec_session(self.dispatcher.plan)
+        self.reload_hooks.append(start_cec_session)
+
+    def start_feedback(self):
+        poller = FeedbackPoller(self.dispatcher, timeout=settings.RIKER_STATE_QUERY_TIMEOUT)
+        poller.start(get_tcp_pool())
+        self.dispatcher.feedback = poller
+        self.reload_hooks.append(poller.reload)
+
+    def start_change_listener(self, loop=None):
+        listener = ChangeListener(self.dispatcher, on_reload=self.run_reload_hooks, loop=loop)
+        listener.start()
+        return listener
+
+    def run_reload_hooks(self, plan):
+        for hook in self.reload_hooks:
+            hook(plan)
+
+    def uses_cec(self):
+        return any('cec' in device for device in self.dispatcher.devices.devices.values())
+
+    def start_cec_session(self, plan):
+        if self.uses_cec():
+            get_cec_session().start()
@@ -0,0 +1,130 @@
+"""
+Measure how long the listener takes to start, and which imports it spends
+that time on. ``python -m worker.startup SETTINGS COMMAND [--checks]`` runs
+one measurement and prints it as JSON; measure() runs that in a fresh
+interpreter so nothing is already imported. This module must not import
+Django at the top, or the timings would miss it.
+"""
+import json
+import os
+import subprocess
+import sys
+from importlib import import_module
+from time import perf_counter
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TimedLoader(object):
+    """
+    Wraps a module's loader to time its execution.
+    """
+
+    def __init__(self, timer, loader):
+        self.timer = timer
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Modules look like they were loaded normally afterwards.
+        module.__loader__ = module.__spec__.loader = self.loader
+        self.timer.enter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.timer.exit(module.__name__)
+
+
+class ImportTimer(object):
+    """
+    A meta path finder that records, for each module imported while it is
+    installed, the time spent executing the module itself ("self") and
+    including the imports it triggered ("cumulative"), in seconds.
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self._stack = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if hasattr(spec.loader, 'exec_module'):
+                spec.loader = TimedLoader(self, spec.loader)
+            return spec
+        return None
+
+    def enter(self):
+        self._stack.append([perf_counter(), 0.0])
+
+    def exit(self, name):
+        started, children = self._stack.pop()
+        elapsed = perf_counter() - started
+        if self._stack:
+            self._stack[-1][1] += elapsed
+        self.modules[name] = {'self': elapsed - children, 'cumulative': elapsed}
+
+
+def run(settings_module, command, checks=False):
+    timer = ImportTimer()
+    timer.install()
+    os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+    started = perf_counter()
+    import django
+    django.setup()
+    setup = perf_counter()
+    import_module('worker.management.commands.{}'.format(command))
+    imported = perf_counter()
+    if checks:
+        from django.core.checks import run_checks
+        run_checks()
+    finished = perf_counter()
+    timer.uninstall()
+    return {
+        'settings': settings_module,
+        'command': command,
+        'checks': checks,
+        'seconds': {
+            'setup': setup - started,
+            'command': imported - setup,
+            'checks': finished - imported,
+            'total': finished - started,
+        },
+        'modules': timer.modules,
+    }
+
+
+def measure(settings_module, command, checks=False):
+    """
+    Run one measurement in a new interpreter and return its results.
+    """
+    args = [sys.executable, '-m', 'worker.startup', settings_module, command]
+    if checks:
+        args.append('--checks')
+    output = subprocess.check_output(args, cwd=BASE_DIR)
+    return json.loads(output.decode('utf-8'))
+
+
+def main(argv):
+    result = run(argv[1], argv[2], checks='--checks' in argv[3:])
+    sys.stdout.write(json.dumps(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,197 @@
+import asyncio
+import multiprocessing
+import signal
+from collections import namedtuple
+from logging import getLogger
+from multiprocessing.connection import wait
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.utils.log import configure_logging
+
+from systemstate.utils import push_button
+from worker.inputs import EvdevSource
+from worker.utils import create_lircrc_tempfile, listen, listen_lircd, write_lircrc
+
+LOGGER = getLogger(__name__)
+
+Receiver = namedtuple('Receiver', ['name', 'backend', 'path'])
+
+RECEIVER_BACKENDS = ('lircd', 'evdev', 'lirc')
+
+
+def parse_receiver(value):
+    """
+    Parse "name=backend:path", e.g. "kitchen=lircd:/var/run/lirc/lircd-kitchen".
+    """
+    name, _, spec = value.partition('=')
+    backend, _, path = spec.partition(':')
+    if not name or backend not in RECEIVER_BACKENDS or (backend != 'lirc' and not path):
+        raise ValueError(
+            'Expected "name=backend:path" with backend one of {}; got {!r}.'.format(RECEIVER_BACKENDS, value)
+        )
+    return Receiver(name, backend, path or None)
+
+
+def run_receiver(receiver, connection, lircrc_filename=None):
+    """
+    Entry point of a receiver process: read one receiver's input and send
+    (receiver name, code, repeat, received) tuples over ``connection``. The
+    process holds no state, so it can be restarted at any time.
+    """
+    # Logging handlers and their threads don't survive the fork.
+    configure_logging(settings.LOGGING_CONFIG, settings.LOGGING)
+    # Ctrl-C is for the supervisor, which stops its receivers itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def emit(code, repeat=None, received=None):
+        connection.send((receiver.name, code, repeat, received or monotonic()))
+
+    if receiver.backend == 'lircd':
+        listen_lircd(receiver.path, callback=emit)
+    elif receiver.backend == 'lirc':
+        listen(receiver.name, lircrc_filename, callback=emit)
+    else:
+        loop = asyncio.new_event_loop()
+        EvdevSource(receiver.path).start(loop, emit)
+        loop.run_forever()
+
+
+class Supervisor(object):
+    """
+    Runs one process per receiver and dispatches the events they send, in
+    arrival order, on the supervisor's own dispatcher. Each receiver has its
+    own pipe, so one that is killed mid-write can't block the others. Since
+    that dispatcher is the only one, every zone sees and updates the same
+    StateSets. A receiver that exits is restarted after ``restart_delay``
+    seconds, doubling up to ``max_restart_delay`` while it keeps exiting
+    within that time of starting.
+    """
+
+    def __init__(self, receivers, dispatch=None, restart_delay=1.0, max_restart_delay=30.0, context=None):
+        self.receivers = {receiver.name: receiver for receiver in receivers}
+        self.dispatch = dispatch or push_button
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.context = context or multiprocessing.get_context('fork')
+        self.processes = {}
+        self.restarts = {}
+        self.lircrc_files = {}
+        self._delays = {}
+        self._pending = {}
+        self._reloading = set()
+        self._lock = Lock()
+        self._stopping = False
+
+    def start_receiver(self, name):
+        receiver = self.receivers[name]
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_receiver,
+            args=(receiver, writer, self.lircrc_files.get(name)),
+            name='riker-receiver-{}'.format(name),
+            daemon=True,
+        )
+        process.start()
+        writer.close()
+        self.processes[name] = (process, reader, monotonic())
+        LOGGER.info('Started receiver %s (%s %s) as process %s.', name, receiver.backend, receiver.path, process.pid)
+
+    def start(self):
+        with self._lock:
+            for name, receiver in sorted(self.receivers.items()):
+                if receiver.backend == 'lirc':
+                    self.lircrc_files[name] = create_lircrc_tempfile(name)
+                self.start_receiver(name)
+
+    def check_receivers(self):
+        """
+        Schedule a restart for every receiver that has exited, and start the
+        ones whose restart delay has passed.
+        """
+        now = monotonic()
+        with self._lock:
+            for name in self._reloading:
+                self._pending.pop(name, None)
+                process, reader, _ = self.processes[name]
+                process.terminate()
+                process.join()
+                reader.close()
+                self.start_receiver(name)
+            self._reloading = set()
+            for name, (process, reader, started) in list(self.processes.items()):
+                if name in self._pending or process.is_alive():
+                    continue
+                delay = self.restart_delay
+                if now - started < self.max_restart_delay:
+                    delay = min(self._delays.get(name, self.restart_delay / 2) * 2, self.max_restart_delay)
+                self._delays[name] = delay
+                self._pending[name] = now + delay
+                reader.close()
+                LOGGER.error('Receiver %s exited with code %s; restarting in %.1fs.', name, process.exitcode, delay)
+            for name, due in list(self._pending.items()):
+                if due <= now and not self._stopping:
+                    del self._pending[name]
+                    self.restarts[name] = self.restarts.get(name, 0) + 1
+                    self.start_receiver(name)
+
+    def reload(self, plan):
+        """
+        python-lirc's configuration lives in each lirc receiver's own process,
+        where refresh_lircrc() can't reach it from here. Receivers hold no
+        state, so rewrite their lircrc files for the new plan and have
+        check_receivers() restart them, which loads the new files.
+        """
+        with self._lock:
+            for name, filename in self.lircrc_files.items():
+                write_lircrc(name, filename, plan.buttons)
+                self._reloading.add(name)
+
+    def dispatch_event(self, event):
+        name, code, repeat, received = event
+        try:
+            self.dispatch(code, repeat, received)
+        except Exception:
+            LOGGER.exception('Dispatching %s from receiver %s failed.', code, name)
+
+    def receive(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for events from any receiver.
+        """
+        with self._lock:
+            readers = [reader for _, reader, _ in self.processes.values() if not reader.closed]
+        events = []
+        for reader in wait(readers, timeout):
+            try:
+                events.append(reader.recv())
+            except (EOFError, OSError):
+                # The receiver exited; check_receivers() restarts it.
+                reader.close()
+        return sorted(events, key=lambda event: event[3])
+
+    def run(self, check_interval=0.5):
+        self.start()
+        next_check = monotonic() + check_interval
+        try:
+            while not self._stopping:
+                for event in self.receive(check_interval):
+                    self.dispatch_event(event)
+                if monotonic() >= next_check:
+                    self.check_receivers()
+                    next_check = monotonic() + check_interval
+        finally:
+            self.stop_receivers()
+
+    def stop(self):
+        self._stopping = True
+
+    def stop_receivers(self):
+        with self._lock:
+            processes, self.processes = self.processes, {}
+            self._pending = {}
+        for process, _, _ in processes.values():
+            process.terminate()
+        for process, reader, _ in processes.values():
+            process.join()
+            reader.close()
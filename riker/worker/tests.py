@@ -0,0 +1,493 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from threading import Thread, Timer
+from time import monotonic
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from riker.logutils import BackgroundHandler, Event, JsonFormatter, log_event
+from systemstate.executor import CommandExecutor
+from systemstate.metrics import METRICS
+from systemstate.models import Device, StateQuery, StateSet
+from worker.inputs import HttpTriggerSource, InputHub, TcpTriggerSource
+from worker.lircd import LircEvent, LircdClient, parse_event
+from worker.pressapi import PressApiSource
+from worker.services import Services
+from worker.startup import measure
+from worker.supervisor import Receiver, Supervisor, parse_receiver
+from worker.utils import listen
+
+
+class FakeLircd(object):
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'lircd')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(1)
+        self.conn = None
+
+    def accept(self):
+        self.conn, _ = self.listener.accept()
+
+    def send(self, *lines):
+        self.conn.sendall(''.join(line + '\n' for line in lines).encode('ascii'))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.listener.close()
+        shutil.rmtree(self.directory)
+
+
+class FakeLirc(object):
+    """
+    Stands in for the python-lirc module: codes written with press() are
+    returned by nextcode(), which refuses to be called in blocking mode.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.blocking = None
+        self.loaded = []
+
+    def init(self, name, config_filename, blocking=True):
+        self.blocking = blocking
+        return self.read_fd
+
+    def nextcode(self):
+        if self.blocking:
+            raise AssertionError('nextcode() would hold the GIL while it waits.')
+        return os.read(self.read_fd, 4096).decode('ascii').split()
+
+    def load_config_file(self, filename):
+        self.loaded.append((filename, threading.get_ident()))
+
+    def press(self, code):
+        os.write(self.write_fd, (code + '\n').encode('ascii'))
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class StopListening(Exception):
+    pass
+
+
+class LircListenTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lirc = FakeLirc()
+        self.addCleanup(self.lirc.close)
+        patcher = mock.patch.dict(sys.modules, {'lirc': self.lirc})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.codes = queue.Queue()
+
+    def callback(self, code, repeat, received):
+        if code == 'KEY_STOP':
+            raise StopListening()
+        self.codes.put(code)
+
+    def start_listening(self, lircrc_filename='/dev/null', **kwargs):
+        def run():
+            try:
+                listen('riker', lircrc_filename, callback=self.callback, **kwargs)
+            except StopListening:
+                pass
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(self.lirc.press, 'KEY_STOP')
+        return thread
+
+    def test_idle_listener_does_not_hold_up_sends(self):
+        self.start_listening()
+        executor = CommandExecutor()
+        self.addCleanup(executor.stop)
+        sent = queue.Queue()
+        executor.submit('receiver', sent.put, 'PO')
+        self.assertEqual(sent.get(timeout=5), 'PO')
+        self.assertFalse(self.lirc.blocking)
+        self.lirc.press('KEY_UP')
+        self.assertEqual(self.codes.get(timeout=5), 'KEY_UP')
+
+    def test_reloads_happen_on_the_listening_thread(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'lircrc')
+        reloads = queue.Queue()
+        thread = self.start_listening(lircrc_filename=filename, reloads=reloads)
+        reloads.put(['KEY_UP'])
+        reloads.put(['KEY_UP', 'KEY_DOWN'])
+        deadline = monotonic() + 5
+        while not self.lirc.loaded and monotonic() < deadline:
+            thread.join(0.01)
+        self.assertEqual(self.lirc.loaded, [(filename, thread.ident)])
+        with open(filename) as lircrc:
+            self.assertIn('KEY_DOWN', lircrc.read())
+
+
+class LircdClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lircd = FakeLircd()
+        self.addCleanup(self.lircd.close)
+
+    def test_parse_event(self):
+        self.assertEqual(
+            parse_event('0000000000f40bf0 0a KEY_UP devinput'),
+            LircEvent('0000000000f40bf0', 10, 'KEY_UP', 'devinput'),
+        )
+        self.assertIsNone(parse_event('SIGHUP'))
+
+    def test_events_skip_replies_and_filtered_buttons(self):
+        buttons = {'KEY_UP'}
+        client = LircdClient(self.lircd.path, button_filter=buttons.__contains__)
+        self.addCleanup(client.close)
+        client.connect()
+        self.lircd.accept()
+        self.lircd.send(
+            'BEGIN',
+            'LIST',
+            'SUCCESS',
+            'END',
+            '0000000000f40bf0 00 KEY_UP devinput',
+            '0000000000f40bf1 00 KEY_DOWN devinput',
+        )
+        self.lircd.send('0000000000f40bf0 01 KEY_UP devinput')
+        events = client.events()
+        self.assertEqual(next(events).repeat, 0)
+        self.assertEqual(next(events).repeat, 1)
+        buttons.add('KEY_DOWN')
+        self.lircd.conn.sendall(b'0000000000f40bf1 00 KEY_DOWN')
+        self.lircd.conn.sendall(b' devinput\n')
+        self.assertEqual(next(events).button, 'KEY_DOWN')
+
+    def test_watch_on_event_loop(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        received = []
+        client = LircdClient(self.lircd.path)
+        self.addCleanup(client.close)
+        client.watch(received.append, loop=loop)
+        self.lircd.accept()
+        self.lircd.send('0000000000f40bf0 00 KEY_UP devinput')
+        loop.call_later(0.05, loop.stop)
+        loop.run_forever()
+        loop.remove_reader(client.fileno())
+        self.assertEqual([x.button for x in received], ['KEY_UP'])
+
+
+@override_settings(RIKER_METRICS_FILE='/nonexistent/metrics.json')
+class MetricsViewTests(TestCase):
+
+    def setUp(self):
+        METRICS.reset()
+        self.addCleanup(METRICS.reset)
+
+    def test_reports_devices_by_name(self):
+        device = Device.objects.create(name='Receiver')
+        METRICS.observe('send', device.pk, 0.004)
+        METRICS.observe('press', 'KEY_VOLUMEUP', 0.005)
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        stages = response.json()['stages']
+        self.assertEqual(stages['send']['Receiver']['p50'], 0.004)
+        self.assertEqual(stages['press']['KEY_VOLUMEUP']['count'], 1)
+
+    def test_local_only(self):
+        response = self.client.get('/metrics/', REMOTE_ADDR='192.168.1.20')
+        self.assertEqual(response.status_code, 403)
+
+
+class LogEventTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = BackgroundHandler(self.stream)
+        self.addCleanup(self.handler.close)
+        self.logger = logging.getLogger('worker.tests.events')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_fields_are_not_rendered_below_level(self):
+        rendered = []
+
+        class Field(object):
+            def __repr__(self):
+                rendered.append(self)
+                return 'field'
+
+        self.logger.setLevel(logging.INFO)
+        log_event(self.logger, logging.DEBUG, 'button.execute', button=Field())
+        self.handler.close()
+        self.assertEqual(self.stream.getvalue(), '')
+        self.assertEqual(rendered, [])
+
+    def test_written_in_background(self):
+        self.logger.setLevel(logging.DEBUG)
+        self.handler.setFormatter(JsonFormatter())
+        log_event(self.logger, logging.DEBUG, 'tcp.send', host='receiver', port=23)
+        self.handler.close()
+        record = json.loads(self.stream.getvalue())
+        self.assertEqual(record['event'], 'tcp.send')
+        self.assertEqual(record['port'], 23)
+        self.assertEqual(str(Event('tcp.send', {'port': 23})), 'tcp.send port=23')
+
+
+class InputHubTests(SimpleTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self.loop.run_until_complete, asyncio.sleep(0.01, loop=self.loop))
+        self.presses = []
+        self.hub = InputHub(self.loop, callback=lambda code, repeat, received, on_sent: self.presses.append((code, repeat)))
+        self.tcp = self.hub.add(TcpTriggerSource('127.0.0.1', 0))
+        self.http = self.hub.add(HttpTriggerSource('127.0.0.1', 0))
+        self.hub.start()
+        self.addCleanup(self.hub.stop)
+
+    def run_client(self, client):
+        self.loop.run_until_complete(asyncio.wait_for(client(), 5, loop=self.loop))
+        self.loop.run_until_complete(asyncio.sleep(0.01, loop=self.loop))
+
+    def test_sources_share_one_ordered_queue(self):
+        async def client():
+            reader, writer = await asyncio.open_connection(*self.tcp.address, loop=self.loop)
+            writer.write(b'KEY_UP\nKEY_DOWN 2\n')
+            while len(self.presses) < 2:
+                await asyncio.sleep(0.001, loop=self.loop)
+            http_reader, http_writer = await asyncio.open_connection(*self.http.address, loop=self.loop)
+            for code in ('KEY_LEFT', 'KEY_RIGHT'):
+                http_writer.write('POST /press/{} HTTP/1.1\r\nContent-Length: 0\r\n\r\n'.format(code).encode('ascii'))
+                status = await http_reader.readline()
+                self.assertEqual(status, b'HTTP/1.1 202 Accepted\r\n')
+                headers = await http_reader.readuntil(b'\r\n\r\n')
+                length = int(headers.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+                await http_reader.readexactly(length)
+            writer.close()
+            http_writer.close()
+
+        self.run_client(client)
+        self.assertEqual(
+            self.presses,
+            [('KEY_UP', None), ('KEY_DOWN', 2), ('KEY_LEFT', None), ('KEY_RIGHT', None)],
+        )
+
+    def test_blocking_dispatch_runs_off_the_loop(self):
+        threads = []
+        hub = InputHub(
+            self.loop,
+            callback=lambda code, repeat, received, on_sent: threads.append(threading.get_ident()),
+            blocking=True,
+        )
+        self.addCleanup(hub.stop)
+        hub.start()
+        hub.emitter('test')('KEY_UP')
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+
+    def test_http_rejects_unknown_paths(self):
+        async def client():
+            reader, writer = await asyncio.open_connection(*self.http.address, loop=self.loop)
+            writer.write(b'GET /press/KEY_UP HTTP/1.1\r\n\r\n')
+            self.assertEqual(await reader.readline(), b'HTTP/1.1 405 Method Not Allowed\r\n')
+            writer.close()
+
+        self.run_client(client)
+        self.assertEqual(self.presses, [])
+
+
+class PressApiTests(SimpleTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self.loop.run_until_complete, asyncio.sleep(0.01, loop=self.loop))
+        self.presses = []
+        self.sent = []
+        self.hub = InputHub(
+            self.loop,
+            callback=self.press,
+            macro_callback=self.run_macro,
+        )
+        self.api = self.hub.add(PressApiSource('127.0.0.1', 0, tokens=['secret']))
+        self.hub.start()
+        self.addCleanup(self.hub.stop)
+
+    def press(self, code, repeat, received, on_sent=None):
+        self.presses.append(code)
+        if on_sent is not None:
+            # Like a device worker reporting its send from another thread.
+            Timer(0.05, lambda: (self.sent.append(code), on_sent(int(code == 'KEY_BROKEN')))).start()
+
+    def run_macro(self, name, received, on_sent=None):
+        if name != 'Movie night':
+            raise KeyError(name)
+        on_sent(0)
+        return True
+
+    async def request(self, reader, writer, method, path, body=b'', token=None):
+        headers = 'Content-Length: {}\r\n'.format(len(body))
+        if token:
+            headers += 'Authorization: Bearer {}\r\n'.format(token)
+        writer.write('{} {} HTTP/1.1\r\n{}\r\n'.format(method, path, headers).encode('ascii') + body)
+        status = int((await reader.readline()).split()[1])
+        headers = await reader.readuntil(b'\r\n\r\n')
+        length = int(headers.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        return status, json.loads((await reader.readexactly(length)).decode('utf-8'))
+
+    def run_client(self, client):
+        return self.loop.run_until_complete(asyncio.wait_for(client(), 5, loop=self.loop))
+
+    def test_token_authenticates_the_connection(self):
+        async def client():
+            reader, writer = await asyncio.open_connection(*self.api.address, loop=self.loop)
+            status, _ = await self.request(reader, writer, 'POST', '/press/KEY_UP', token='wrong')
+            self.assertEqual(status, 401)
+            status, _ = await self.request(reader, writer, 'POST', '/press/KEY_UP', token='secret')
+            self.assertEqual(status, 202)
+            status, data = await self.request(reader, writer, 'POST', '/press/KEY_DOWN?wait=1')
+            writer.close()
+            return status, data
+
+        status, data = self.run_client(client)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['jobs'][0]['status'], 'done')
+        self.assertEqual(self.presses, ['KEY_UP', 'KEY_DOWN'])
+        self.assertIn('KEY_DOWN', self.sent)
+
+    def test_wait_reports_failed_sends(self):
+        async def client():
+            reader, writer = await asyncio.open_connection(*self.api.address, loop=self.loop)
+            response = await self.request(reader, writer, 'POST', '/press/KEY_BROKEN?wait=1', token='secret')
+            writer.close()
+            return response
+
+        status, data = self.run_client(client)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['jobs'][0]['status'], 'failed')
+
+    def test_tokens_are_required(self):
+        with self.assertRaises(ValueError):
+            PressApiSource('127.0.0.1', 0)
+
+    def test_batch_and_macro(self):
+        async def client():
+            reader, writer = await asyncio.open_connection(*self.api.address, loop=self.loop)
+            batch = await self.request(
+                reader, writer, 'POST', '/press?wait=1', b'{"codes": ["KEY_1", "KEY_2"]}', token='secret'
+            )
+            macro = await self.request(reader, writer, 'POST', '/macro/Movie%20night?wait=1')
+            missing = await self.request(reader, writer, 'POST', '/macro/Nope?wait=1')
+            job = await self.request(reader, writer, 'GET', '/jobs/{}'.format(missing[1]['jobs'][0]['job']))
+            writer.close()
+            return batch, macro, job
+
+        batch, macro, job = self.run_client(client)
+        self.assertEqual(batch[0], 200)
+        self.assertEqual(self.presses, ['KEY_1', 'KEY_2'])
+        self.assertCountEqual(self.sent, ['KEY_1', 'KEY_2'])
+        self.assertEqual(macro[1]['jobs'][0]['result'], True)
+        self.assertEqual(job[1]['status'], 'unknown')
+
+
+class SupervisorTests(SimpleTestCase):
+
+    def test_parse_receiver(self):
+        self.assertEqual(
+            parse_receiver('kitchen=lircd:/var/run/lirc/lircd-kitchen'),
+            Receiver('kitchen', 'lircd', '/var/run/lirc/lircd-kitchen'),
+        )
+        self.assertEqual(parse_receiver('den=lirc'), Receiver('den', 'lirc', None))
+        with self.assertRaises(ValueError):
+            parse_receiver('den=evdev')
+
+    def test_crashed_receiver_is_restarted(self):
+        lircd = FakeLircd()
+        self.addCleanup(lircd.close)
+        lircd.listener.settimeout(10)
+        events = queue.Queue()
+        supervisor = Supervisor(
+            [parse_receiver('den=lircd:' + lircd.path)],
+            dispatch=lambda *args: events.put(args),
+            restart_delay=0.01,
+        )
+        thread = Thread(target=supervisor.run, kwargs={'check_interval': 0.01}, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(supervisor.stop)
+        for attempt in range(2):
+            if lircd.conn is not None:
+                lircd.conn.close()
+            lircd.accept()
+            lircd.send('0000000000f40bf0 00 KEY_UP devinput')
+            code, repeat, received = events.get(timeout=10)
+            self.assertEqual((code, repeat), ('KEY_UP', 0))
+            if not attempt:
+                os.kill(supervisor.processes['den'][0].pid, signal.SIGKILL)
+        self.assertEqual(supervisor.restarts, {'den': 1})
+
+
+class ServicesTests(SimpleTestCase):
+
+    @override_settings(RIKER_TCP_PREWARM=False)
+    @mock.patch('worker.services.get_cec_session')
+    def test_cec_session_starts_once_a_device_needs_it(self, get_cec_session):
+        dispatcher = mock.Mock()
+        dispatcher.devices.devices = {1: {'tcp': None}}
+        services = Services(dispatcher)
+        services.start_transports()
+        self.assertFalse(get_cec_session.called)
+        reloaded = []
+        services.reload_hooks.append(reloaded.append)
+        dispatcher.devices.devices = {1: {'tcp': None}, 2: {'cec': None}}
+        services.run_reload_hooks(dispatcher.plan)
+        get_cec_session.return_value.start.assert_called_once_with()
+        self.assertEqual(reloaded, [dispatcher.plan])
+
+
+
+class AsyncioListenerTests(TestCase):
+
+    @override_settings(RIKER_STATE_FEEDBACK=True)
+    def test_state_queries_need_the_threaded_listener(self):
+        device = Device.objects.create(name='Receiver')
+        state_set = StateSet.objects.create(name='Power', device=device)
+        StateQuery.objects.create(state_set=state_set, command_type='tcp', data='?P')
+        with self.assertRaisesRegex(CommandError, 'RIKER_STATE_FEEDBACK'):
+            call_command('lirc_listen', '--asyncio')
+
+
+class StartupTests(SimpleTestCase):
+
+    def test_worker_settings_skip_web_stack_and_unused_transports(self):
+        result = measure('riker.worker_settings', 'lirc_listen')
+        modules = result['modules']
+        self.assertIn('systemstate.models', modules)
+        self.assertGreaterEqual(
+            modules['systemstate.dispatch']['cumulative'], modules['systemstate.dispatch']['self']
+        )
+        for name in ('django.contrib.admin', 'django.contrib.auth.models', 'serial', 'py_irsend', 'commands.aio'):
+            self.assertNotIn(name, modules)
+        self.assertGreater(result['seconds']['total'], result['seconds']['setup'])
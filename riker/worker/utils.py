@@ -1,24 +1,36 @@
-from logging import getLogger
+import asyncio
+from logging import DEBUG, getLogger
+import os
+import queue
+import select
 import tempfile
 from threading import Thread
+from time import monotonic
 
-import lirc
 from django.conf import settings
 
+from riker.logutils import log_event
+from systemstate.dispatch import DISPATCHER
 from systemstate.models import RemoteButton
 from systemstate.utils import push_button
+from worker.lircd import LircdClient
 
 
 LOGGER = getLogger(__name__)
 
+# How often listen() checks for a new lircrc file while no codes arrive.
+RELOAD_INTERVAL = 0.2
 
+
+# Every repeat is passed through; RemoteButton's repeat policy is applied by
+# the dispatcher.
 LIRCRC_TEMPLATE = '''
 begin
         prog   = {lirc_name}
         button = {key_name}
         config = {key_name}
-        repeat = 2
-        delay = 3
+        repeat = 1
+        delay = 0
 end
 
 '''
@@ -32,26 +44,125 @@ class LircListener(Thread):
         super(LircListener, self).__init__()
 
     def run(self):
-        lirc.init(self.lirc_name, self.lircrc_filename)
         listen(self.lirc_name, self.lircrc_filename)
 
 
-def listen(lirc_name, lircrc_filename, callback=None):
-    lirc.init(lirc_name, lircrc_filename)
+def listen(lirc_name, lircrc_filename, callback=None, reloads=None):
+    """
+    Read codes with python-lirc, waiting in select() rather than in
+    nextcode(), which holds the GIL and would stop every other thread until
+    the next press. Button lists put on the ``reloads`` queue are loaded
+    between reads, on this thread, since python-lirc's configuration isn't
+    thread-safe.
+    """
+    import lirc
+    lirc_socket = lirc.init(lirc_name, lircrc_filename, blocking=False)
     callback = callback or push_button
+    timeout = RELOAD_INTERVAL if reloads is not None else None
+    while True:
+        readable, _, _ = select.select([lirc_socket], [], [], timeout)
+        if reloads is not None:
+            apply_reloads(lirc_name, lircrc_filename, reloads)
+        if not readable:
+            continue
+        received = monotonic()
+        for key_code in lirc.nextcode():
+            log_event(LOGGER, DEBUG, 'input.received', button=key_code)
+            callback(key_code, None, received)
+
+
+def apply_reloads(lirc_name, lircrc_filename, reloads):
+    """
+    Load the latest button list on ``reloads``, skipping any it replaced.
+    """
+    buttons = None
     while True:
+        try:
+            buttons = reloads.get_nowait()
+        except queue.Empty:
+            break
+    if buttons is not None:
+        refresh_lircrc(lirc_name, lircrc_filename, buttons)
+
+
+def listen_async(lirc_name, lircrc_filename, callback=None, loop=None):
+    """
+    Read codes from lircd on the event loop instead of blocking in nextcode().
+    """
+    import lirc
+    loop = loop or asyncio.get_event_loop()
+    callback = callback or push_button
+    lirc_socket = lirc.init(lirc_name, lircrc_filename, blocking=False)
+
+    def read_codes():
+        received = monotonic()
         for key_code in lirc.nextcode():
-            LOGGER.warning(key_code)
-            callback(key_code)
+            log_event(LOGGER, DEBUG, 'input.received', button=key_code)
+            callback(key_code, None, received)
+
+    loop.add_reader(lirc_socket, read_codes)
+    return lirc_socket
 
 
-def create_lircrc_tempfile(lirc_name):
-    buttons = RemoteButton.objects.all().values_list('lirc_code', flat=True)
+def listen_lircd(path, callback=None, button_filter=None):
+    """
+    Read events from the lircd socket directly, without python-lirc or a
+    lircrc file.
+    """
+    callback = callback or push_button
+    for event in LircdClient(path, button_filter).events():
+        received = monotonic()
+        log_event(LOGGER, DEBUG, 'input.received', button=event.button, repeat=event.repeat)
+        callback(event.button, event.repeat, received)
+
+
+def listen_lircd_async(path, callback=None, button_filter=None, loop=None):
+    callback = callback or push_button
+    client = LircdClient(path, button_filter)
+
+    def handle(event):
+        received = monotonic()
+        log_event(LOGGER, DEBUG, 'input.received', button=event.button, repeat=event.repeat)
+        callback(event.button, event.repeat, received)
+
+    client.watch(handle, loop=loop)
+    return client
+
+
+def create_lircrc_tempfile(lirc_name, buttons=None):
+    """
+    Write a lircrc file for ``buttons``; by default, those of the loaded
+    dispatch plan, or of the database before there is one.
+    """
+    if buttons is None:
+        plan = DISPATCHER.plan
+        if plan is not None:
+            buttons = plan.buttons
+        else:
+            buttons = RemoteButton.objects.all().values_list('lirc_code', flat=True)
+    buttons = sorted(buttons)
     with tempfile.NamedTemporaryFile(delete=False) as lircrc_file:
         lircrc_file.write(generate_lircrc(lirc_name, buttons).encode('ascii'))
         return lircrc_file.name
 
 
+def refresh_lircrc(lirc_name, lircrc_filename, buttons):
+    """
+    Rewrite the lircrc file for ``buttons`` and have python-lirc re-read it,
+    so new buttons are delivered without restarting the listener.
+    """
+    import lirc
+    write_lircrc(lirc_name, lircrc_filename, buttons)
+    lirc.load_config_file(lircrc_filename)
+
+
+def write_lircrc(lirc_name, lircrc_filename, buttons):
+    temporary_filename = '{}.tmp'.format(lircrc_filename)
+    with open(temporary_filename, 'w') as lircrc_file:
+        lircrc_file.write(generate_lircrc(lirc_name, sorted(buttons)))
+    os.replace(temporary_filename, lircrc_filename)
+
+
 def generate_lircrc(name, buttons):
     return '\n'.join(
         LIRCRC_TEMPLATE.format(
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.http import HttpResponseForbidden, JsonResponse
+
+from systemstate.metrics import METRICS, read_snapshot
+from systemstate.models import Device
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+DEVICE_STAGES = ('queue', 'send')
+
+
+def name_devices(snapshot):
+    """
+    Per-command stages are recorded by device id; report them by name.
+    """
+    names = {str(pk): name for pk, name in Device.objects.values_list('id', 'name')}
+    for stage in DEVICE_STAGES:
+        if stage in snapshot['stages']:
+            snapshot['stages'][stage] = {
+                names.get(label, label): summary
+                for label, summary in snapshot['stages'][stage].items()
+            }
+    return snapshot
+
+
+def load_metrics():
+    snapshot = read_snapshot(settings.RIKER_METRICS_FILE)
+    if snapshot is None:
+        snapshot = METRICS.snapshot()
+    return name_devices(snapshot)
+
+
+def metrics(request):
+    if request.META.get('REMOTE_ADDR') not in LOCAL_ADDRESSES:
+        return HttpResponseForbidden()
+    return JsonResponse(load_metrics())